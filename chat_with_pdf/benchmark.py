@@ -0,0 +1,395 @@
+"""
+取り込み (抽出・分割・インデックス登録) と検索・質問回答のベンチマーク
+
+    python benchmark.py [--pages 20 200] [--layouts single two_column table sparse]
+                        [--queries 200] [--embed-latency-ms 0] [--output bench.json]
+
+PyMuPDF で決まった乱数の種から合成した PDF を使い、埋め込みは HashingEmbeddings、
+LLM は固定の応答を返す FakeListChatModel なので、ネットワークなしで実行できる。
+結果 (各ステージの時間・スループット・検索のレイテンシのパーセンタイル・ピークメモリ) は
+JSON で出力する。MMR の選び直し (mmr_select) だけの時間も候補数ごとに計る。
+git のリビジョンも記録するので、版ごとの結果を比べられる。
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import faiss
+import fitz  # PyMuPDF
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import FakeListChatModel
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+from bm25 import BM25Index
+from context_packing import DEFAULT_CONTEXT_BUDGET, pack_context
+from embedding_backends import HashingEmbeddings
+from extraction import extract_pages, iter_pages
+from faiss_index import index_kind
+from ingest import ingest
+from retrievers import FaissRetriever, HybridRetriever, MMRRetriever, mmr_select
+from splitter import TokenSplitter
+
+
+LAYOUTS = ("single", "two_column", "table", "sparse")
+RETRIEVAL_MODES = ("vector", "hybrid", "mmr", "lexical")
+PERCENTILES = (50, 90, 99)
+# 1ページあたりのトピック数 (検索のクエリはページのトピックの語から作る)
+TOPICS = 64
+K = 10
+# mmr_select だけの時間を計る候補数と次元 (text-embedding-3-small と同じ 1536 次元)
+MMR_CANDIDATES = (100, 200, 300)
+MMR_DIMENSION = 1536
+
+_SYLLABLES = [c + v for c in "bdfgklmnprstvz" for v in "aeiou"]
+
+
+class LatencyEmbeddings(Embeddings):
+    """ API の往復時間を真似て、呼び出しごとに latency 秒待つ """
+
+    def __init__(self, embeddings, latency):
+        self.embeddings = embeddings
+        self.latency = latency
+        self.model = embeddings.model
+        self.dimensions = embeddings.dimensions
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        time.sleep(self.latency)
+        return self.embeddings.embed_query(text)
+
+
+class PeakRSS:
+    """ with の間のこのプロセスの最大 RSS を 10ms ごとに測る (Linux 以外では ru_maxrss) """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    @staticmethod
+    def current():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            # ru_maxrss は Linux では KB、macOS ではバイト
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+    @property
+    def peak_mb(self):
+        return round(self.peak / 2**20, 1)
+
+
+def _vocabulary(rng, size=4_000):
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(1, 4))))
+    return sorted(words)
+
+
+def _topic_words(vocabulary, topic):
+    # トピックごとに語彙の一部を決めておき、ページの本文はそこから多めに選ぶ
+    rng = random.Random(topic)
+    return rng.sample(vocabulary, 40)
+
+
+def _paragraph(rng, vocabulary, topic_words, n_words):
+    words = [
+        rng.choice(topic_words) if rng.random() < 0.3 else rng.choice(vocabulary)
+        for _ in range(n_words)
+    ]
+    sentences, start = [], 0
+    while start < len(words):
+        stop = start + rng.randint(8, 20)
+        sentences.append(" ".join(words[start:stop]).capitalize() + ".")
+        start = stop
+    return " ".join(sentences)
+
+
+def _page_topic(page_no):
+    return page_no * 7919 % TOPICS
+
+
+def make_pdf(path, pages, layout="single", seed=0):
+    """ 決まった内容の合成 PDF を作る。同じ引数なら同じ PDF になる """
+    rng = random.Random(f"{seed}:{layout}")
+    vocabulary = _vocabulary(random.Random(seed))
+    doc = fitz.open()
+    for page_no in range(1, pages + 1):
+        topic_words = _topic_words(vocabulary, _page_topic(page_no))
+        page = doc.new_page()
+        width, height = page.rect.width, page.rect.height
+        page.insert_text((50, 40), f"Section {page_no}: {' '.join(topic_words[:3])}", fontsize=14)
+        if layout == "single":
+            text = "\n\n".join(_paragraph(rng, vocabulary, topic_words, 90) for _ in range(4))
+            page.insert_textbox(fitz.Rect(50, 60, width - 50, height - 50), text, fontsize=10)
+        elif layout == "two_column":
+            middle = width / 2
+            for left, right in ((50, middle - 10), (middle + 10, width - 50)):
+                text = "\n\n".join(_paragraph(rng, vocabulary, topic_words, 60) for _ in range(3))
+                page.insert_textbox(fitz.Rect(left, 60, right, height - 50), text, fontsize=9)
+        elif layout == "table":
+            y = 70
+            for row in range(30):
+                cells = [
+                    f"AB-{rng.randint(100, 999)}",
+                    rng.choice(topic_words),
+                    f"{rng.uniform(0, 100):.2f}",
+                    rng.choice(vocabulary),
+                ]
+                for col, cell in enumerate(cells):
+                    page.insert_text((50 + col * 120, y), cell, fontsize=9)
+                y += 20
+        elif layout == "sparse":
+            text = _paragraph(rng, vocabulary, topic_words, 25)
+            page.insert_textbox(fitz.Rect(50, 80, width - 50, 300), text, fontsize=12)
+        else:
+            raise ValueError(f"unknown layout: {layout}")
+    doc.save(path, garbage=3, deflate=True)
+    doc.close()
+
+
+def _percentiles(seconds):
+    ms = np.asarray(seconds) * 1000
+    result = {f"p{p}_ms": round(float(np.percentile(ms, p)), 3) for p in PERCENTILES}
+    result["mean_ms"] = round(float(ms.mean()), 3)
+    return result
+
+
+def _queries(pages, n_queries, seed=0):
+    """ (クエリ, 正解のページ番号) のリスト。ページ本文の語をいくつか並べたもの """
+    rng = random.Random(seed)
+    candidates = [(no, text.split()) for no, text in enumerate(pages, start=1) if len(text.split()) > 8]
+    queries = []
+    for _ in range(n_queries):
+        page_no, words = rng.choice(candidates)
+        start = rng.randrange(len(words) - 6)
+        queries.append((" ".join(words[start:start + 6]), page_no))
+    return queries
+
+
+def _retriever(mode, vectorstore, lexical_index):
+    if mode == "vector":
+        return FaissRetriever(vectorstore=vectorstore, k=K)
+    if mode == "mmr":
+        return MMRRetriever(vectorstore=vectorstore, k=K)
+    return HybridRetriever(
+        vectorstore=vectorstore, lexical_index=lexical_index, k=K,
+        lexical_only=(mode == "lexical"),
+    )
+
+
+def bench_document(pdf_path, splitter, embeddings, n_queries, max_workers=None):
+    report = {}
+
+    with PeakRSS() as rss:
+        pages, stats = extract_pages(pdf_path, max_workers=max_workers)
+    report["extract"] = {
+        "pages": stats.pages,
+        "seconds": round(stats.seconds, 4),
+        "pages_per_sec": round(stats.pages_per_sec, 1),
+        "workers": stats.workers,
+        "peak_rss_mb": rss.peak_mb,
+    }
+
+    with PeakRSS() as rss:
+        started = time.perf_counter()
+        chunks = [chunk for page in pages for chunk in splitter.split_with_offsets(page)]
+        seconds = time.perf_counter() - started
+    report["split"] = {
+        "chunks": len(chunks),
+        "seconds": round(seconds, 4),
+        "chunks_per_sec": round(len(chunks) / seconds, 1) if seconds else None,
+        "peak_rss_mb": rss.peak_mb,
+    }
+
+    # 抽出から登録までを通しで計測する (アップロード時と同じ経路)
+    lexical_index = BM25Index()
+    with PeakRSS() as rss:
+        vectorstore, progress = None, None
+        for vectorstore, progress in ingest(
+            iter_pages(pdf_path, max_workers=max_workers),
+            splitter,
+            embeddings,
+            lexical_index=lexical_index,
+        ):
+            pass
+    report["ingest"] = {
+        "chunks": progress.chunks,
+        "seconds": round(progress.seconds, 4),
+        "pages_per_sec": round(progress.pages_per_sec, 1),
+        "chunks_per_sec": round(progress.chunks_per_sec, 1),
+        "index_type": index_kind(vectorstore.index),
+        "peak_rss_mb": rss.peak_mb,
+    }
+
+    queries = _queries(pages, n_queries)
+    report["query"] = {}
+    for mode in RETRIEVAL_MODES:
+        retriever = _retriever(mode, vectorstore, lexical_index)
+        latencies, hits = [], 0
+        with PeakRSS() as rss:
+            for query, page_no in queries:
+                started = time.perf_counter()
+                docs = retriever.invoke(query)
+                latencies.append(time.perf_counter() - started)
+                hits += any(doc.metadata["page"] == page_no for doc in docs)
+        report["query"][mode] = {
+            **_percentiles(latencies),
+            f"hit_rate@{K}": round(hits / len(queries), 3),
+            "peak_rss_mb": rss.peak_mb,
+        }
+
+    # 検索 → 前提知識の組み立て → (偽の) LLM のストリーミング までの1問あたりの時間
+    # FakeListChatModel は1文字ずつストリーミングするので、応答は短くしてこちら側の処理時間を測る
+    llm = FakeListChatModel(responses=["これは回答です。"])
+    chain = ChatPromptTemplate.from_template("{context}\n\n{question}") | llm | StrOutputParser()
+    retriever = _retriever("hybrid", vectorstore, lexical_index)
+    latencies, context_tokens = [], []
+    for query, _ in queries:
+        started = time.perf_counter()
+        context = pack_context(retriever.invoke(query), DEFAULT_CONTEXT_BUDGET)
+        for _ in chain.stream({"context": context.text, "question": query}):
+            pass
+        latencies.append(time.perf_counter() - started)
+        context_tokens.append(context.tokens)
+    report["qa"] = {
+        **_percentiles(latencies),
+        "mean_context_tokens": round(float(np.mean(context_tokens)), 1),
+    }
+    return report
+
+
+def bench_mmr_select(candidate_counts=MMR_CANDIDATES, d=MMR_DIMENSION, repeats=200, seed=0):
+    """ 候補数ごとの mmr_select のレイテンシ (埋め込みや FAISS の検索は含まない) """
+    rng = np.random.default_rng(seed)
+    report = {}
+    for n in candidate_counts:
+        vectors = rng.standard_normal((n, d)).astype(np.float32)
+        query = rng.standard_normal(d).astype(np.float32)
+        # 最初の数回はキャッシュや BLAS の初期化で遅いので捨てる
+        for _ in range(10):
+            mmr_select(query, vectors, K)
+        latencies = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            mmr_select(query, vectors, K)
+            latencies.append(time.perf_counter() - started)
+        report[str(n)] = _percentiles(latencies)
+    return report
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(page_counts, layouts, n_queries=200, embed_latency=0.0, max_workers=None,
+                  chunk_size=500, seed=0):
+    embeddings = HashingEmbeddings()
+    if embed_latency:
+        embeddings = LatencyEmbeddings(embeddings, embed_latency)
+    splitter = TokenSplitter(chunk_size=chunk_size)
+    report = {
+        "revision": _git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "faiss": faiss.__version__,
+            "pymupdf": fitz.VersionBind,
+            "encoding": splitter.encoding.name,
+        },
+        "params": {
+            "queries": n_queries,
+            "k": K,
+            "chunk_size": chunk_size,
+            "embed_latency_ms": embed_latency * 1000,
+            "embeddings": embeddings.model,
+            "seed": seed,
+        },
+        "documents": [],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for layout in layouts:
+            for pages in page_counts:
+                path = os.path.join(tmp, f"{layout}-{pages}.pdf")
+                make_pdf(path, pages, layout, seed)
+                result = bench_document(path, splitter, embeddings, n_queries, max_workers)
+                report["documents"].append({
+                    "layout": layout,
+                    "pages": pages,
+                    "file_bytes": os.path.getsize(path),
+                    **result,
+                })
+    report["mmr_select"] = bench_mmr_select(seed=seed)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # 抽出のワーカープロセスのうち最大のもの
+    report["children_peak_rss_mb"] = round(
+        (children if sys.platform == "darwin" else children * 1024) / 2**20, 1
+    )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=[20, 200])
+    parser.add_argument("--layouts", nargs="+", choices=LAYOUTS, default=list(LAYOUTS))
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=None, help="抽出のワーカー数")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果の JSON の保存先 (省略時は標準出力)")
+    args = parser.parse_args()
+
+    report = run_benchmark(
+        args.pages, args.layouts, args.queries, args.embed_latency_ms / 1000,
+        args.workers, args.chunk_size, args.seed,
+    )
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+プロセス内の BM25 転置インデックス
+
+ベクトルストアと同じチャンク ID で登録し、埋め込みを使わずに語彙の一致で検索する。
+型番や条項番号のような完全一致が大事なクエリはベクトル検索より得意。
+日本語は分かち書きしないので、英数字の単語に加えて CJK 文字の bigram を語として使う。
+"""
+import math
+import re
+from array import array
+from collections import Counter
+
+# BM25 のパラメータ
+K1 = 1.5
+B = 0.75
+
+_WORD = re.compile(r"[a-z0-9]+(?:[\-_./:][a-z0-9]+)*")
+_CJK_RUN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f]+")
+
+
+def tokenize(text):
+    text = text.lower()
+    terms = _WORD.findall(text)
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+class BM25Index:
+    def __init__(self):
+        # 語 → {スロット番号: 出現回数}
+        self.postings = {}
+        self.doc_lengths = array("I")
+        self.slot_ids = []
+        self.id_slots = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.id_slots)
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore):
+        """ 既存のベクトルストアの docstore から作る (BM25 を保存していない古いインデックス用) """
+        index = cls()
+        ids = [
+            vectorstore.index_to_docstore_id[i]
+            for i in range(len(vectorstore.index_to_docstore_id))
+        ]
+        index.add(ids, [vectorstore.docstore.search(_id).page_content for _id in ids])
+        return index
+
+    def add(self, ids, texts):
+        for _id, text in zip(ids, texts):
+            terms = tokenize(text)
+            slot = len(self.slot_ids)
+            self.slot_ids.append(_id)
+            self.id_slots[_id] = slot
+            self.doc_lengths.append(len(terms))
+            self.total_length += len(terms)
+            for term, tf in Counter(terms).items():
+                self.postings.setdefault(term, {})[slot] = tf
+
+    def remove(self, ids):
+        for _id in ids:
+            slot = self.id_slots.pop(_id, None)
+            if slot is None:
+                continue
+            # スロットは詰めずに空ける (転置リストからは検索時に除外する)
+            self.slot_ids[slot] = None
+            self.total_length -= self.doc_lengths[slot]
+            self.doc_lengths[slot] = 0
+        if len(self.id_slots) * 2 < len(self.slot_ids):
+            self._compact()
+
+    def _compact(self):
+        live = [(_id, slot) for slot, _id in enumerate(self.slot_ids) if _id is not None]
+        remap = {old: new for new, (_, old) in enumerate(live)}
+        self.slot_ids = [_id for _id, _ in live]
+        self.id_slots = {_id: new for new, _id in enumerate(self.slot_ids)}
+        self.doc_lengths = array("I", (self.doc_lengths[old] for _, old in live))
+        postings = {}
+        for term, docs in self.postings.items():
+            docs = {remap[slot]: tf for slot, tf in docs.items() if slot in remap}
+            if docs:
+                postings[term] = docs
+        self.postings = postings
+
+    def search(self, query, k=10):
+        """ (チャンクID, スコア) のリストをスコアの高い順に返す """
+        n_docs = len(self.id_slots)
+        if not n_docs:
+            return []
+        avg_length = self.total_length / n_docs or 1.0
+        scores = Counter()
+        for term in set(tokenize(query)):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            for slot, tf in docs.items():
+                if self.slot_ids[slot] is None:
+                    continue
+                norm = K1 * (1 - B + B * self.doc_lengths[slot] / avg_length)
+                scores[slot] += idf * tf * (K1 + 1) / (tf + norm)
+        return [(self.slot_ids[slot], score) for slot, score in scores.most_common(k)]
@@ -0,0 +1,121 @@
+"""
+配列ベースのコンパクトな docstore
+
+InMemoryDocstore はチャンクごとに Document (と metadata の dict) を保持する。
+ここではテキストを UTF-8 で1つの bytearray に連結し、各チャンクは
+(開始位置, 終了位置, metadata 番号) を配列に持つだけにする。
+metadata は (source, page) のように多くのチャンクで共通なので、重複を除いて共有する。
+チャンクごとに違うページ内の文字位置 (start_index / end_index) は共有できないので、
+metadata からは外して別の配列に持つ (持たないチャンクは -1)。
+Document は search() のたびに組み立てる。
+"""
+from array import array
+
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+
+
+# metadata から外して配列に持つキー
+_OFFSET_KEYS = ("start_index", "end_index")
+
+
+class CompactDocstore(Docstore, AddableMixin):
+    def __init__(self):
+        self._data = bytearray()
+        self._starts = array("Q")
+        self._ends = array("Q")
+        self._meta_ids = array("I")
+        self._start_indexes = array("q")
+        self._end_indexes = array("q")
+        self._metas = []
+        self._meta_lookup = {}
+        self._slots = {}
+        self._deleted_bytes = 0
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "_start_indexes" not in state:
+            # 文字位置も metadata に入れていた以前の形式 (search はそのまま metadata を返す)
+            self._start_indexes = array("q", [-1]) * len(self._starts)
+            self._end_indexes = array("q", [-1]) * len(self._starts)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _intern_metadata(self, metadata):
+        key = tuple(sorted((k, v) for k, v in metadata.items() if k not in _OFFSET_KEYS))
+        meta_id = self._meta_lookup.get(key)
+        if meta_id is None:
+            meta_id = len(self._metas)
+            self._metas.append(key)
+            self._meta_lookup[key] = meta_id
+        return meta_id
+
+    def add(self, texts):
+        overlapping = set(texts).intersection(self._slots)
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        for _id, doc in texts.items():
+            encoded = doc.page_content.encode("utf-8")
+            self._slots[_id] = len(self._starts)
+            self._starts.append(len(self._data))
+            self._data += encoded
+            self._ends.append(len(self._data))
+            self._meta_ids.append(self._intern_metadata(doc.metadata))
+            self._start_indexes.append(doc.metadata.get("start_index", -1))
+            self._end_indexes.append(doc.metadata.get("end_index", -1))
+
+    def delete(self, ids):
+        overlapping = set(ids).intersection(self._slots)
+        if not overlapping:
+            raise ValueError(f"Tried to delete ids that does not  exist: {ids}")
+        for _id in overlapping:
+            slot = self._slots.pop(_id)
+            self._deleted_bytes += self._ends[slot] - self._starts[slot]
+        # 削除したテキストが全体の半分を超えたら詰め直す
+        if self._deleted_bytes * 2 > len(self._data):
+            self._compact()
+
+    def update_metadata(self, updates):
+        """ (id, metadata) のリストで metadata を置き換える (テキストはそのまま) """
+        for _id, metadata in updates:
+            slot = self._slots[_id]
+            self._meta_ids[slot] = self._intern_metadata(metadata)
+            self._start_indexes[slot] = metadata.get("start_index", -1)
+            self._end_indexes[slot] = metadata.get("end_index", -1)
+
+    def search(self, search):
+        slot = self._slots.get(search)
+        if slot is None:
+            return f"ID {search} not found."
+        text = self._data[self._starts[slot]:self._ends[slot]].decode("utf-8")
+        metadata = dict(self._metas[self._meta_ids[slot]])
+        if self._start_indexes[slot] >= 0:
+            metadata.update(start_index=self._start_indexes[slot], end_index=self._end_indexes[slot])
+        return Document(page_content=text, metadata=metadata)
+
+    def _compact(self):
+        data, starts, ends, meta_ids = bytearray(), array("Q"), array("Q"), array("I")
+        start_indexes, end_indexes = array("q"), array("q")
+        for _id, slot in self._slots.items():
+            self._slots[_id] = len(starts)
+            starts.append(len(data))
+            data += self._data[self._starts[slot]:self._ends[slot]]
+            ends.append(len(data))
+            meta_ids.append(self._meta_ids[slot])
+            start_indexes.append(self._start_indexes[slot])
+            end_indexes.append(self._end_indexes[slot])
+        self._data, self._starts, self._ends, self._meta_ids = data, starts, ends, meta_ids
+        self._start_indexes, self._end_indexes = start_indexes, end_indexes
+        self._deleted_bytes = 0
+
+    def nbytes(self):
+        """ テキストとオフセット配列が使っているバイト数 (ID の dict は含まない) """
+        return (
+            len(self._data)
+            + self._starts.itemsize * len(self._starts)
+            + self._ends.itemsize * len(self._ends)
+            + self._meta_ids.itemsize * len(self._meta_ids)
+            + self._start_indexes.itemsize * len(self._start_indexes)
+            + self._end_indexes.itemsize * len(self._end_indexes)
+        )
@@ -0,0 +1,7 @@
+import os
+
+# キャッシュや保存したインデックスなど、ローカルに永続化するデータの置き場所
+DATA_DIR = os.environ.get(
+    "CHAT_WITH_PDF_DATA_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".data"),
+)
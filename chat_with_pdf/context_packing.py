@@ -0,0 +1,110 @@
+"""
+PDF QA のプロンプトに入れる前提知識の組み立て
+
+取得したチャンクを tiktoken で数え、重複・ほぼ重複したチャンクを落としてから、
+スコアの高い順 (= リトリーバーが返した順) にモデルごとのトークン予算まで詰める。
+従来の「k=10 件をそのまま {context} に入れる」場合と比べて何トークン減ったかも記録する。
+"""
+from dataclasses import dataclass, field
+
+from splitter import get_encoding
+
+
+# モデルごとの前提知識のトークン予算
+MODEL_CONTEXT_BUDGETS = {
+    "gpt-3.5-turbo": 2_500,
+    "gpt-4o": 4_000,
+    "claude-3-5-sonnet-20240620": 4_000,
+    "gemini-1.5-pro-latest": 4_000,
+}
+DEFAULT_CONTEXT_BUDGET = 3_000
+# トークン 3-gram の Jaccard 係数がこれ以上ならほぼ重複とみなす
+NEAR_DUPLICATE_THRESHOLD = 0.8
+# 同じページで文字範囲がこの割合以上重なっていたら重複とみなす
+OVERLAP_THRESHOLD = 0.5
+
+
+@dataclass
+class PackedContext:
+    text: str
+    docs: list
+    tokens: int
+    # 従来どおり全件を {context} に入れた場合のトークン数
+    baseline_tokens: int
+    duplicates: int = 0
+    over_budget: int = 0
+    dropped: list = field(default_factory=list)
+
+    @property
+    def saved_tokens(self):
+        return self.baseline_tokens - self.tokens
+
+
+def context_budget(model_name):
+    return MODEL_CONTEXT_BUDGETS.get(model_name, DEFAULT_CONTEXT_BUDGET)
+
+
+def _shingles(tokens, n=3):
+    return {tuple(tokens[i:i + n]) for i in range(max(len(tokens) - n + 1, 1))}
+
+
+def _overlaps(a, b):
+    """ 同じページ内で文字範囲が大きく重なっているか (位置のメタデータがある場合だけ) """
+    ma, mb = a.metadata, b.metadata
+    if "start_index" not in ma or "start_index" not in mb:
+        return False
+    if (ma.get("source"), ma.get("page")) != (mb.get("source"), mb.get("page")):
+        return False
+    overlap = min(ma["end_index"], mb["end_index"]) - max(ma["start_index"], mb["start_index"])
+    shorter = min(ma["end_index"] - ma["start_index"], mb["end_index"] - mb["start_index"])
+    return shorter > 0 and overlap / shorter >= OVERLAP_THRESHOLD
+
+
+def _is_duplicate(doc, shingles, kept):
+    for kept_doc, kept_shingles in kept:
+        if doc.page_content == kept_doc.page_content or _overlaps(doc, kept_doc):
+            return True
+        union = len(shingles | kept_shingles)
+        if union and len(shingles & kept_shingles) / union >= NEAR_DUPLICATE_THRESHOLD:
+            return True
+    return False
+
+
+def format_doc(doc):
+    source, page = doc.metadata.get("source"), doc.metadata.get("page")
+    header = f"[{source} p.{page}]\n" if source and page else ""
+    return header + doc.page_content
+
+
+def pack_context(docs, budget, encoding=None):
+    """ docs はスコアの高い順に並んでいること """
+    encoding = encoding or get_encoding()
+    baseline_tokens = len(encoding.encode(str(docs), disallowed_special=()))
+    texts = [format_doc(doc) for doc in docs]
+    token_lists = encoding.encode_batch(texts, disallowed_special=())
+    # 重複の判定はページ番号などの見出しを除いた本文で行う
+    content_tokens = encoding.encode_batch([doc.page_content for doc in docs], disallowed_special=())
+    separator = len(encoding.encode("\n\n"))
+
+    kept, packed, used = [], [], 0
+    packed_context = PackedContext("", [], 0, baseline_tokens)
+    for doc, text, tokens, content in zip(docs, texts, token_lists, content_tokens):
+        shingles = _shingles(content)
+        if _is_duplicate(doc, shingles, kept):
+            packed_context.duplicates += 1
+            packed_context.dropped.append(doc)
+            continue
+        cost = len(tokens) + (separator if packed else 0)
+        if used + cost > budget:
+            # 予算を超えるチャンクは飛ばし、後ろの短いチャンクが入るなら入れる
+            packed_context.over_budget += 1
+            packed_context.dropped.append(doc)
+            continue
+        kept.append((doc, shingles))
+        packed.append(text)
+        used += cost
+
+    packed_context.text = "\n\n".join(packed)
+    packed_context.docs = [doc for doc, _ in kept]
+    packed_context.tokens = used
+    return packed_context
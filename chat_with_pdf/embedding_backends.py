@@ -0,0 +1,108 @@
+"""
+埋め込みのバックエンド
+
+openai: OpenAI の埋め込み API (ディスクキャッシュとレート制限つき)
+local:  ネットワークを使わない CPU だけの埋め込み (特徴ハッシング)
+
+バックエンドは名前で選び、インデックスの manifest にはモデル名を記録する。
+保存済みインデックスを読み込むときはモデル名からバックエンドを引き直す。
+新しいバックエンドは register_backend で追加できる。
+"""
+import hashlib
+import math
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+from bm25 import tokenize
+from embedding_cache import CachedEmbeddings
+from embedding_scheduler import ScheduledEmbeddings
+
+
+OPENAI = "openai"
+LOCAL = "local"
+OPENAI_EMBEDDING_MODEL = "text-embedding-3-small"
+LOCAL_DIMENSIONS = 1024
+
+
+@lru_cache(maxsize=1 << 18)
+def _feature(term, dimensions):
+    """ 語 → (次元, 符号)。Python の hash() はプロセスごとに変わるので使わない """
+    h = int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+    return h % dimensions, 1.0 if h >> 63 else -1.0
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    特徴ハッシングによるローカルの埋め込み
+    BM25 と同じ語 (英数字の単語 + CJK の bigram) と隣り合う語の組を、
+    ハッシュで固定長のベクトルに射影し、1 + log(tf) で重み付けして L2 正規化する。
+    文書頻度 (IDF) は使わない (文書を追加してもベクトルが変わらないようにするため)。
+    意味の近さは OpenAI の埋め込みには及ばないが、API もネットワークも要らない。
+    """
+
+    def __init__(self, dimensions=LOCAL_DIMENSIONS):
+        self.dimensions = dimensions
+        self.model = f"local-hashing-{dimensions}"
+
+    def _features(self, text):
+        terms = tokenize(text)
+        terms += [f"{a} {b}" for a, b in zip(terms, terms[1:])]
+        return Counter(terms)
+
+    def embed_documents(self, texts):
+        rows, cols, values = [], [], []
+        for row, text in enumerate(texts):
+            for term, tf in self._features(text).items():
+                col, sign = _feature(term, self.dimensions)
+                rows.append(row)
+                cols.append(col)
+                values.append(sign * (1.0 + math.log(tf)))
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        # 同じ次元に落ちた語は足し合わせる
+        np.add.at(matrix, (rows, cols), values)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1, norms)
+        return matrix.tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def _openai_embeddings():
+    # 一度埋め込んだチャンクはディスクにキャッシュし、再アップロード時は API を呼ばない
+    # キャッシュに無いチャンクはレート制限を守りながら並列にリクエストする
+    # (再試行はスケジューラ側で行うので OpenAI クライアントの再試行は切る)
+    return CachedEmbeddings(
+        ScheduledEmbeddings(OpenAIEmbeddings(model=OPENAI_EMBEDDING_MODEL, max_retries=0))
+    )
+
+
+# バックエンド名 → (manifest に記録するモデル名, Embeddings を作る関数)
+BACKENDS = {
+    OPENAI: (OPENAI_EMBEDDING_MODEL, _openai_embeddings),
+    LOCAL: (f"local-hashing-{LOCAL_DIMENSIONS}", HashingEmbeddings),
+}
+
+
+def register_backend(name, model, factory):
+    BACKENDS[name] = (model, factory)
+
+
+def create_embeddings(backend):
+    return BACKENDS[backend][1]()
+
+
+def embedding_model(backend):
+    return BACKENDS[backend][0]
+
+
+def backend_for_model(model):
+    """ manifest のモデル名からバックエンドを引く (古いインデックスは OpenAI) """
+    for name, (backend_model, _) in BACKENDS.items():
+        if backend_model == model:
+            return name
+    return OPENAI
@@ -0,0 +1,120 @@
+"""
+埋め込みベクトルのディスクキャッシュ
+
+(チャンクのテキスト, モデル名, 次元数) のハッシュをキーに SQLite に保存する。
+ヒットしたチャンクは API を呼ばずにキャッシュから返す。
+最大件数を超えたら最後に使われた時刻が古いものから削除する (LRU)。
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+import tiktoken
+from langchain_core.embeddings import Embeddings
+
+from config import DATA_DIR
+
+
+DEFAULT_PATH = os.path.join(DATA_DIR, "embeddings.sqlite3")
+# text-embedding-3-small (1536次元, float32) で 1件 約6KB なので 20万件で約1.2GB
+DEFAULT_MAX_ENTRIES = 200_000
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings, path=DEFAULT_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, "model", type(embeddings).__name__)
+        self.dimensions = getattr(embeddings, "dimensions", None)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 複数スレッド・複数プロセスから使うので WAL モードで開き、接続はロックで守る
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._conn.commit()
+        self._encoding = tiktoken.get_encoding("cl100k_base")
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _key(self, text):
+        raw = f"{self.model}\0{self.dimensions}\0{text}".encode("utf-8")
+        return hashlib.sha256(raw).hexdigest()
+
+    def _lookup(self, keys):
+        found = {}
+        with self._lock:
+            # SQLite の変数上限に当たらないよう分割して問い合わせる
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})",
+                    part,
+                ).fetchall()
+                found.update((key, array("f", blob).tolist()) for key, blob in rows)
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+        return found
+
+    def _store(self, items):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", vector).tobytes(), now) for key, vector in items],
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                " SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def embed_documents(self, texts):
+        keys = [self._key(text) for text in texts]
+        cached = self._lookup(keys)
+        # 同じバッチ内の重複チャンクは1回だけ API に送る
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            fresh = list(zip(missing.keys(), vectors))
+            self._store(fresh)
+            cached.update(fresh)
+
+        hit_texts = [text for key, text in zip(keys, texts) if key not in missing]
+        with self._lock:
+            self.hits += len(hit_texts)
+            self.misses += len(texts) - len(hit_texts)
+            self.saved_tokens += sum(len(t) for t in self._encoding.encode_batch(hit_texts))
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
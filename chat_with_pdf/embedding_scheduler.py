@@ -0,0 +1,129 @@
+"""
+レート制限を意識した埋め込みリクエストのスケジューラ
+
+- チャンクをトークン数でバッチに詰める
+- 複数のバッチをスレッドプールで同時にリクエストする
+- RPM (requests/min) と TPM (tokens/min) をトークンバケットで守る
+- 429 などの一時的なエラーはジッター付き指数バックオフで再試行する
+"""
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import tiktoken
+from langchain_core.embeddings import Embeddings
+
+
+# text-embedding-3-small の Tier 1 の上限。アカウントに合わせて環境変数で上書きする
+DEFAULT_RPM = int(os.environ.get("OPENAI_EMBEDDING_RPM", 3000))
+DEFAULT_TPM = int(os.environ.get("OPENAI_EMBEDDING_TPM", 1_000_000))
+# 1リクエストに詰めるトークン数の上限
+MAX_BATCH_TOKENS = 16_000
+MAX_CONCURRENCY = 8
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+class TokenBucket:
+    """ 1分あたり rate_per_minute 個のトークンが補充されるバケット """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        # 容量を超える要求は永遠に満たせないので容量で頭打ちにする
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def _retry_after(error):
+    """ レスポンスに Retry-After ヘッダがあればその秒数を返す """
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class ScheduledEmbeddings(Embeddings):
+    def __init__(self, embeddings, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM,
+                 max_batch_tokens=MAX_BATCH_TOKENS, max_concurrency=MAX_CONCURRENCY):
+        self.embeddings = embeddings
+        # キャッシュのキーなどに使うので、ラップしたモデルの情報をそのまま見せる
+        self.model = getattr(embeddings, "model", type(embeddings).__name__)
+        self.dimensions = getattr(embeddings, "dimensions", None)
+        self.max_batch_tokens = max_batch_tokens
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.retries = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._encoding = tiktoken.get_encoding("cl100k_base")
+
+    def _pack(self, texts):
+        """ (開始位置, テキストのリスト, トークン数) のバッチに分ける """
+        batches, start, size = [], 0, 0
+        token_counts = [len(t) for t in self._encoding.encode_batch(texts)]
+        for i, n_tokens in enumerate(token_counts):
+            if i > start and size + n_tokens > self.max_batch_tokens:
+                batches.append((start, texts[start:i], size))
+                start, size = i, 0
+            size += n_tokens
+        if start < len(texts):
+            batches.append((start, texts[start:], size))
+        return batches
+
+    def _embed_batch(self, texts, n_tokens):
+        for attempt in range(MAX_RETRIES + 1):
+            self.requests.acquire(1)
+            self.tokens.acquire(n_tokens)
+            try:
+                return self.embeddings.embed_documents(texts)
+            except RETRYABLE_ERRORS as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                self.retries += 1
+                delay = _retry_after(e)
+                if delay is None:
+                    # full jitter: 同時に失敗したリクエストが一斉に再送しないようにばらす
+                    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+                time.sleep(delay)
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        vectors = [None] * len(texts)
+        futures = [
+            (start, self._executor.submit(self._embed_batch, batch, n_tokens))
+            for start, batch, n_tokens in self._pack(texts)
+        ]
+        for start, future in futures:
+            result = future.result()
+            vectors[start:start + len(result)] = result
+        return vectors
+
+    def embed_query(self, text):
+        self.requests.acquire(1)
+        return self.embeddings.embed_query(text)
@@ -0,0 +1,161 @@
+"""
+PDF からのテキスト抽出エンジン
+
+ページ範囲をいくつかのシャードに分割し、プロセスプールで並列に PyMuPDF の
+`page.get_text()` を実行する。結果はページ順に返す。
+
+source には PDF のバイト列かファイルのパスを渡せる。大きなアップロードは
+spool_to_file で一時ファイルに書き出してパスを渡すと、PyMuPDF はディスクから
+必要なページだけを読み、ワーカーにも PDF 全体をコピーせずに済む。
+シャードは最大 PAGE_WINDOW ページで、処理中のシャード数にも上限があるので、
+メモリに載るテキストはファイルの大きさではなくウィンドウの大きさで決まる。
+"""
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import fitz  # PyMuPDF
+
+from config import DATA_DIR
+
+
+# これより少ないページ数ならプロセス起動コストの方が高くつくので単一プロセスで処理する
+PARALLEL_MIN_PAGES = 32
+# 1ワーカーあたりのシャード数 (ページごとの重さのばらつきを均すため少し細かく切る)
+SHARDS_PER_WORKER = 4
+# 1シャードの最大ページ数 (巨大な PDF でもシャードごとのテキストがこれで抑えられる)
+PAGE_WINDOW = 64
+# ワーカーの起動方法。Streamlit のサーバーはスレッドを多く動かしていて、抽出はジョブのスレッドから
+# 呼ばれるので、fork だと他のスレッドが持っていたロックごと複製されてデッドロックしうる
+# forkserver はスレッドを持たないサーバープロセスから fork するのでその心配がない
+MP_START_METHOD = os.environ.get("CHAT_WITH_PDF_MP_START_METHOD", "forkserver")
+# アップロードを書き出す場所 (/tmp が tmpfs だとメモリを使うので、既定はデータディレクトリ)
+UPLOAD_DIR = os.environ.get("CHAT_WITH_PDF_UPLOAD_DIR", os.path.join(DATA_DIR, "uploads"))
+SPOOL_CHUNK_SIZE = 1 << 20
+
+# ワーカープロセスごとに一度だけ開いた PDF を保持する
+_worker_doc = None
+
+
+@dataclass
+class ExtractionStats:
+    pages: int
+    seconds: float
+    workers: int
+
+    @property
+    def pages_per_sec(self):
+        return self.pages / self.seconds if self.seconds > 0 else float("inf")
+
+
+def _open(source):
+    if isinstance(source, (str, os.PathLike)):
+        return fitz.open(source, filetype="pdf")
+    return fitz.open(stream=source, filetype="pdf")
+
+
+def spool_to_file(fileobj, directory=UPLOAD_DIR):
+    """
+    アップロードされたファイルを一時ファイルに少しずつ書き出し、(パス, sha256) を返す
+    一時ファイルは呼び出し側で削除する
+    """
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".pdf", delete=False) as f:
+        try:
+            while block := fileobj.read(SPOOL_CHUNK_SIZE):
+                digest.update(block)
+                f.write(block)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    return f.name, digest.hexdigest()
+
+
+def _init_worker(source):
+    global _worker_doc
+    # パスを渡した場合は各ワーカーがファイルを開くだけで、PDF のバイト列はコピーされない
+    _worker_doc = _open(source)
+
+
+def _extract_shard(page_range):
+    start, stop = page_range
+    texts = [_worker_doc[i].get_text() for i in range(start, stop)]
+    # 読み込んだページのオブジェクトやフォントなどのキャッシュを手放す
+    fitz.TOOLS.store_shrink(100)
+    return texts
+
+
+def _split_pages(page_count, n_shards):
+    """ [0, page_count) をほぼ均等な連続範囲に分割する """
+    n_shards = max(1, min(n_shards, page_count))
+    size, rest = divmod(page_count, n_shards)
+    ranges, start = [], 0
+    for i in range(n_shards):
+        stop = start + size + (1 if i < rest else 0)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+
+def _plan(page_count, max_workers):
+    """ シャードの範囲と使用するワーカー数を決める """
+    max_workers = max_workers or os.cpu_count() or 1
+    if page_count < PARALLEL_MIN_PAGES or max_workers == 1:
+        return [(0, page_count)], 1
+    n_shards = max(max_workers * SHARDS_PER_WORKER, -(-page_count // PAGE_WINDOW))
+    ranges = _split_pages(page_count, n_shards)
+    return ranges, min(max_workers, len(ranges))
+
+
+def count_pages(source):
+    with _open(source) as doc:
+        return doc.page_count
+
+
+def iter_pages(source, max_workers=None):
+    """
+    ページごとのテキストをページ順に yield するジェネレータ
+    同時に処理中のシャードはワーカー数の2倍までに抑え、結果を溜め込まない
+    """
+    ranges, workers = _plan(count_pages(source), max_workers)
+    if workers == 1:
+        with _open(source) as doc:
+            for i, page in enumerate(doc, start=1):
+                yield page.get_text()
+                if i % PAGE_WINDOW == 0:
+                    fitz.TOOLS.store_shrink(100)
+        return
+
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context(MP_START_METHOD),
+        initializer=_init_worker,
+        initargs=(source,),
+    )
+    try:
+        pending = deque()
+        for page_range in ranges:
+            pending.append(executor.submit(_extract_shard, page_range))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        # 途中で打ち切られた場合は未着手のシャードを捨てる
+        executor.shutdown(cancel_futures=True)
+
+
+def extract_pages(source, max_workers=None):
+    """ ページごとのテキストのリストと計測結果を返す """
+    started = time.perf_counter()
+    _, workers = _plan(count_pages(source), max_workers)
+    pages = list(iter_pages(source, max_workers=max_workers))
+    stats = ExtractionStats(len(pages), time.perf_counter() - started, workers)
+    return pages, stats
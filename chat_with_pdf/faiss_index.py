@@ -0,0 +1,230 @@
+"""
+チャンク数に応じた FAISS インデックスの種類の切り替え
+
+LangChain の FAISS はいつも IndexFlatL2 (全件の線形探索) を作る。
+チャンク数がしきい値を超えたら、保存済みのベクトルを取り出して
+HNSW や IVF-PQ のインデックスに作り直す (埋め込み直しはしない)。
+ベクトルの並び順は変えないので index_to_docstore_id はそのまま使える。
+"""
+import math
+import os
+
+import faiss
+import numpy as np
+from faiss.contrib.inspect_tools import get_invlist
+
+
+# このチャンク数を超えたら HNSW に切り替える
+HNSW_THRESHOLD = int(os.environ.get("CHAT_WITH_PDF_HNSW_THRESHOLD", 50_000))
+# このチャンク数を超えたら IVF-PQ に切り替える
+IVFPQ_THRESHOLD = int(os.environ.get("CHAT_WITH_PDF_IVFPQ_THRESHOLD", 500_000))
+
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 40
+# 学習に使うサンプル数は nlist のこの倍数まで (faiss の推奨は 30〜256 倍)
+IVF_TRAIN_POINTS_PER_LIST = 64
+# IVF-PQ の学習に最低限必要なサンプル数: nlist の倍数 (faiss はこれより少ないと警告する) と
+# 8ビットの PQ のコードブックの大きさ (256 未満では学習がエラーになる)
+IVF_MIN_POINTS_PER_LIST = 39
+PQ_MIN_TRAIN_POINTS = 256
+# ベクトルを取り出して新しいインデックスに移すときのバッチサイズ
+COPY_BATCH_SIZE = 65_536
+
+FLAT, HNSW, IVFPQ = "flat", "hnsw", "ivfpq"
+
+# ベクトルの保存形式 (1536次元で float32: 6144, float16: 3072, int8: 1536 バイト/チャンク)
+FLOAT32, FLOAT16, INT8 = "float32", "float16", "int8"
+STORAGE_TYPES = (FLOAT32, FLOAT16, INT8)
+_SQ_TYPES = {
+    FLOAT16: faiss.ScalarQuantizer.QT_fp16,
+    INT8: faiss.ScalarQuantizer.QT_8bit,
+}
+
+
+def index_kind(index):
+    if isinstance(index, faiss.IndexHNSW):
+        return HNSW
+    if isinstance(index, faiss.IndexIVF):
+        return IVFPQ
+    return FLAT
+
+
+def _ivf_nlist(ntotal):
+    return int(min(65_536, max(16, 4 * math.sqrt(ntotal))))
+
+
+def target_kind(ntotal, hnsw_threshold=HNSW_THRESHOLD, ivfpq_threshold=IVFPQ_THRESHOLD):
+    # しきい値を小さくしても、学習できるだけのベクトルが無ければ IVF-PQ にはしない
+    min_ivfpq = max(PQ_MIN_TRAIN_POINTS, IVF_MIN_POINTS_PER_LIST * _ivf_nlist(ntotal))
+    if ntotal > ivfpq_threshold and ntotal >= min_ivfpq:
+        return IVFPQ
+    if ntotal > hnsw_threshold:
+        return HNSW
+    return FLAT
+
+
+def storage_type(index):
+    """ フラット / HNSW インデックスのベクトルの保存形式 """
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        qtype = index.sq.qtype
+        return next(name for name, t in _SQ_TYPES.items() if t == qtype)
+    return FLOAT32
+
+
+def new_flat_index(d, storage=FLOAT32):
+    """
+    新しいフラットインデックスを作る
+    int8 は次元ごとの値の範囲の学習が必要 (最初に追加するバッチで学習する)
+    """
+    if storage == FLOAT32:
+        return faiss.IndexFlatL2(d)
+    return faiss.IndexScalarQuantizer(d, _SQ_TYPES[storage], faiss.METRIC_L2)
+
+
+def _pq_subquantizers(d):
+    """ d を割り切れる PQ のサブベクトル数のうち大きいもの (1ベクトルあたり m バイト) """
+    return next(m for m in (64, 48, 32, 16, 8, 4, 2, 1) if d % m == 0)
+
+
+def _iter_vectors(index, ids=None):
+    """ インデックスに保存されているベクトルをバッチごとに取り出す """
+    if ids is None:
+        for start in range(0, index.ntotal, COPY_BATCH_SIZE):
+            yield index.reconstruct_n(start, min(COPY_BATCH_SIZE, index.ntotal - start))
+        return
+    for start in range(0, len(ids), COPY_BATCH_SIZE):
+        yield np.vstack([index.reconstruct(int(i)) for i in ids[start:start + COPY_BATCH_SIZE]])
+
+
+def _train_sample(index, n_train):
+    sample = np.sort(np.random.default_rng(0).choice(index.ntotal, n_train, replace=False))
+    return np.vstack(list(_iter_vectors(index, sample)))
+
+
+def _new_index(kind, index, storage=FLOAT32):
+    d, ntotal = index.d, index.ntotal
+    if kind == HNSW:
+        if storage == FLOAT32:
+            new = faiss.IndexHNSWFlat(d, HNSW_M)
+        else:
+            new = faiss.IndexHNSWSQ(d, _SQ_TYPES[storage], HNSW_M)
+            new.train(_train_sample(index, min(ntotal, 65_536)))
+        new.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        return new
+    if kind == IVFPQ:
+        nlist = _ivf_nlist(ntotal)
+        new = faiss.IndexIVFPQ(faiss.IndexFlatL2(d), d, nlist, _pq_subquantizers(d), 8)
+        # 全件ではなくランダムなサンプルで学習する
+        new.train(_train_sample(index, min(ntotal, nlist * IVF_TRAIN_POINTS_PER_LIST)))
+        return new
+    new = new_flat_index(d, storage)
+    if not new.is_trained:
+        new.train(_train_sample(index, min(ntotal, 65_536)))
+    return new
+
+
+def rebuild_index(index, kind, keep=None):
+    """
+    index のベクトルを kind のインデックスに移し替える
+    float16 / int8 で保存されていた場合、取り出したベクトルは量子化後の近似値になる
+    keep を渡した場合は、その位置のベクトルだけを (順番を保って) 移す
+    """
+    storage = storage_type(index)
+    source = index
+    if keep is not None:
+        # 学習用のサンプルも残すベクトルから取るため、先にフラットなインデックスに集める
+        source = faiss.IndexFlatL2(index.d)
+        for vectors in _iter_vectors(index, keep):
+            source.add(vectors)
+    # 元の保存形式 (float16 / int8) を引き継ぐ
+    new = _new_index(kind, source, storage)
+    for vectors in _iter_vectors(source):
+        new.add(vectors)
+    return new
+
+
+def maybe_upgrade_index(vectorstore, hnsw_threshold=HNSW_THRESHOLD,
+                        ivfpq_threshold=IVFPQ_THRESHOLD):
+    """ チャンク数に見合ったインデックスに切り替える。切り替えたら True """
+    current = index_kind(vectorstore.index)
+    target = target_kind(vectorstore.index.ntotal, hnsw_threshold, ivfpq_threshold)
+    order = (FLAT, HNSW, IVFPQ)
+    # 小さくなった場合に作り直すことはしない (IVF-PQ からは元のベクトルを復元できないため)
+    if order.index(target) <= order.index(current):
+        return False
+    vectorstore.index = rebuild_index(vectorstore.index, target)
+    return True
+
+
+def _renumber_ivf(index):
+    """
+    remove_ids した IVF インデックスの ID (元の位置) を 0 から詰め直す
+    LangChain の FAISS.delete は index_to_docstore_id を残った位置の順に詰め直すが、
+    IVF の remove_ids は元の ID を残すので、そのままでは番号がずれて KeyError になる
+    """
+    invlists = index.invlists
+    lists = [
+        (list_no, *get_invlist(invlists, list_no))
+        for list_no in range(index.nlist) if invlists.list_size(list_no)
+    ]
+    if not lists:
+        return
+    remaining = np.sort(np.concatenate([ids for _, ids, _ in lists]))
+    for list_no, ids, codes in lists:
+        # 残った ID の中での順位が、詰め直した後の位置になる
+        new_ids = np.searchsorted(remaining, ids).astype(np.int64)
+        invlists.update_entries(list_no, 0, len(ids), faiss.swig_ptr(new_ids), faiss.swig_ptr(codes))
+
+
+def delete_chunks(vectorstore, ids):
+    """
+    チャンクを削除する
+    HNSW は remove_ids に対応していないので、残すベクトルだけで作り直す
+    IVF は remove_ids の後で ID を index_to_docstore_id に合わせて詰め直す
+    """
+    kind = index_kind(vectorstore.index)
+    if kind == IVFPQ:
+        deleted = vectorstore.delete(ids)
+        _renumber_ivf(vectorstore.index)
+        return deleted
+    if kind != HNSW:
+        return vectorstore.delete(ids)
+    removed = set(ids)
+    keep = [
+        i for i in range(vectorstore.index.ntotal)
+        if vectorstore.index_to_docstore_id[i] not in removed
+    ]
+    vectorstore.index = rebuild_index(vectorstore.index, HNSW, keep=keep)
+    vectorstore.docstore.delete(list(removed))
+    vectorstore.index_to_docstore_id = {
+        new: vectorstore.index_to_docstore_id[old] for new, old in enumerate(keep)
+    }
+    return True
+
+
+def search_params(index, nprobe=None, ef_search=None):
+    """ クエリごとの探索パラメータ (共有インデックスの設定は書き換えない) """
+    kind = index_kind(index)
+    if kind == IVFPQ and nprobe:
+        params = faiss.SearchParametersIVF()
+        params.nprobe = nprobe
+        return params
+    if kind == HNSW and ef_search:
+        params = faiss.SearchParametersHNSW()
+        params.efSearch = ef_search
+        return params
+    return None
+
+
+def bytes_per_vector(index):
+    """ インデックスがベクトル1本あたりに使うバイト数 (グラフや転置リストの管理領域は除く) """
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    if isinstance(index, faiss.IndexIVFPQ):
+        # PQ コード + 転置リストに持つ ID (int64)
+        return index.code_size + 8
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return index.code_size
+    return index.d * 4
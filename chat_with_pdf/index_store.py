@@ -0,0 +1,191 @@
+"""
+FAISS インデックスのディスク永続化
+
+インデックスは名前ごとのディレクトリにバージョン付きで保存し、
+manifest.json が現在のバージョンを指す。manifest の書き換えはアトミックなので、
+読み込み中の他プロセスが中途半端な状態を見ることはない。
+
+読み込みは faiss の IO_FLAG_MMAP を使うので、対応するインデックス (IVF 系) では
+ベクトルはページキャッシュ上の1つの物理コピーを複数プロセスで共有する。
+"""
+import copy
+import json
+import os
+import pickle
+import re
+import shutil
+import time
+
+import faiss
+from faiss.contrib.inspect_tools import get_invlist
+from langchain_community.vectorstores import FAISS
+
+from config import DATA_DIR
+from registry import DocumentRegistry, fingerprint
+
+
+INDEX_DIR = os.path.join(DATA_DIR, "indexes")
+MANIFEST = "manifest.json"
+INDEX_FILE = "index.faiss"
+DOCSTORE_FILE = "docstore.pkl"
+REGISTRY_FILE = "registry.json"
+LEXICAL_FILE = "bm25.pkl"
+# 古いバージョンを消すまでの猶予 (読み込み途中のプロセスのため)
+KEEP_VERSIONS = 2
+
+
+def index_name(file_name, file_hash):
+    """ アップロードされたファイル名とハッシュからインデックス名を作る """
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    stem = re.sub(r"[^\w\-]+", "_", stem).strip("_") or "index"
+    return f"{stem[:40]}-{file_hash[:8]}"
+
+
+def documents_index_name(documents, suffix=None):
+    """
+    ドキュメントの集合 ({ファイル名: sha256}) からインデックス名を作る
+    集合が変われば名前も変わるので、追記や削除をしても他のセッションが使っている
+    保存済みインデックスを上書きしない
+    """
+    first = next(iter(documents), "")
+    name = index_name(first, fingerprint(documents.values()))
+    return f"{name}-{suffix}" if suffix else name
+
+
+def _index_dir(name):
+    # 名前は検索サービスのリクエストからも来るので、INDEX_DIR の外を指すものは受け付けない
+    # (読み込み・保存はすべてここを通る)
+    if (not isinstance(name, str) or name in ("", ".", "..") or os.path.basename(name) != name
+            or (os.altsep and os.altsep in name)):
+        raise ValueError(f"invalid index name: {name!r}")
+    return os.path.join(INDEX_DIR, name)
+
+
+def read_manifest(name):
+    try:
+        with open(os.path.join(_index_dir(name), MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def list_indexes():
+    """ 保存済みインデックスの manifest を新しい順に返す """
+    if not os.path.isdir(INDEX_DIR):
+        return []
+    manifests = [read_manifest(name) for name in os.listdir(INDEX_DIR)]
+    manifests = [m for m in manifests if m]
+    return sorted(manifests, key=lambda m: m["updated"], reverse=True)
+
+
+def save_index(vectorstore, name, embedding_model, registry, lexical_index=None):
+    """ ベクトルストアを新しいバージョンとして保存し、manifest を返す """
+    base = _index_dir(name)
+    version = str(time.time_ns())
+    version_dir = os.path.join(base, version)
+    os.makedirs(version_dir)
+    faiss.write_index(vectorstore.index, os.path.join(version_dir, INDEX_FILE))
+    with open(os.path.join(version_dir, DOCSTORE_FILE), "wb") as f:
+        pickle.dump((vectorstore.docstore, vectorstore.index_to_docstore_id), f)
+    with open(os.path.join(version_dir, REGISTRY_FILE), "w", encoding="utf-8") as f:
+        registry.dump(f)
+    if lexical_index is not None:
+        with open(os.path.join(version_dir, LEXICAL_FILE), "wb") as f:
+            pickle.dump(lexical_index, f)
+
+    manifest = {
+        "name": name,
+        "version": version,
+        "updated": time.time(),
+        "embedding_model": embedding_model,
+        "ntotal": vectorstore.index.ntotal,
+        "dimension": vectorstore.index.d,
+        "index_type": type(vectorstore.index).__name__,
+        "documents": registry.summary(),
+    }
+    tmp_path = os.path.join(base, MANIFEST + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, os.path.join(base, MANIFEST))
+
+    # 古いバージョンを掃除する
+    # (mmap 済みのファイルは削除されても読み込み済みのプロセスからは引き続き見える)
+    versions = sorted(d for d in os.listdir(base) if d.isdigit())
+    for old in versions[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(base, old), ignore_errors=True)
+    return manifest
+
+
+def load_index(name, embeddings, mmap=True):
+    """ 保存済みインデックスを読み込む。存在しなければ None """
+    manifest = read_manifest(name)
+    if manifest is None:
+        return None
+    version_dir = os.path.join(_index_dir(name), manifest["version"])
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+    index = faiss.read_index(os.path.join(version_dir, INDEX_FILE), flags)
+    with open(os.path.join(version_dir, DOCSTORE_FILE), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+
+def load_registry(name):
+    """ 保存済みインデックスのドキュメント台帳を読み込む (セッションごとに編集するので毎回新しく作る) """
+    manifest = read_manifest(name)
+    if manifest is None:
+        return DocumentRegistry()
+    path = os.path.join(_index_dir(name), manifest["version"], REGISTRY_FILE)
+    with open(path, encoding="utf-8") as f:
+        return DocumentRegistry.load(f)
+
+
+def load_lexical_index(name):
+    """ 保存済みの BM25 インデックスを読み込む。保存されていなければ None """
+    manifest = read_manifest(name)
+    if manifest is None:
+        return None
+    path = os.path.join(_index_dir(name), manifest["version"], LEXICAL_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def _copy_index(index):
+    """
+    インデックスのメモリ上のコピーを作る
+    mmap で読み込んだ IVF の転置リスト (OnDiskInvertedLists) は clone_index も
+    serialize_index からの復元もできないので、転置リスト以外を複製してから
+    リストの中身を ArrayInvertedLists に移す
+    """
+    if not isinstance(index, faiss.IndexIVF) or isinstance(
+        faiss.downcast_InvertedLists(index.invlists), faiss.ArrayInvertedLists
+    ):
+        return faiss.clone_index(index)
+    reader = faiss.VectorIOReader()
+    faiss.copy_array_to_vector(faiss.serialize_index(index), reader.data)
+    copied = faiss.read_index(reader, faiss.IO_FLAG_SKIP_IVF_DATA)
+    invlists = faiss.ArrayInvertedLists(index.nlist, index.code_size)
+    for list_no in range(index.nlist):
+        ids, codes = get_invlist(index.invlists, list_no)
+        if len(ids):
+            invlists.add_entries(list_no, len(ids), faiss.swig_ptr(ids), faiss.swig_ptr(codes))
+    # 転置リストの解放はインデックスに任せる
+    copied.replace_invlists(invlists, True)
+    invlists.this.disown()
+    copied.ntotal = index.ntotal
+    return copied
+
+
+def clone_vectorstore(vectorstore):
+    """
+    共有中 (読み込み専用) のベクトルストアに追記する前に、セッション専用のコピーを作る
+    """
+    return FAISS(
+        vectorstore.embedding_function,
+        _copy_index(vectorstore.index),
+        copy.deepcopy(vectorstore.docstore),
+        dict(vectorstore.index_to_docstore_id),
+        normalize_L2=vectorstore._normalize_L2,
+        distance_strategy=vectorstore.distance_strategy,
+    )
@@ -0,0 +1,248 @@
+"""
+抽出 → 分割 → 埋め込み → インデックス登録 のストリーミングパイプライン
+
+各ステージはスレッドで動き、ステージ間は上限付きのキューでつなぐ。
+下流が詰まれば上流は待たされる (バックプレッシャー) ので、
+ドキュメントの大きさに関わらず同時にメモリに載るのは数バッチ分だけになる。
+"""
+import hashlib
+import queue
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+from compact_docstore import CompactDocstore
+from faiss_index import FLOAT32, new_flat_index
+
+
+# 埋め込みステージに1度に渡すチャンク数
+# (スケジューラがトークン数で複数リクエストに分けて並列に送れるよう大きめにとる)
+EMBED_BATCH_SIZE = 256
+# ステージ間のキューに溜めておけるバッチ数
+QUEUE_SIZE = 4
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+@dataclass
+class IngestProgress:
+    # インデックスに登録済みのページ数・チャンク数
+    pages: int = 0
+    chunks: int = 0
+    # 実際に埋め込みを計算したチャンク数 (引き継いだチャンクは含まない)
+    embedded: int = 0
+    seconds: float = 0.0
+    records: list = field(default_factory=list)
+    # ステージごとの進み具合 (各ステージのスレッドが書き込む。別スレッドから読んでよい)
+    pages_read: int = 0
+    chunks_split: int = 0
+    chunks_embedded: int = 0
+    # 引き継いだチャンクの新しい版での (id, metadata)。ページや位置がずれていることがあるので、
+    # 登録が成功したら呼び出し側で update_metadata を使って反映する
+    reused: list = field(default_factory=list)
+
+    @property
+    def pages_per_sec(self):
+        return self.pages / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def chunks_per_sec(self):
+        return self.chunks / self.seconds if self.seconds > 0 else 0.0
+
+
+def _put(q, item, stop):
+    """ 下流が止まった場合に永遠にブロックしないよう、stop を見ながら put する """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _drain(q, stop):
+    while not stop.is_set():
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _DONE:
+            return
+        if isinstance(item, _Failure):
+            raise item.exc
+        yield item
+
+
+def _start_stage(produce, out_q, stop):
+    def run():
+        try:
+            for item in produce():
+                if not _put(out_q, item, stop):
+                    return
+        except BaseException as e:
+            _put(out_q, _Failure(e), stop)
+        _put(out_q, _DONE, stop)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def _split(text_splitter, text):
+    """ (チャンク, 開始文字位置, 終了文字位置) を返す。位置が分からないスプリッターなら None """
+    if hasattr(text_splitter, "split_with_offsets"):
+        return text_splitter.split_with_offsets(text)
+    return [(chunk, None, None) for chunk in text_splitter.split_text(text)]
+
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class _Batch:
+    page_no: int
+    texts: list = field(default_factory=list)
+    metadatas: list = field(default_factory=list)
+    ids: list = field(default_factory=list)
+    # インデックスに登録されたチャンクの (id, hash, page)。引き継いだチャンクも含む
+    records: list = field(default_factory=list)
+    reused: list = field(default_factory=list)
+    vectors: list = None
+
+
+def new_vectorstore(embeddings, first_vectors, storage=FLOAT32):
+    """
+    空のベクトルストアを作る
+    ベクトルは storage (float32 / float16 / int8) で、テキストは CompactDocstore に保存する
+    int8 の値の範囲は最初のバッチで学習する
+    """
+    index = new_flat_index(len(first_vectors[0]), storage)
+    if not index.is_trained:
+        index.train(np.asarray(first_vectors, dtype=np.float32))
+    return FAISS(embeddings, index, CompactDocstore(), {})
+
+
+def update_metadata(vectorstore, updates):
+    """
+    登録済みのチャンクの metadata を書き換える。updates は (id, metadata) のリスト
+    書き換える前の metadata を同じ形で返す (これを渡し直せば元に戻る)
+    """
+    docstore = vectorstore.docstore
+    previous = [(chunk_id, docstore.search(chunk_id).metadata) for chunk_id, _ in updates]
+    if isinstance(docstore, CompactDocstore):
+        docstore.update_metadata(updates)
+        return previous
+    for chunk_id, metadata in updates:
+        # InMemoryDocstore の search は保持している Document そのものを返す
+        docstore.search(chunk_id).metadata = metadata
+    return previous
+
+
+def ingest(pages, text_splitter, embeddings, vectorstore=None, source=None, reuse=None,
+           storage=FLOAT32, lexical_index=None, index_lock=None, progress=None,
+           batch_size=EMBED_BATCH_SIZE, queue_size=QUEUE_SIZE):
+    """
+    pages (ページごとのテキストの iterable) をベクトルストアに登録する
+
+    reuse には {チャンクのハッシュ: [既存のチャンクID, ...]} を渡す。
+    同じ内容のチャンクがすでにインデックスにあれば、埋め込み直さずに ID を引き継ぐ。
+    storage は新しくベクトルストアを作る場合のベクトルの保存形式。
+    lexical_index (BM25Index) を渡すと、同じチャンクを語彙検索用にも登録する。
+    index_lock を渡すと、ベクトルストアと lexical_index への追加をそのロックの中で行う
+    (登録中に別スレッドから検索する場合は、検索側も同じロックを取る)。
+    progress (IngestProgress) を渡すと、途中経過をそこに書き込む。
+
+    バッチがインデックスに入るたびに (vectorstore, IngestProgress) を yield する。
+    最初のバッチが入った時点でベクトルストアは検索可能になる。
+    登録したチャンクは progress.records に (id, hash, page) として記録される。
+    引き継いだチャンクの metadata は書き換えずに progress.reused に記録する。
+    """
+    stop = threading.Event()
+    chunk_q = queue.Queue(maxsize=queue_size)
+    vector_q = queue.Queue(maxsize=queue_size)
+    reuse = {h: list(ids) for h, ids in (reuse or {}).items()}
+    index_lock = index_lock or nullcontext()
+    progress = progress or IngestProgress()
+
+    def chunk_batches():
+        batch = _Batch(page_no=0)
+        try:
+            for page_no, page_text in enumerate(pages, start=1):
+                batch.page_no = page_no
+                progress.pages_read = page_no
+                for chunk, start_index, end_index in _split(text_splitter, page_text):
+                    h = chunk_hash(chunk)
+                    progress.chunks_split += 1
+                    metadata = {"source": source, "page": page_no}
+                    if start_index is not None:
+                        # ページ内の文字位置
+                        metadata.update(start_index=start_index, end_index=end_index)
+                    if reuse.get(h):
+                        reused_id = reuse[h].pop()
+                        batch.records.append((reused_id, h, page_no))
+                        batch.reused.append((reused_id, metadata))
+                        continue
+                    chunk_id = str(uuid.uuid4())
+                    batch.texts.append(chunk)
+                    batch.metadatas.append(metadata)
+                    batch.ids.append(chunk_id)
+                    batch.records.append((chunk_id, h, page_no))
+                    if len(batch.texts) >= batch_size:
+                        yield batch
+                        batch = _Batch(page_no=page_no)
+                if stop.is_set():
+                    return
+            if batch.records:
+                yield batch
+        finally:
+            # 抽出側のプロセスプールなどを確実に後始末する
+            if hasattr(pages, "close"):
+                pages.close()
+
+    def embedded_batches():
+        for batch in _drain(chunk_q, stop):
+            if batch.texts:
+                batch.vectors = embeddings.embed_documents(batch.texts)
+                progress.chunks_embedded += len(batch.texts)
+            yield batch
+
+    threads = [
+        _start_stage(chunk_batches, chunk_q, stop),
+        _start_stage(embedded_batches, vector_q, stop),
+    ]
+    started = time.perf_counter()
+    try:
+        for batch in _drain(vector_q, stop):
+            if batch.texts:
+                text_embeddings = list(zip(batch.texts, batch.vectors))
+                if vectorstore is None:
+                    vectorstore = new_vectorstore(embeddings, batch.vectors, storage)
+                with index_lock:
+                    vectorstore.add_embeddings(
+                        text_embeddings, metadatas=batch.metadatas, ids=batch.ids
+                    )
+                    if lexical_index is not None:
+                        lexical_index.add(batch.ids, batch.texts)
+            progress.pages = batch.page_no
+            progress.chunks += len(batch.records)
+            progress.embedded += len(batch.texts)
+            progress.records.extend(batch.records)
+            progress.reused.extend(batch.reused)
+            progress.seconds = time.perf_counter() - started
+            yield vectorstore, progress
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=1)
@@ -0,0 +1,280 @@
+"""
+バックグラウンドのインジェストジョブ
+
+Streamlit のスクリプトは再実行やページ移動で打ち切られるので、PDF の登録は
+プロセス内で1つの JobManager のスレッドプールで実行する。
+ジョブはステージごとの進み具合と途中のベクトルストアを持ち、各ページは再実行のたびに
+sync_session でそれを session_state に反映する。最初のバッチが入った時点から、
+登録済みのチャンクに対して質問できる (検索は job.lock を取ってから行う)。
+"""
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from extraction import count_pages, iter_pages
+from faiss_index import delete_chunks, maybe_upgrade_index
+from index_store import save_index
+from ingest import IngestProgress, ingest, update_metadata
+
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+# 同時に実行するジョブ数 (抽出はジョブの中でさらにプロセスプールで並列化される)
+MAX_CONCURRENT_JOBS = 2
+# 終わったジョブを、セッションが結果を受け取りに来るまで残しておく時間
+FINISHED_JOB_TTL = 60 * 60
+
+
+class IngestJob:
+    def __init__(self, job_id, name):
+        self.id = job_id
+        self.name = name
+        self.status = QUEUED
+        self.error = None
+        self.messages = []
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.page_count = 0
+        self.progress = IngestProgress()
+        # 登録中のベクトルストアなど。ジョブのスレッドはこのロックの中で書き換える
+        self.lock = threading.Lock()
+        self.vectorstore = None
+        self.lexical_index = None
+        self.registry = None
+        # 保存したインデックスの名前 (保存しなかった場合は None)
+        self.index_name = None
+        # 登録は済んだが保存に失敗した (セッションの index_name は古い内容を指す)
+        self.unsaved = False
+        self._cancel = threading.Event()
+
+    @property
+    def done(self):
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def pages_per_sec(self):
+        return self.progress.pages_read / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def chunks_per_sec(self):
+        return self.progress.chunks / self.elapsed if self.elapsed > 0 else 0.0
+
+    def stages(self):
+        """ (ステージ名, 済んだ数, 全体の数 or None) のリスト """
+        progress = self.progress
+        return [
+            ("extract", progress.pages_read, self.page_count),
+            ("split", progress.chunks_split, None),
+            ("embed", progress.chunks_embedded, None),
+            ("index", progress.chunks, None),
+        ]
+
+
+class JobManager:
+    def __init__(self, max_workers=MAX_CONCURRENT_JOBS):
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="ingest")
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, name, target, *args, **kwargs):
+        """ target(job, *args, **kwargs) をバックグラウンドで実行し、ジョブを返す """
+        with self._lock:
+            self._prune()
+            job = IngestJob(next(self._ids), name)
+            # 実行が始まる前から、どのベクトルストアに追加するジョブか分かるようにする (running_on)
+            job.vectorstore = kwargs.get("vectorstore")
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, target, args, kwargs)
+        return job
+
+    def _run(self, job, target, args, kwargs):
+        job.started = time.time()
+        job.status = RUNNING
+        try:
+            target(job, *args, **kwargs)
+            job.status = CANCELLED if job.cancelled else DONE
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.status = FAILED
+        finally:
+            job.finished = time.time()
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def running_on(self, vectorstore):
+        """ vectorstore に登録中 (未完了) のジョブを返す。無ければ None """
+        with self._lock:
+            return next(
+                (job for job in self._jobs.values() if not job.done and job.vectorstore is vectorstore),
+                None,
+            )
+
+    def jobs(self):
+        return sorted(self._jobs.values(), key=lambda job: job.created, reverse=True)
+
+    def _prune(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.done and now - job.finished > FINISHED_JOB_TTL:
+                del self._jobs[job_id]
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def job_manager():
+    """ プロセス内で共有する JobManager (スクリプトの再実行をまたいで残る) """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager()
+        return _manager
+
+
+def ingest_pdf_job(job, pdf_path, file_name, file_hash, text_splitter, embeddings, *,
+                   vectorstore, lexical_index, registry, index_name, embedding_model,
+                   storage, remove_file=True):
+    """
+    PDF (のパス) を抽出 → 分割 → 埋め込み → 登録し、台帳を更新して保存する
+    途中でキャンセルされた場合は、このジョブで追加したチャンクを取り除く
+    """
+    job.vectorstore, job.lexical_index, job.registry = vectorstore, lexical_index, registry
+    reuse = registry.reusable_chunks(file_name)
+    reused_ids = {_id for ids in reuse.values() for _id in ids}
+
+    def rollback():
+        added = [r[0] for r in job.progress.records if r[0] not in reused_ids]
+        with job.lock:
+            if vectorstore is None:
+                # このジョブで作ったベクトルストアはまるごと捨てる
+                job.vectorstore = None
+            elif added:
+                delete_chunks(job.vectorstore, added)
+            lexical_index.remove(added)
+        return added
+
+    try:
+        job.page_count = count_pages(pdf_path)
+        batches = ingest(
+            iter_pages(pdf_path),
+            text_splitter,
+            embeddings,
+            vectorstore=vectorstore,
+            source=file_name,
+            reuse=reuse,
+            storage=storage,
+            lexical_index=lexical_index,
+            index_lock=job.lock,
+            progress=job.progress,
+        )
+        with closing(batches):
+            for batch_vectorstore, _ in batches:
+                job.vectorstore = batch_vectorstore
+                if job.cancelled:
+                    break
+    except BaseException:
+        rollback()
+        raise
+    finally:
+        if remove_file:
+            os.unlink(pdf_path)
+
+    progress = job.progress
+    if job.cancelled:
+        added = rollback()
+        job.messages.append(f"Cancelled; removed {len(added)} chunks of {file_name}")
+        return
+    if job.vectorstore is None:
+        job.messages.append(f"{file_name} にテキストが見つかりませんでした")
+        return
+
+    # 台帳を書き換えるのは最後にする。途中で失敗したら、このジョブで加えた変更を戻してから失敗させる
+    try:
+        with job.lock:
+            # 改訂版で使われなくなったチャンクだけを取り除く
+            stale_ids = registry.stale_chunks(file_name, progress.records)
+            # 引き継いだチャンクのページ番号と位置を新しい版に合わせる
+            previous_metadata = update_metadata(job.vectorstore, progress.reused)
+            try:
+                if stale_ids:
+                    delete_chunks(job.vectorstore, stale_ids)
+                    lexical_index.remove(stale_ids)
+            except BaseException:
+                update_metadata(job.vectorstore, previous_metadata)
+                raise
+    except BaseException:
+        rollback()
+        raise
+    with job.lock:
+        # チャンク数がしきい値を超えたら HNSW / IVF-PQ に切り替える (faiss_index.py)
+        # 作り直したインデックスは出来上がってから差し替えるので、失敗しても元のまま使える
+        try:
+            upgraded = maybe_upgrade_index(job.vectorstore)
+        except Exception as e:
+            upgraded = False
+            job.messages.append(f"Index upgrade failed ({type(e).__name__}: {e}); kept the current index")
+        registry.put(file_name, file_hash, progress.pages, progress.records)
+    try:
+        save_index(job.vectorstore, index_name, embedding_model, registry, lexical_index)
+    except Exception as e:
+        # 登録は済んでいるので、ジョブは失敗にせず保存できなかったことだけを伝える
+        job.unsaved = True
+        job.messages.append(f"Could not save the index: {type(e).__name__}: {e}")
+    else:
+        job.index_name = index_name
+    if upgraded:
+        job.messages.append(f"Index upgraded to {type(job.vectorstore.index).__name__}")
+    job.messages.append(
+        f"{progress.pages} pages / {progress.chunks} chunks in {job.elapsed:.2f}s "
+        f"({job.pages_per_sec:.1f} pages/sec, {job.chunks_per_sec:.1f} chunks/sec, "
+        f"{progress.embedded} embedded, {progress.chunks - progress.embedded} reused, "
+        f"{len(stale_ids)} removed)"
+    )
+
+
+def sync_session(state, manager=None):
+    """
+    セッションのジョブ (state["ingest_job_id"]) の途中結果を state に反映し、ジョブを返す
+    ジョブが終わっていれば台帳も反映し、state からジョブを外す
+    """
+    manager = manager or job_manager()
+    job = manager.get(state.get("ingest_job_id"))
+    if job is None:
+        state.pop("ingest_job_id", None)
+        return None
+    state["vectorstore_lock"] = job.lock
+    if job.vectorstore is not None:
+        state["vectorstore"] = job.vectorstore
+        state["lexical_index"] = job.lexical_index
+    elif job.done:
+        # 新しく作るはずだったベクトルストアへの登録が失敗・キャンセルされた
+        state.pop("vectorstore", None)
+    if job.done:
+        if job.status == DONE:
+            state["registry"] = job.registry
+            if job.index_name is not None:
+                state["index_name"] = job.index_name
+            elif job.unsaved:
+                # 保存済みのインデックスは今の内容と違うので、検索サービスには使わせない
+                state.pop("index_name", None)
+        state.pop("ingest_job_id", None)
+    return job
@@ -1,9 +1,23 @@
-import fitz  # PyMuPDF
+import copy
+import os
+
 import streamlit as st
-from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from bm25 import BM25Index
+from embedding_backends import (
+    BACKENDS, OPENAI, OPENAI_EMBEDDING_MODEL, backend_for_model, create_embeddings,
+    embedding_model,
+)
+from extraction import spool_to_file
+from faiss_index import STORAGE_TYPES, bytes_per_vector, delete_chunks
+from index_store import (
+    clone_vectorstore, documents_index_name, list_indexes, load_index, load_lexical_index,
+    load_registry, read_manifest, save_index,
+)
+from jobs import DONE, FAILED, ingest_pdf_job, job_manager, sync_session
+from registry import DocumentRegistry
+from session_memory import session_memory
+from splitter import TokenSplitter
 
 
 def init_page():
@@ -16,8 +30,171 @@ def init_page():
 
 def init_messages():
     clear_button = st.sidebar.button("Clear DB", key="clear")
-    if clear_button and "vectorstore" in st.session_state:
-        del st.session_state.vectorstore
+    if clear_button:
+        # 登録中のジョブがあれば止める
+        job = job_manager().get(st.session_state.get("ingest_job_id"))
+        if job is not None:
+            job.cancel()
+        for key in (
+            "vectorstore", "vectorstore_shared", "lexical_index",
+            "index_name", "registry", "last_upload_id", "embedding_backend",
+            # PDF QA のページがベクトルストアを参照したまま持っているもの
+            "qa_retriever", "qa_query_embeddings",
+            "ingest_job_id", "vectorstore_lock",
+        ):
+            st.session_state.pop(key, None)
+
+
+@st.cache_resource
+def get_embeddings(backend=OPENAI):
+    # バックエンドごとに1つ作り、キャッシュとレート制限は全セッションで共有する
+    # (embedding_backends.py)
+    return create_embeddings(backend)
+
+
+def select_embedding_backend():
+    # local はネットワークも API キーも使わずに CPU だけで埋め込む (精度は OpenAI に劣る)
+    # ベクトルストアを作った後は、そのバックエンドに固定する (次元が変わるため)
+    current = st.session_state.get("embedding_backend")
+    backends = list(BACKENDS)
+    backend = st.sidebar.radio(
+        "Embeddings", backends,
+        index=backends.index(current) if current else 0,
+        disabled=current is not None,
+    )
+    return current or backend
+
+
+@st.cache_resource(max_entries=8)
+def load_shared_index(name, version):
+    # 保存済みインデックスはプロセス内の全セッションで1つのオブジェクトを共有する
+    # version が変わると (= 再保存されると) 読み込み直す
+    # 埋め込みは保存時のモデルに合わせる
+    backend = backend_for_model(read_manifest(name).get("embedding_model"))
+    return load_index(name, get_embeddings(backend))
+
+
+@st.cache_resource(max_entries=8)
+def load_shared_lexical_index(name, version):
+    # BM25 を保存していない古いインデックスは docstore から作り直す
+    return load_lexical_index(name) or BM25Index.from_vectorstore(load_shared_index(name, version))
+
+
+def select_saved_index():
+    manifests = list_indexes()
+    if not manifests:
+        return
+    labels = {
+        m["name"]: f'{m["name"]} ({m["ntotal"]} chunks)' for m in manifests
+    }
+    name = st.sidebar.selectbox(
+        "Saved indexes", list(labels), format_func=labels.get
+    )
+    if st.sidebar.button("Load", key="load_index"):
+        manifest = next(m for m in manifests if m["name"] == name)
+        activate_saved_index(name, manifest)
+
+
+def activate_saved_index(name, manifest):
+    st.session_state.vectorstore = load_shared_index(name, manifest["version"])
+    # 共有オブジェクトなので、追記や削除をする場合は先にコピーする (writable_vectorstore)
+    st.session_state.lexical_index = load_shared_lexical_index(name, manifest["version"])
+    st.session_state.vectorstore_shared = True
+    st.session_state.index_name = name
+    st.session_state.registry = load_registry(name)
+    st.session_state.embedding_backend = backend_for_model(manifest.get("embedding_model"))
+
+
+def restore_saved_index():
+    # PDF QA が検索サービスを使っている間、セッションはインデックスの名前だけを持つ
+    # このページでは追記・削除に使うので、保存済みのもの (全セッションで共有) を読み込み直す
+    name = st.session_state.get("index_name")
+    if name is None or "vectorstore" in st.session_state:
+        return
+    manifest = read_manifest(name)
+    if manifest is not None:
+        activate_saved_index(name, manifest)
+
+
+def writable_vectorstore():
+    vectorstore = st.session_state.get("vectorstore")
+    if vectorstore is not None and st.session_state.get("vectorstore_shared"):
+        vectorstore = clone_vectorstore(vectorstore)
+        st.session_state.vectorstore = vectorstore
+        st.session_state.lexical_index = copy.deepcopy(st.session_state.lexical_index)
+        st.session_state.vectorstore_shared = False
+    return vectorstore
+
+
+def session_index_name(documents, backend):
+    # 名前はドキュメントの集合から決める。読み込んだ共有インデックスに追記・削除しても、
+    # 別の名前で保存されるので他のセッションのインデックスは変わらない
+    # 埋め込みのバックエンドが違うインデックスとは名前を分ける
+    return documents_index_name(documents, None if backend == OPENAI else backend)
+
+
+def registry_documents(registry):
+    return {name: doc["sha256"] for name, doc in registry.documents.items()}
+
+
+def save_session_index():
+    # 再起動やリロード後も使えるようにディスクに保存する (index_store.py)
+    backend = st.session_state.get("embedding_backend", OPENAI)
+    st.session_state.index_name = session_index_name(
+        registry_documents(st.session_state.registry), backend
+    )
+    save_index(
+        st.session_state.vectorstore,
+        st.session_state.index_name,
+        embedding_model(backend),
+        st.session_state.registry,
+        st.session_state.lexical_index,
+    )
+
+
+def manage_documents():
+    registry = st.session_state.get("registry")
+    if not registry or not registry.documents:
+        return
+    st.sidebar.markdown("### Documents")
+    for name in list(registry.documents):
+        first, last = registry.page_span(name)
+        chunks = len(registry.documents[name]["chunks"])
+        col1, col2 = st.sidebar.columns([4, 1])
+        col1.caption(f"{name} (p.{first}-{last}, {chunks} chunks)")
+        if col2.button("🗑", key=f"remove_{name}"):
+            # 台帳に記録したチャンクだけを FAISS から取り除く (全体の作り直しはしない)
+            vectorstore = writable_vectorstore()
+            ids = registry.remove(name)
+            if ids:
+                delete_chunks(vectorstore, ids)
+                st.session_state.lexical_index.remove(ids)
+            if registry.documents:
+                save_session_index()
+            else:
+                st.session_state.pop("index_name", None)
+            st.rerun()
+
+
+def select_storage():
+    # ベクトルの保存形式。float16 は半分、int8 は 1/4 のメモリで済むが、検索の精度は少し落ちる
+    # (python storage_report.py <index name> で比較できる)
+    # 新しくベクトルストアを作るときだけ使われる
+    return st.sidebar.selectbox("Vector storage", STORAGE_TYPES)
+
+
+def get_text_splitter():
+    # 文書を一度だけ tiktoken でエンコードし、トークン位置で段落・文の切れ目を探して分割する
+    # (splitter.py, RecursiveCharacterTextSplitter.from_tiktoken_encoder より速い)
+    # (local の埋め込みでもチャンクの大きさは同じトークン数で揃える)
+    return TokenSplitter.from_model_name(
+        OPENAI_EMBEDDING_MODEL,
+        # 適切な chunk size は質問対象のPDFによって変わるため調整が必要
+        # 大きくしすぎると質問回答時に色々な箇所の情報を参照することができない
+        # 逆に小さすぎると一つのchunkに十分なサイズの文脈が入らない
+        chunk_size=500,
+        chunk_overlap=0,
+    )
 
 
 def get_pdf_text():
@@ -28,61 +205,152 @@ def get_pdf_text():
         type=['pdf']  # PDFファイルのみアップロード可
     )
     if pdf_file:
-        pdf_text = ""
-        with st.spinner("Loading PDF ..."):
-            # PyMuPDFでPDFを読み取る
-            # (詳細な説明はライブラリの公式ページなどをご参照ください)
-            pdf_doc = fitz.open(stream=pdf_file.read(), filetype="pdf")
-            for page in pdf_doc:
-                pdf_text += page.get_text()
-
-        # RecursiveCharacterTextSplitter でチャンクに分割する
-        # (詳細な説明は第6章をご参照ください)
-        text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-            model_name="text-embedding-3-small",
-            # 適切な chunk size は質問対象のPDFによって変わるため調整が必要
-            # 大きくしすぎると質問回答時に色々な箇所の情報を参照することができない
-            # 逆に小さすぎると一つのchunkに十分なサイズの文脈が入らない
-            chunk_size=500,
-            chunk_overlap=0,
-        )
-        return text_splitter.split_text(pdf_text)
+        # 中身は read() でコピーせず、ファイルオブジェクトのまま渡す
+        return pdf_file.name, pdf_file
     else:
         return None
 
 
-def build_vector_store(pdf_text):
-    with st.spinner("Saving to vector store ..."):
-        if 'vectorstore' in st.session_state:
-            st.session_state.vectorstore.add_texts(pdf_text)
-        else:
-            # ベクトルDBの初期化と文書の追加を同時に行う
-            # LangChain の Document Loader を利用した場合は `from_documents` にする
-            st.session_state.vectorstore = FAISS.from_texts(
-                pdf_text,
-                OpenAIEmbeddings(model="text-embedding-3-small")
-            )
-
-            # FAISSのデフォルト設定はL2距離となっている
-            # コサイン類似度にしたい場合は以下のようにする
-            # from langchain_community.vectorstores.utils import DistanceStrategy
-            # st.session_state.vectorstore = FAISS.from_texts(
-            #     pdf_text,
-            #     OpenAIEmbeddings(model="text-embedding-3-small"),
-            #     distance_strategy=DistanceStrategy.COSINE
-            # )
-
-
-def page_pdf_upload_and_build_vector_db():
+def build_vector_store(pdf_text, storage, backend):
+    file_name, pdf_file = pdf_text
+    # file_uploader にファイルが残っている間は再実行のたびに呼ばれるので、
+    # 処理済みのアップロードは (削除した後でも) 登録し直さない
+    if st.session_state.get("last_upload_id") == pdf_file.file_id:
+        return
+    st.session_state.last_upload_id = pdf_file.file_id
+    # アップロードは一時ファイルに書き出し、登録はバックグラウンドのジョブで行う (jobs.py)
+    # ハッシュは書き出しながら計算する (アップロードの中身を読むのは1回だけ)
+    pdf_path, file_hash = spool_to_file(pdf_file)
+    registry = st.session_state.get("registry") or DocumentRegistry()
+    if registry.is_unchanged(file_name, file_hash):
+        os.unlink(pdf_path)
+        st.info(f"{file_name} はすでにベクトルストアに登録済みです")
+        return
+
+    if st.session_state.get("vectorstore") is None:
+        # 同じPDFを以前に保存していれば、埋め込み直さずにディスクから読み込む
+        name = session_index_name({file_name: file_hash}, backend)
+        manifest = read_manifest(name)
+        if manifest and [doc["sha256"] for doc in manifest["documents"]] == [file_hash]:
+            os.unlink(pdf_path)
+            activate_saved_index(name, manifest)
+            st.info(f"{file_name} は保存済みのインデックスから読み込みました")
+            return
+        st.session_state.embedding_backend = backend
+    # 登録後のドキュメントの集合の名前で保存する (同名ファイルは新しい版に置き換わる)
+    documents = registry_documents(registry)
+    documents[file_name] = file_hash
+    vectorstore = writable_vectorstore()
+    if "lexical_index" not in st.session_state:
+        st.session_state.lexical_index = BM25Index()
+
+    # ページ移動や再実行で処理が打ち切られることはなく、登録済みのチャンクにはすぐ質問できる
+    # ジョブの中では PyMuPDF でディスクから開いたPDFを、
+    # 抽出 → 分割 → 埋め込み → インデックス とキューでつないで流す (extraction.py, ingest.py)
+    # FAISSのデフォルト設定はL2距離となっている
+    # コサイン類似度にしたい場合は FAISS の作成時に distance_strategy=DistanceStrategy.COSINE を指定する
+    job = job_manager().submit(
+        file_name,
+        ingest_pdf_job,
+        pdf_path,
+        file_name,
+        file_hash,
+        get_text_splitter(),
+        get_embeddings(backend),
+        vectorstore=vectorstore,
+        # 語彙検索 (BM25) 用の転置インデックスも同時に作る
+        lexical_index=st.session_state.lexical_index,
+        # 同名ファイルの改訂版なら、内容が変わっていないチャンクは埋め込み直さない
+        registry=registry,
+        index_name=session_index_name(documents, backend),
+        embedding_model=embedding_model(backend),
+        storage=storage,
+    )
+    st.session_state.ingest_job_id = job.id
+    st.rerun()
+
+
+@st.experimental_fragment(run_every=1)
+def show_ingest_progress():
+    # ページ全体ではなく、この部分だけを1秒ごとに再実行して進み具合を表示する
+    job = job_manager().get(st.session_state.get("ingest_job_id"))
+    if job is None or job.done:
+        # 終わったらページ全体を再実行して結果を反映する
+        st.rerun()
+    progress = job.progress
+    st.progress(
+        min(progress.pages_read / max(job.page_count, 1), 1.0),
+        text=f"Saving {job.name} to vector store ... {progress.pages_read}/{job.page_count} pages",
+    )
+    st.caption(" → ".join(
+        f"{stage} {done:,}" + (f"/{total:,}" if total else "")
+        for stage, done, total in job.stages()
+    ))
+    st.caption(
+        f"{job.pages_per_sec:.1f} pages/sec, {job.chunks_per_sec:.1f} chunks/sec, "
+        f"{job.elapsed:.0f}s elapsed. 登録済みのチャンクには 🧐 PDF QA で質問できます"
+    )
+    if st.button("Cancel", key="cancel_ingest"):
+        job.cancel()
+
+
+def show_ingest_result(job):
+    if job.status != DONE:
+        # 同じファイルをもう一度アップロードできるようにする
+        st.session_state.pop("last_upload_id", None)
+    if job.status == FAILED:
+        st.error(f"{job.name} の登録に失敗しました: {job.error}")
+    for message in job.messages:
+        st.caption(message)
+    vectorstore = st.session_state.get("vectorstore")
+    if job.status == DONE and vectorstore is not None:
+        st.caption(
+            f"{vectorstore.index.ntotal} chunks, "
+            f"{bytes_per_vector(vectorstore.index)} bytes/chunk for vectors "
+            f"({type(vectorstore.index).__name__})"
+        )
+
+
+def show_embedding_cache_stats(backend):
+    embeddings = get_embeddings(backend)
+    if not hasattr(embeddings, "hit_rate"):
+        return
+    st.sidebar.caption(
+        f"Embedding cache: {embeddings.hits} hits / {embeddings.misses} misses "
+        f"({embeddings.hit_rate:.0%}), {embeddings.saved_tokens:,} tokens saved"
+    )
+
+
+def page_pdf_upload_and_build_vector_db(job):
     st.title("PDF Upload 📄")
+    storage = select_storage()
+    backend = select_embedding_backend()
+    if job is not None and not job.done:
+        # 登録が終わるまでは、次のアップロードや削除は受け付けない
+        show_ingest_progress()
+        return
+    if job is not None:
+        show_ingest_result(job)
     pdf_text = get_pdf_text()
     if pdf_text:
-        build_vector_store(pdf_text)
+        build_vector_store(pdf_text, storage, backend)
+    manage_documents()
+    show_embedding_cache_stats(backend)
 
 
 def main():
     init_page()
-    page_pdf_upload_and_build_vector_db()
+    # バックグラウンドの登録ジョブの途中経過をセッションに反映する (jobs.py)
+    job = sync_session(st.session_state)
+    init_messages()
+    restore_saved_index()
+    if job is None or job.done:
+        select_saved_index()
+    # 使っていないセッションのインデックスはディスクに書き出されている (session_memory.py)
+    memory = session_memory()
+    memory.touch(st.session_state)
+    with memory.use(st.session_state):
+        page_pdf_upload_and_build_vector_db(job)
 
 
 if __name__ == '__main__':
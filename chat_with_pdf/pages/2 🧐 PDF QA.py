@@ -1,6 +1,9 @@
+import time
+from collections import deque
+from contextlib import nullcontext
+
 import streamlit as st
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
 
 # models
@@ -8,6 +11,22 @@ from langchain_openai import ChatOpenAI
 from langchain_anthropic import ChatAnthropic
 from langchain_google_genai import ChatGoogleGenerativeAI
 
+from bm25 import BM25Index
+from context_packing import context_budget, pack_context
+from embedding_backends import backend_for_model, create_embeddings
+from faiss_index import HNSW, IVFPQ, index_kind
+from index_store import load_index, load_lexical_index, read_manifest
+from ingest import chunk_hash
+from jobs import sync_session
+from qa_cache import (
+    QUERY_CACHE_SIZE, QUERY_CACHE_TTL, QueryEmbeddingCache, SemanticAnswerCache, TTLCache
+)
+from retrieval_service import (
+    SERVICE_URL, RetrievalClient, RetrievalServiceError, ServiceEmbeddings, ServiceRetriever
+)
+from retrievers import FaissRetriever, HybridRetriever, MMRRetriever, is_keyword_query
+from session_memory import session_memory
+
 ###### dotenv を利用しない場合は消してください ######
 try:
     from dotenv import load_dotenv
@@ -26,33 +45,190 @@ def init_page():
     st.sidebar.title("Options")
 
 
-def select_model(temperature=0):
-    models = ("GPT-3.5", "GPT-4", "Claude 3.5 Sonnet", "Gemini 1.5 Pro")
-    model = st.sidebar.radio("Choose a model:", models)
-    if model == "GPT-3.5":
-        return ChatOpenAI(
-            temperature=temperature,
-            model_name="gpt-3.5-turbo"
-        )
-    elif model == "GPT-4":
+MODELS = {
+    "GPT-3.5": "gpt-3.5-turbo",
+    "GPT-4": "gpt-4o",
+    "Claude 3.5 Sonnet": "claude-3-5-sonnet-20240620",
+    "Gemini 1.5 Pro": "gemini-1.5-pro-latest",
+}
+# サイドバーに表示する直近の再実行の件数
+RERUN_HISTORY = 20
+
+
+@st.cache_resource
+def get_llm(model_name, temperature=0):
+    # Streamlit は入力のたびにスクリプト全体を再実行するので、
+    # クライアント (と HTTP のコネクションプール) はプロセス内で使い回す
+    if model_name.startswith("gpt-"):
         return ChatOpenAI(
             temperature=temperature,
-            model_name="gpt-4o"
+            model_name=model_name
         )
-    elif model == "Claude 3.5 Sonnet":
+    elif model_name.startswith("claude-"):
         return ChatAnthropic(
             temperature=temperature,
-            model_name="claude-3-5-sonnet-20240620"
+            model_name=model_name
         )
-    elif model == "Gemini 1.5 Pro":
+    elif model_name.startswith("gemini-"):
         return ChatGoogleGenerativeAI(
             temperature=temperature,
-            model="gemini-1.5-pro-latest"
+            model=model_name
         )
 
 
-def init_qa_chain():
-    llm = select_model()
+def select_model(temperature=0):
+    model = st.sidebar.radio("Choose a model:", tuple(MODELS))
+    return MODELS[model], temperature
+
+
+def select_search_params(kind):
+    # 大きなインデックス (HNSW / IVF-PQ) では探索の広さを調整できる
+    # 大きくするほど再現率が上がるが、検索は遅くなる
+    if kind == HNSW:
+        return {"ef_search": st.sidebar.slider("efSearch", 16, 512, 64)}
+    if kind == IVFPQ:
+        return {"nprobe": st.sidebar.slider("nprobe", 1, 256, 16)}
+    return {}
+
+
+def get_lexical_index():
+    # アップロード時に作った BM25 インデックスを使う。無ければ docstore から作る
+    if st.session_state.get("lexical_index") is None:
+        st.session_state.lexical_index = BM25Index.from_vectorstore(st.session_state.vectorstore)
+    return st.session_state.lexical_index
+
+
+@st.cache_resource
+def get_retrieval_client():
+    # 検索サービス (retrieval_service.py) が設定されていれば、接続は全セッションで共有する
+    return RetrievalClient(SERVICE_URL) if SERVICE_URL else None
+
+
+def get_service_index(job):
+    """
+    検索サービスを使える場合は (クライアント, インデックスの情報) を返す
+    セッションのインデックスが保存済みで、登録中でないことが条件
+    """
+    client = get_retrieval_client()
+    name = st.session_state.get("index_name")
+    if client is None or name is None or (job is not None and not job.done):
+        return None
+    try:
+        return client, client.index_info(name)
+    except (RetrievalServiceError, OSError) as e:
+        st.sidebar.caption(f"Retrieval service unavailable ({e}); searching locally")
+        return None
+
+
+def release_session_index():
+    # 検索サービスが保存済みのインデックスで答えるので、セッションはインデックスを持たずに
+    # index_name だけを持つ (📄 Upload PDF(s) で追記・削除するときに読み込み直す)
+    for key in ("vectorstore", "vectorstore_shared", "lexical_index", "qa_query_embeddings"):
+        st.session_state.pop(key, None)
+
+
+@st.cache_resource(max_entries=8)
+def load_saved_index(name, version):
+    # 保存済みインデックスはプロセス内の全セッションで1つのオブジェクトを共有する
+    backend = backend_for_model(read_manifest(name).get("embedding_model"))
+    vectorstore = load_index(name, create_embeddings(backend))
+    return vectorstore, load_lexical_index(name) or BM25Index.from_vectorstore(vectorstore)
+
+
+def restore_session_index():
+    # 検索サービスが使えなくなったら、保存済みのインデックスを読み込んでこのプロセスで検索する
+    name = st.session_state.get("index_name")
+    if name is None or "vectorstore" in st.session_state:
+        return
+    manifest = read_manifest(name)
+    if manifest is None:
+        return
+    vectorstore, lexical_index = load_saved_index(name, manifest["version"])
+    st.session_state.vectorstore = vectorstore
+    st.session_state.lexical_index = lexical_index
+    # 共有オブジェクトなので、追記や削除をする場合は先にコピーする
+    st.session_state.vectorstore_shared = True
+
+
+@st.cache_resource
+def get_query_embedding_cache():
+    # クエリの埋め込みと回答のキャッシュはプロセス内の全セッションで共有する (qa_cache.py)
+    return TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+
+@st.cache_resource
+def get_answer_cache():
+    return SemanticAnswerCache()
+
+
+def select_retrieval_mode():
+    # hybrid: ベクトル検索と BM25 を順位で統合する。型番などだけのクエリは BM25 だけで返す
+    # vector: ベクトル検索のみ / lexical: BM25 のみ (埋め込みの API を呼ばない)
+    # mmr: ベクトル検索の候補から、互いに似ていないチャンクを選ぶ
+    return st.sidebar.radio("Retrieval:", ("hybrid", "vector", "mmr", "lexical"))
+
+
+def vectorstore_version(service):
+    if service is not None:
+        _, info = service
+        return info["name"], info["version"]
+    # コピーオンライトでベクトルストアを差し替えると id が変わり、削除すると件数が変わる
+    vectorstore = st.session_state.vectorstore
+    return id(vectorstore), vectorstore.index.ntotal
+
+
+def init_retriever(mode, query_embeddings, service, k=10):
+    if service is not None:
+        kind = service[1]["index_kind"]
+    else:
+        kind = index_kind(st.session_state.vectorstore.index)
+    search_params = select_search_params(kind)
+    # リトリーバーはセッションのベクトルストアを参照するので session_state に置き、
+    # ベクトルストアの版・検索方法・探索パラメータが変わったときだけ作り直す
+    key = (vectorstore_version(service), mode, k, tuple(sorted(search_params.items())))
+    cached = st.session_state.get("qa_retriever")
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    retriever = build_retriever(mode, query_embeddings, service, k, search_params)
+    st.session_state.qa_retriever = (key, retriever)
+    return retriever
+
+
+def build_retriever(mode, query_embeddings, service, k, search_params):
+    if service is not None:
+        # 埋め込みと検索はサービス側で行う (セッションは FAISS を使わない)
+        client, info = service
+        return ServiceRetriever(
+            client=client, index_name=info["name"], mode=mode, k=k, **search_params
+        )
+    if mode == "vector":
+        return FaissRetriever(
+            vectorstore=st.session_state.vectorstore,
+            query_embeddings=query_embeddings,
+            k=k,
+            **search_params,
+        )
+    if mode == "mmr":
+        return MMRRetriever(
+            vectorstore=st.session_state.vectorstore,
+            query_embeddings=query_embeddings,
+            k=k,
+            **search_params,
+        )
+    return HybridRetriever(
+        vectorstore=st.session_state.vectorstore,
+        lexical_index=get_lexical_index(),
+        query_embeddings=query_embeddings,
+        k=k,
+        # lexical の場合は埋め込み検索をせず、常に BM25 の結果を返す
+        lexical_only=(mode == "lexical"),
+        **search_params,
+    )
+
+
+@st.cache_resource
+def get_qa_chain(model_name, temperature=0):
+    llm = get_llm(model_name, temperature)
     prompt = ChatPromptTemplate.from_template("""
     以下の前提知識を用いて、ユーザーからの質問に答えてください。
 
@@ -64,37 +240,144 @@ def init_qa_chain():
     ユーザーからの質問
     {question}
     """)
-    retriever = st.session_state.vectorstore.as_retriever(
-        # "mmr",  "similarity_score_threshold" などもある
-        search_type="similarity",
-        # 文書を何個取得するか (default: 4)
-        search_kwargs={"k":10}
+    chain = prompt | llm | StrOutputParser()
+    return llm, chain
+
+
+def init_qa_chain():
+    return get_qa_chain(*select_model())
+
+
+def model_name(llm):
+    return getattr(llm, "model_name", None) or getattr(llm, "model", "")
+
+
+def cache_scope(llm, mode, service):
+    # ドキュメントの集合・モデル・検索方法が同じ場合だけ回答を使い回す
+    registry = st.session_state.get("registry")
+    if service is not None:
+        ntotal, fallback = service[1]["ntotal"], service[1]["version"]
+    else:
+        vectorstore = st.session_state.vectorstore
+        ntotal, fallback = vectorstore.index.ntotal, id(vectorstore)
+    # 登録中はチャンク数が増えていくので、チャンク数もキーに含める
+    if registry is not None:
+        documents = f"{registry.fingerprint()}:{ntotal}"
+    else:
+        documents = f"{fallback}:{ntotal}"
+    return documents, model_name(llm), mode
+
+
+def show_cache_stats(query_cache, answer_cache):
+    st.sidebar.caption(
+        f"Query embedding cache: {query_cache.hits} hits / {query_cache.misses} misses "
+        f"({query_cache.hit_rate:.0%})"
     )
-    chain = (
-        {"context": retriever, "question": RunnablePassthrough()}
-        | prompt
-        | llm
-        | StrOutputParser()
+    st.sidebar.caption(
+        f"Answer cache: {answer_cache.exact_hits} exact + {answer_cache.semantic_hits} semantic hits "
+        f"/ {answer_cache.misses} misses ({answer_cache.hit_rate:.0%})"
     )
-    return chain
 
 
-def page_ask_my_pdf():
-    chain = init_qa_chain()
+def get_query_embeddings(service):
+    if service is not None:
+        # 回答キャッシュの類似検索に使うクエリの埋め込みもサービスに求める
+        client, info = service
+        embeddings = ServiceEmbeddings(client, info["name"], info["embedding_model"])
+        return QueryEmbeddingCache(embeddings, get_query_embedding_cache())
+    embeddings = st.session_state.vectorstore.embedding_function
+    cached = st.session_state.get("qa_query_embeddings")
+    if cached is None or cached.embeddings is not embeddings:
+        cached = QueryEmbeddingCache(embeddings, get_query_embedding_cache())
+        st.session_state.qa_query_embeddings = cached
+    return cached
+
+
+def show_rerun_latency(setup_seconds, total_seconds):
+    # 再実行ごとのモデル・チェーン・リトリーバーの準備時間とスクリプト全体の時間
+    history = st.session_state.setdefault("qa_rerun_latency", deque(maxlen=RERUN_HISTORY))
+    history.append((setup_seconds, total_seconds))
+    setups = sorted(s for s, _ in history)
+    totals = sorted(t for _, t in history)
+    st.sidebar.caption(
+        f"Rerun: setup {setup_seconds * 1000:.1f} ms, total {total_seconds * 1000:.0f} ms "
+        f"(median of last {len(history)}: setup {setups[len(setups) // 2] * 1000:.1f} ms, "
+        f"total {totals[len(totals) // 2] * 1000:.0f} ms)"
+    )
+
+
+def page_ask_my_pdf(service):
+    started = time.perf_counter()
+    llm, chain = init_qa_chain()
+    mode = select_retrieval_mode()
+    query_embeddings = get_query_embeddings(service)
+    retriever = init_retriever(mode, query_embeddings, service, k=10)
+    answer_cache = get_answer_cache()
+    setup_seconds = time.perf_counter() - started
 
     if query := st.text_input("PDFへの質問を書いてね: ", key="input"):
         st.markdown("## Answer")
-        st.write_stream(chain.stream(query))
+        scope = cache_scope(llm, mode, service)
+        # 埋め込みを使わずに答えるクエリは、完全一致でだけ回答キャッシュを引く
+        use_vector = mode != "lexical" and not is_keyword_query(query)
+        embed_query = query_embeddings.embed_query if use_vector else None
+        cached = answer_cache.lookup(scope, query, embed_query)
+        if cached:
+            st.write(cached.answer)
+            st.caption(f"Cached answer for「{cached.question}」(similarity {cached.similarity:.3f})")
+        else:
+            # バックグラウンドで登録中なら、チャンクの追加と検索が重ならないようにロックを取る
+            with st.session_state.get("vectorstore_lock") or nullcontext():
+                docs = retriever.invoke(query)
+            # 重複したチャンクを落とし、モデルごとのトークン予算まで詰める (context_packing.py)
+            context = pack_context(docs, context_budget(model_name(llm)))
+            answer = st.write_stream(chain.stream({"context": context.text, "question": query}))
+            st.caption(
+                f"Context: {len(context.docs)}/{len(docs)} chunks, {context.tokens:,} tokens "
+                f"({context.saved_tokens:,} tokens saved vs. all {len(docs)} chunks; "
+                f"{context.duplicates} duplicates, {context.over_budget} over budget)"
+            )
+            answer_cache.store(
+                scope,
+                query,
+                embed_query(query) if embed_query else None,
+                [chunk_hash(doc.page_content) for doc in context.docs],
+                answer,
+            )
+    show_cache_stats(query_embeddings.cache, answer_cache)
+    show_rerun_latency(setup_seconds, time.perf_counter() - started)
+
+
+def show_ingest_status(job):
+    if job is not None and not job.done:
+        st.info(
+            f"{job.name} を登録中です ({job.progress.pages_read}/{job.page_count} pages, "
+            f"{job.progress.chunks:,} chunks)。登録済みのチャンクから回答します"
+        )
 
 
 def main():
     init_page()
     st.title("PDF QA 🧐")
-    if "vectorstore" not in st.session_state:
+    # バックグラウンドで登録中のチャンクもここまでの分は検索できる (jobs.py)
+    job = sync_session(st.session_state)
+    show_ingest_status(job)
+    service = get_service_index(job)
+    if service is not None:
+        release_session_index()
+    else:
+        restore_session_index()
+    memory = session_memory()
+    memory.touch(st.session_state)
+    if "vectorstore" not in st.session_state and service is None:
         st.warning("まずは 📄 Upload PDF(s) からPDFファイルをアップロードしてね")
+    elif service is not None:
+        # 検索はサービスで行うので、書き出されたインデックスを読み戻す必要はない
+        page_ask_my_pdf(service)
     else:
-        page_ask_my_pdf()
+        with memory.use(st.session_state):
+            page_ask_my_pdf(service)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,46 @@
+import streamlit as st
+
+from session_memory import process_rss, session_memory
+
+
+MB = 1 << 20
+
+
+def init_page():
+    st.set_page_config(
+        page_title="Admin",
+        page_icon="🛠️"
+    )
+    st.sidebar.title("Options")
+
+
+def show_memory_usage():
+    # プロセス内の全セッションのインデックスのメモリ使用量 (session_memory.py)
+    stats = session_memory().stats()
+    st.header("Session indexes")
+    used, budget = stats["used"], stats["budget"]
+    st.progress(min(used / budget, 1.0) if budget else 0.0)
+    cols = st.columns(4)
+    cols[0].metric("In memory (est.)", f"{used / MB:,.1f} MB", f"budget {budget / MB:,.0f} MB",
+                   delta_color="off")
+    cols[1].metric("Spilled to disk", f'{stats["spilled"] / MB:,.1f} MB')
+    cols[2].metric("Evictions", stats["evictions"])
+    cols[3].metric("Reloads", stats["reloads"])
+    rss = process_rss()
+    if rss is not None:
+        st.caption(f"Process RSS: {rss / MB:,.1f} MB")
+    if stats["sessions"]:
+        st.dataframe(stats["sessions"], use_container_width=True)
+    else:
+        st.info("インデックスを持っているセッションはありません")
+
+
+def main():
+    init_page()
+    # ボタンを押すと再実行されて最新の値になる
+    st.sidebar.button("Refresh", key="refresh")
+    show_memory_usage()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+PDF QA のキャッシュ
+
+1段目: 正規化したクエリ → クエリの埋め込み
+2段目: 過去の (質問, 取得したチャンク, 回答) を質問の埋め込みで引く意味的な回答キャッシュ。
+      類似度がしきい値以上で、ドキュメントの集合とモデルが同じなら保存済みの回答を返す。
+どちらも TTL と最大件数 (LRU) で古いエントリを捨て、ヒット数を数える。
+"""
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+QUERY_CACHE_SIZE = 10_000
+QUERY_CACHE_TTL = 24 * 60 * 60
+ANSWER_CACHE_SIZE = 2_000
+ANSWER_CACHE_TTL = 6 * 60 * 60
+# これ以上のコサイン類似度なら同じ質問とみなす
+SIMILARITY_THRESHOLD = 0.95
+
+_TRAILING_PUNCTUATION = re.compile(r"[\s?？!！。.、,]+$")
+
+
+def normalize_query(query):
+    """ 全角半角・大文字小文字・空白・末尾の記号の違いを吸収する """
+    query = unicodedata.normalize("NFKC", query).lower()
+    query = " ".join(query.split())
+    return _TRAILING_PUNCTUATION.sub("", query)
+
+
+class TTLCache:
+    """ TTL 付きの LRU キャッシュ """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, key, count=True):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or time.monotonic() - item[0] > self.ttl:
+                self._items.pop(key, None)
+                self.misses += count
+                return None
+            self._items.move_to_end(key)
+            self.hits += count
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def items(self):
+        """ 期限切れでない (key, value) のスナップショット (ヒット数は数えない) """
+        now = time.monotonic()
+        with self._lock:
+            return [(k, v) for k, (t, v) in self._items.items() if now - t <= self.ttl]
+
+
+class QueryEmbeddingCache(Embeddings):
+    """
+    1段目: クエリの埋め込みのキャッシュ。ドキュメントの埋め込みはそのまま委譲する
+    cache (TTLCache) を渡すと複数のセッションでキャッシュを共有できる
+    """
+
+    def __init__(self, embeddings, cache=None):
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, "model", type(embeddings).__name__)
+        self.cache = cache or TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        key = (self.model, normalize_query(text))
+        vector = self.cache.get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put(key, vector)
+        return vector
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    chunk_ids: list
+    answer: str
+    similarity: float = 1.0
+
+
+class SemanticAnswerCache:
+    """ 2段目: 意味的な回答キャッシュ """
+
+    def __init__(self, max_entries=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL,
+                 threshold=SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        # キーは (scope, 正規化した質問)。値は (単位ベクトル or None, CachedAnswer)
+        self.cache = TTLCache(max_entries, ttl)
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.exact_hits + self.semantic_hits + self.misses
+        return (self.exact_hits + self.semantic_hits) / total if total else 0.0
+
+    def lookup(self, scope, query, embed_query=None):
+        """
+        scope (ドキュメントの集合・モデルなど) が同じエントリから回答を探す
+        正規化した質問が完全に一致すれば埋め込みなしで返す。
+        一致しなければ embed_query(query) で埋め込みを求めて類似の質問を探す
+        """
+        exact = self.cache.get((scope, normalize_query(query)), count=False)
+        if exact is not None:
+            self.exact_hits += 1
+            return exact[1]
+        if embed_query is not None:
+            entries = [
+                value for (s, _), value in self.cache.items()
+                if s == scope and value[0] is not None
+            ]
+            if entries:
+                # 件数は小さいので、行列積で全件のコサイン類似度を一度に計算する
+                similarities = np.vstack([v for v, _ in entries]) @ _unit(embed_query(query))
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.semantic_hits += 1
+                    answer = entries[best][1]
+                    return CachedAnswer(
+                        answer.question, answer.chunk_ids, answer.answer,
+                        float(similarities[best]),
+                    )
+        self.misses += 1
+        return None
+
+    def store(self, scope, query, query_vector, chunk_ids, answer):
+        """ query_vector が無い (埋め込みを使わずに答えた) 場合は完全一致でだけ引ける """
+        vector = _unit(query_vector) if query_vector is not None else None
+        self.cache.put(
+            (scope, normalize_query(query)),
+            (vector, CachedAnswer(query, list(chunk_ids), answer)),
+        )
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
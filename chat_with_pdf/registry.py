@@ -0,0 +1,91 @@
+"""
+ベクトルストアに登録したドキュメントの台帳
+
+ドキュメント (ファイル名) ごとに、ファイルのハッシュと
+チャンクの ID・内容のハッシュ・ページ番号を記録する。
+これを使って、変更のないファイルはスキップし、改訂されたファイルは
+変わったチャンクだけを埋め込み直し、削除したファイルのチャンクだけを取り除く。
+"""
+import hashlib
+import json
+
+
+def fingerprint(hashes):
+    """ ファイルのハッシュの集合が同じなら (順序に関わらず) 同じ値になる """
+    digest = hashlib.sha256()
+    for sha256 in sorted(hashes):
+        digest.update(sha256.encode())
+    return digest.hexdigest()
+
+
+class DocumentRegistry:
+    def __init__(self, documents=None):
+        self.documents = {doc["name"]: doc for doc in documents or []}
+
+    def __contains__(self, name):
+        return name in self.documents
+
+    def is_unchanged(self, name, sha256):
+        doc = self.documents.get(name)
+        return doc is not None and doc["sha256"] == sha256
+
+    def reusable_chunks(self, name):
+        """ 同名ドキュメントの既存チャンクを {内容のハッシュ: [ID, ...]} で返す """
+        reuse = {}
+        for chunk_id, chunk_hash, _ in self.documents.get(name, {}).get("chunks", []):
+            reuse.setdefault(chunk_hash, []).append(chunk_id)
+        return reuse
+
+    def stale_chunks(self, name, records):
+        """ 登録済みの版のチャンクのうち、records (新しい版) で使われないものの ID を返す """
+        old = self.documents.get(name)
+        if old is None:
+            return []
+        kept = {r[0] for r in records}
+        return [c[0] for c in old["chunks"] if c[0] not in kept]
+
+    def put(self, name, sha256, pages, records):
+        """
+        ドキュメントを登録 (置き換え) し、新しい版で使われなくなったチャンク ID を返す
+        records は (id, hash, page) のリスト
+        """
+        stale_ids = self.stale_chunks(name, records)
+        self.documents[name] = {
+            "name": name,
+            "sha256": sha256,
+            "pages": pages,
+            "chunks": [list(r) for r in records],
+        }
+        return stale_ids
+
+    def remove(self, name):
+        """ ドキュメントを台帳から外し、そのチャンク ID を返す """
+        doc = self.documents.pop(name, None)
+        return [c[0] for c in doc["chunks"]] if doc else []
+
+    def page_span(self, name):
+        pages = [c[2] for c in self.documents[name]["chunks"]]
+        return (min(pages), max(pages)) if pages else (0, 0)
+
+    def fingerprint(self):
+        """ 登録されているドキュメントの集合 (と各版) が同じなら同じ値になる """
+        return fingerprint(doc["sha256"] for doc in self.documents.values())
+
+    def summary(self):
+        """ manifest に載せる概要 (チャンクの一覧は含めない) """
+        return [
+            {
+                "name": doc["name"],
+                "sha256": doc["sha256"],
+                "pages": doc["pages"],
+                "chunks": len(doc["chunks"]),
+            }
+            for doc in self.documents.values()
+        ]
+
+    def dump(self, f):
+        json.dump(list(self.documents.values()), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, f):
+        return cls(json.load(f))
@@ -0,0 +1,472 @@
+"""
+検索サービス
+
+保存済みインデックスを1つのプロセスで持ち、クエリの埋め込みと検索を引き受ける。
+Streamlit のセッションやサーバープロセスごとに FAISS を持たなくて済み、
+同時に来たクエリは SearchBatcher で1回の index.search にまとめる。
+
+    python retrieval_service.py [--host 127.0.0.1] [--port 8765]
+    python retrieval_service.py --socket /tmp/chat_with_pdf.sock
+
+PDF QA のページは環境変数 CHAT_WITH_PDF_RETRIEVAL_SERVICE
+(例: http://127.0.0.1:8765, unix:///tmp/chat_with_pdf.sock) が設定されていれば、
+このサービスに問い合わせるだけの薄いクライアント (ServiceRetriever) になる。
+
+    GET  /health                 読み込み済みのインデックス
+    GET  /indexes/<name>         インデックスの情報 (version, ntotal, kind, ...)
+    POST /embed  {index, query}  クエリの埋め込み
+    POST /search {index, query, k, mode, nprobe, ef_search}  チャンクのリスト
+"""
+import argparse
+import http.client
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, List, Optional
+from urllib.parse import quote, unquote, urlsplit
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+from bm25 import BM25Index
+from embedding_backends import backend_for_model, create_embeddings
+from faiss_index import index_kind
+from index_store import load_index, load_lexical_index, read_manifest
+from qa_cache import QueryEmbeddingCache
+from retrievers import FaissRetriever, HybridRetriever, MMRRetriever
+
+
+SERVICE_URL = os.environ.get("CHAT_WITH_PDF_RETRIEVAL_SERVICE")
+DEFAULT_PORT = 8765
+MODES = ("hybrid", "vector", "mmr", "lexical")
+# 1回の search にまとめる最大クエリ数と、まとめるために待つ時間
+MAX_BATCH = 64
+BATCH_WINDOW = 0.002
+# manifest を見てインデックスが再保存されていないか確認する間隔
+RELOAD_INTERVAL = 2.0
+CLIENT_TIMEOUT = 30
+
+
+class UnknownIndex(KeyError):
+    pass
+
+
+def _params_key(params):
+    if params is None:
+        return None
+    return type(params).__name__, getattr(params, "nprobe", None), getattr(params, "efSearch", None)
+
+
+class SearchBatcher:
+    """
+    faiss のインデックスと同じ search / search_and_reconstruct を持ち、
+    同時に呼ばれたクエリを BATCH_WINDOW の間集めて1回の呼び出しにまとめる
+    (faiss は複数のクエリを1回で検索する方が速く、内部でスレッド並列にもなる)
+    """
+
+    def __init__(self, index, max_batch=MAX_BATCH, window=BATCH_WINDOW):
+        self.index = index
+        self.max_batch = max_batch
+        self.window = window
+        self.batches = 0
+        self.queries = 0
+        self._requests = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _submit(self, op, x, k, params):
+        x = np.asarray(x, dtype=np.float32)
+        with self._lock:
+            future = None if self._closed else Future()
+            if future is not None:
+                self._requests.put((op, x, k, params, future))
+        if future is None:
+            # インデックスが読み込み直された後に古いものへ来たクエリはそのまま検索する
+            return getattr(self.index, op)(x, k, params=params)
+        return future.result()
+
+    def search(self, x, k, params=None):
+        return self._submit("search", x, k, params)
+
+    def search_and_reconstruct(self, x, k, params=None):
+        return self._submit("search_and_reconstruct", x, k, params)
+
+    def close(self):
+        """ 受け付け済みのクエリを処理してからスレッドを終える """
+        with self._lock:
+            self._closed = True
+            self._requests.put(None)
+
+    def _collect(self):
+        first = self._requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self._requests.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while (batch := self._collect()) is not None:
+            # 操作と探索パラメータが同じものごとにまとめて検索する
+            groups = {}
+            for request in batch:
+                groups.setdefault((request[0], _params_key(request[3])), []).append(request)
+            for (op, _), requests in groups.items():
+                self._execute(op, requests)
+
+    def _execute(self, op, requests):
+        try:
+            x = np.vstack([r[1] for r in requests])
+            k = max(r[2] for r in requests)
+            results = getattr(self.index, op)(x, k, params=requests[0][3])
+            self.batches += 1
+            self.queries += len(requests)
+        except Exception as e:
+            for request in requests:
+                request[4].set_exception(e)
+            return
+        row = 0
+        for _, rx, rk, _, future in requests:
+            n = len(rx)
+            future.set_result(tuple(r[row:row + n, :rk] for r in results))
+            row += n
+
+
+class _LoadedIndex:
+    def __init__(self, name, manifest, query_embeddings):
+        self.name = name
+        self.version = manifest["version"]
+        self.embedding_model = manifest.get("embedding_model")
+        self.vectorstore = load_index(name, query_embeddings.embeddings)
+        self.lexical_index = load_lexical_index(name) or BM25Index.from_vectorstore(self.vectorstore)
+        self.query_embeddings = query_embeddings
+        self.batcher = SearchBatcher(self.vectorstore.index)
+        self.checked = time.monotonic()
+
+    def info(self):
+        index = self.vectorstore.index
+        return {
+            "name": self.name,
+            "version": self.version,
+            "ntotal": index.ntotal,
+            "dimension": index.d,
+            "index_kind": index_kind(index),
+            "embedding_model": self.embedding_model,
+            "batches": self.batcher.batches,
+            "queries": self.batcher.queries,
+        }
+
+    def retriever(self, mode, k, nprobe=None, ef_search=None):
+        common = dict(
+            vectorstore=self.vectorstore, query_embeddings=self.query_embeddings, k=k,
+            nprobe=nprobe, ef_search=ef_search, searcher=self.batcher,
+        )
+        if mode == "vector":
+            return FaissRetriever(**common)
+        if mode == "mmr":
+            return MMRRetriever(**common)
+        return HybridRetriever(
+            lexical_index=self.lexical_index, lexical_only=(mode == "lexical"), **common
+        )
+
+
+class RetrievalService:
+    def __init__(self):
+        self._indexes = {}
+        # 埋め込み (とクエリの埋め込みのキャッシュ) はバックエンドごとに1つを共有する
+        self._query_embeddings = {}
+        self._lock = threading.Lock()
+
+    def _embeddings_for(self, model):
+        backend = backend_for_model(model)
+        if backend not in self._query_embeddings:
+            self._query_embeddings[backend] = QueryEmbeddingCache(create_embeddings(backend))
+        return self._query_embeddings[backend]
+
+    def loaded(self):
+        return list(self._indexes)
+
+    def get(self, name):
+        """ 読み込み済みのインデックスを返す。再保存されていれば読み込み直す """
+        entry = self._indexes.get(name)
+        if entry is not None and time.monotonic() - entry.checked < RELOAD_INTERVAL:
+            return entry
+        with self._lock:
+            entry = self._indexes.get(name)
+            manifest = read_manifest(name)
+            if manifest is None:
+                raise UnknownIndex(name)
+            if entry is None or entry.version != manifest["version"]:
+                query_embeddings = self._embeddings_for(manifest.get("embedding_model"))
+                old, entry = entry, _LoadedIndex(name, manifest, query_embeddings)
+                self._indexes[name] = entry
+                if old is not None:
+                    old.batcher.close()
+            entry.checked = time.monotonic()
+            return entry
+
+    def embed(self, name, query):
+        return self.get(name).query_embeddings.embed_query(query)
+
+    def search(self, name, query, k=10, mode="hybrid", nprobe=None, ef_search=None):
+        if mode not in MODES:
+            raise ValueError(f"unknown mode: {mode}")
+        entry = self.get(name)
+        docs = entry.retriever(mode, k, nprobe, ef_search).invoke(query)
+        return entry.version, docs
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # Unix ソケットでは client_address が空文字列になる
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, func):
+        try:
+            self._send(200, func())
+        except UnknownIndex as e:
+            self._send(404, {"error": f"unknown index: {e.args[0]}"})
+        except (ValueError, KeyError, TypeError) as e:
+            self._send(400, {"error": str(e)})
+        except Exception as e:
+            self._send(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def do_GET(self):
+        service = self.server.service
+        path = urlsplit(self.path).path
+        if path == "/health":
+            self._handle(lambda: {"status": "ok", "indexes": service.loaded()})
+        elif path.startswith("/indexes/"):
+            name = unquote(path[len("/indexes/"):])
+            self._handle(lambda: service.get(name).info())
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        service = self.server.service
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError as e:
+            self._send(400, {"error": str(e)})
+            return
+        path = urlsplit(self.path).path
+        if path == "/embed":
+            self._handle(lambda: {"vector": service.embed(body["index"], body["query"])})
+        elif path == "/search":
+            self._handle(lambda: _search_response(service, body))
+        else:
+            self._send(404, {"error": "not found"})
+
+
+def _search_response(service, body):
+    version, docs = service.search(
+        body["index"], body["query"],
+        k=int(body.get("k", 10)),
+        mode=body.get("mode", "hybrid"),
+        nprobe=body.get("nprobe"),
+        ef_search=body.get("ef_search"),
+    )
+    return {
+        "version": version,
+        "documents": [{"page_content": d.page_content, "metadata": d.metadata} for d in docs],
+    }
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None, verbose=False):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = _UnixHTTPServer(socket_path, _Handler)
+    else:
+        server = ThreadingHTTPServer((host, port), _Handler)
+        server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class RetrievalServiceError(RuntimeError):
+    pass
+
+
+class RetrievalClient:
+    """ 検索サービスのクライアント。接続はスレッドごとに使い回す (keep-alive) """
+
+    def __init__(self, url=SERVICE_URL, timeout=CLIENT_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            parts = urlsplit(self.url)
+            if parts.scheme == "unix":
+                conn = _UnixHTTPConnection(parts.path, self.timeout)
+            else:
+                conn = http.client.HTTPConnection(
+                    parts.hostname, parts.port or DEFAULT_PORT, timeout=self.timeout
+                )
+            self._local.conn = conn
+        return conn
+
+    def _request(self, method, path, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        headers = {"Content-Type": "application/json"} if data else {}
+        # サーバー側で keep-alive の接続が切れていた場合は1回だけつなぎ直す
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+                payload = json.loads(response.read() or b"{}")
+                break
+            except (ConnectionError, http.client.HTTPException, OSError):
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+        if response.status != 200:
+            raise RetrievalServiceError(payload.get("error", f"HTTP {response.status}"))
+        return payload
+
+    def health(self):
+        return self._request("GET", "/health")
+
+    def index_info(self, name):
+        return self._request("GET", f"/indexes/{quote(name)}")
+
+    def embed_query(self, name, query):
+        return self._request("POST", "/embed", {"index": name, "query": query})["vector"]
+
+    def search(self, name, query, k=10, mode="hybrid", nprobe=None, ef_search=None):
+        payload = self._request("POST", "/search", {
+            "index": name, "query": query, "k": k, "mode": mode,
+            "nprobe": nprobe, "ef_search": ef_search,
+        })
+        return [Document(**doc) for doc in payload["documents"]]
+
+
+class ServiceEmbeddings(Embeddings):
+    """ クエリの埋め込みをサービスに求める (チャンクの埋め込みには使わない) """
+
+    def __init__(self, client, index_name, model):
+        self.client = client
+        self.index_name = index_name
+        self.model = model
+
+    def embed_documents(self, texts):
+        raise NotImplementedError("documents are embedded when they are uploaded")
+
+    def embed_query(self, text):
+        return self.client.embed_query(self.index_name, text)
+
+
+class ServiceRetriever(BaseRetriever):
+    """ 検索サービスに問い合わせるだけのリトリーバー (セッションは FAISS を持たない) """
+    client: Any
+    index_name: str
+    mode: str = "hybrid"
+    k: int = 10
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self.client.search(
+            self.index_name, query, k=self.k, mode=self.mode,
+            nprobe=self.nprobe, ef_search=self.ef_search,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--socket", help="Unix ソケットのパス (指定すると HTTP のポートは使わない)")
+    parser.add_argument("--preload", nargs="*", default=[], help="起動時に読み込むインデックス")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    # dotenv を利用しない場合は環境変数を設定してください (OpenAI の埋め込みを使う場合)
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+
+    service = RetrievalService()
+    for name in args.preload:
+        service.get(name)
+    server = make_server(service, args.host, args.port, args.socket, args.verbose)
+    where = args.socket or f"http://{args.host}:{args.port}"
+    print(f"Retrieval service listening on {where}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""
+PDF QA 用のリトリーバー
+
+LangChain の VectorStoreRetriever は index.search に探索パラメータを渡せないので、
+nprobe (IVF) や efSearch (HNSW) をクエリごとに指定できるリトリーバーを用意する。
+HybridRetriever はベクトル検索と BM25 の順位を Reciprocal Rank Fusion で統合する。
+MMRRetriever は多めに取った候補から、似たチャンクばかりにならないように選び直す。
+searcher を渡すと、index.search の代わりにそのオブジェクトの search を呼ぶ
+(検索サービスで複数のクエリを1回の検索にまとめるため。retrieval_service.py)。
+"""
+import re
+from typing import Any, List, Optional
+
+import faiss
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from faiss_index import search_params
+
+
+# MMR で FAISS から取る候補の数と、関連度と多様性の重み (1 に近いほど関連度を重視)
+MMR_FETCH_K = 200
+MMR_LAMBDA = 0.5
+# Reciprocal Rank Fusion の定数 (一般的な値)
+RRF_K = 60
+# 語彙検索だけで済ませるクエリの最大語数
+KEYWORD_QUERY_MAX_TERMS = 4
+# 型番・条項番号・バージョンなど、数字を含む語
+_IDENTIFIER = re.compile(r"[a-z0-9\-_./:]*\d[a-z0-9\-_./:]*")
+_QUESTION = re.compile(
+    r"[?？]|\b(what|why|how|when|where|who|which)\b|(とは|ですか|ますか|なぜ|どう|何|教えて)"
+)
+
+
+def _query_matrix(vectorstore, query_vector):
+    x = np.asarray([query_vector], dtype=np.float32)
+    if vectorstore._normalize_L2:
+        faiss.normalize_L2(x)
+    return x
+
+
+def search_ids_by_vector(vectorstore, query_vector, k, nprobe=None, ef_search=None,
+                         searcher=None):
+    """ (チャンクID, L2距離) のリストを近い順に返す """
+    x = _query_matrix(vectorstore, query_vector)
+    params = search_params(vectorstore.index, nprobe=nprobe, ef_search=ef_search)
+    scores, indices = (searcher or vectorstore.index).search(x, k, params=params)
+    return [
+        (vectorstore.index_to_docstore_id[i], float(score))
+        for score, i in zip(scores[0], indices[0])
+        if i != -1
+    ]
+
+
+def search_by_vector(vectorstore, query_vector, k, nprobe=None, ef_search=None, searcher=None):
+    """ (Document, L2距離) のリストを近い順に返す """
+    results = search_ids_by_vector(vectorstore, query_vector, k, nprobe, ef_search, searcher)
+    return [(vectorstore.docstore.search(_id), score) for _id, score in results]
+
+
+def _embed_query(retriever, query):
+    embeddings = retriever.query_embeddings or retriever.vectorstore.embedding_function
+    return embeddings.embed_query(query)
+
+
+class FaissRetriever(BaseRetriever):
+    vectorstore: Any
+    k: int = 10
+    # クエリの埋め込みに使う Embeddings (キャッシュ付きのものなど)。省略時はベクトルストアのもの
+    query_embeddings: Any = None
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+    searcher: Any = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        query_vector = _embed_query(self, query)
+        results = search_by_vector(
+            self.vectorstore, query_vector, self.k,
+            nprobe=self.nprobe, ef_search=self.ef_search, searcher=self.searcher,
+        )
+        return [doc for doc, _ in results]
+
+
+def search_candidates(vectorstore, query_vector, fetch_k, nprobe=None, ef_search=None,
+                      searcher=None):
+    """
+    (チャンクIDのリスト, 候補のベクトル, クエリのベクトル) を返す
+    候補のベクトルは検索と同時に復元する (IVF-PQ / int8 などでは量子化後の近似値)
+    """
+    x = _query_matrix(vectorstore, query_vector)
+    params = search_params(vectorstore.index, nprobe=nprobe, ef_search=ef_search)
+    searcher = searcher or vectorstore.index
+    _, indices, vectors = searcher.search_and_reconstruct(x, fetch_k, params=params)
+    found = indices[0] != -1
+    ids = [vectorstore.index_to_docstore_id[i] for i in indices[0][found]]
+    return ids, vectors[0][found], x[0]
+
+
+def mmr_select(query_vector, vectors, k, lambda_mult=MMR_LAMBDA):
+    """
+    Maximal Marginal Relevance で選んだ候補の位置を選んだ順に返す
+    選ぶたびに、選んだ1件と全候補のコサイン類似度を行列ベクトル積で求めて
+    「選択済みとの最大類似度」のベクトルを更新する (ペアごとのループはしない)。
+    候補同士の類似度を全部 (n x n) 求めるより、選ぶ k 件の分 (k x n) だけで済む。
+    行列を正規化したコピーは作らず、内積をノルムで割る。
+    選ぶたびの計算は確保済みのバッファの中で行い、最後の1件を選んだ後の積は省く
+    (1コア・1536次元・k=10 で 300 候補あたり 1ms 前後。時間の大半は k 回の行列ベクトル積)
+    """
+    n = len(vectors)
+    if n == 0 or k <= 0:
+        return []
+    vectors = np.asarray(vectors, dtype=np.float32)
+    query_vector = np.asarray(query_vector, dtype=np.float32)
+    inv_norms = np.sqrt(np.einsum("ij,ij->i", vectors, vectors))
+    inv_norms[inv_norms == 0] = 1
+    np.reciprocal(inv_norms, out=inv_norms)
+    # 関連度に lambda_mult を掛けたもの (スコア = これ - (1 - lambda_mult) * 選択済みとの最大類似度)
+    relevance = vectors @ query_vector
+    relevance *= inv_norms * (lambda_mult / (np.linalg.norm(query_vector) or 1))
+    redundancy = np.full(n, -np.inf, dtype=np.float32)
+    similarity = np.empty(n, dtype=np.float32)
+    scores = np.empty(n, dtype=np.float32)
+    selected = []
+    # 1件目は関連度が最大のもの
+    best = int(np.argmax(relevance))
+    for _ in range(min(k, n) - 1):
+        selected.append(best)
+        np.matmul(vectors, vectors[best], out=similarity)
+        similarity *= inv_norms
+        similarity *= inv_norms[best]
+        np.maximum(redundancy, similarity, out=redundancy)
+        np.multiply(redundancy, lambda_mult - 1, out=scores)
+        scores += relevance
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+    selected.append(best)
+    return selected
+
+
+class MMRRetriever(BaseRetriever):
+    vectorstore: Any
+    k: int = 10
+    query_embeddings: Any = None
+    fetch_k: int = MMR_FETCH_K
+    lambda_mult: float = MMR_LAMBDA
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+    searcher: Any = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        query_vector = _embed_query(self, query)
+        ids, vectors, x = search_candidates(
+            self.vectorstore, query_vector, self.fetch_k,
+            nprobe=self.nprobe, ef_search=self.ef_search, searcher=self.searcher,
+        )
+        selected = mmr_select(x, vectors, self.k, self.lambda_mult)
+        return [self.vectorstore.docstore.search(ids[i]) for i in selected]
+
+
+def is_keyword_query(query):
+    """ 型番や条項番号だけのような、語彙検索だけで答えられそうなクエリかどうか """
+    if _QUESTION.search(query.lower()):
+        return False
+    query = query.lower()
+    words = query.split()
+    if not words or len(words) > KEYWORD_QUERY_MAX_TERMS:
+        return False
+    return _IDENTIFIER.search(query) is not None
+
+
+def reciprocal_rank_fusion(rankings, rrf_k=RRF_K):
+    """ 複数の ID のランキングを統合し、スコアの高い順の ID のリストを返す """
+    scores = {}
+    for ranking in rankings:
+        for rank, _id in enumerate(ranking, start=1):
+            scores[_id] = scores.get(_id, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class HybridRetriever(BaseRetriever):
+    vectorstore: Any
+    lexical_index: Any
+    k: int = 10
+    query_embeddings: Any = None
+    # それぞれの検索から統合前に取り出す件数
+    fetch_k: int = 30
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+    # キーワード的なクエリは埋め込みを呼ばずに BM25 だけで返す
+    lexical_fast_path: bool = True
+    # 常に BM25 だけで返す
+    lexical_only: bool = False
+    searcher: Any = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _documents(self, ids):
+        return [self.vectorstore.docstore.search(_id) for _id in ids[:self.k]]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        lexical = [_id for _id, _ in self.lexical_index.search(query, self.fetch_k)]
+        if self.lexical_only or (self.lexical_fast_path and lexical and is_keyword_query(query)):
+            return self._documents(lexical)
+
+        query_vector = _embed_query(self, query)
+        vector = search_ids_by_vector(
+            self.vectorstore, query_vector, self.fetch_k,
+            nprobe=self.nprobe, ef_search=self.ef_search, searcher=self.searcher,
+        )
+        fused = reciprocal_rank_fusion([[_id for _id, _ in vector], lexical])
+        return self._documents(fused)
@@ -0,0 +1,334 @@
+"""
+セッションごとのインデックスのメモリ管理
+
+閉じられたタブのセッションも、サーバーが再起動するまで session_state (とベクトルストア) を
+持ち続ける。ここではプロセス全体のメモリ予算を決め、各セッションのベクトルストアと
+BM25 インデックスの推定サイズを最後に使われた順に管理する。予算を超えたら、最も長く
+使われていないセッションのものをディスク (SPILL_DIR) に書き出してオブジェクトの中身を空にする。
+オブジェクト自体は session_state やリトリーバーに残るので、そのセッションが次にページを
+開いたとき (use) に同じオブジェクトへ読み戻せば、呼び出し側は書き出されたことを意識しなくてよい。
+
+保存済みインデックスを読み込んだだけの共有オブジェクト (vectorstore_shared) は全セッションで
+1つなので対象外にする。登録中のジョブのベクトルストアも書き出さない。
+"""
+import os
+import pickle
+import shutil
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+import faiss
+from langchain_community.docstore.in_memory import InMemoryDocstore
+
+from compact_docstore import CompactDocstore
+from config import DATA_DIR
+from faiss_index import HNSW, HNSW_M, bytes_per_vector, index_kind
+from jobs import job_manager
+
+
+# セッションのインデックスに使ってよいメモリ (推定値の合計) の上限
+MEMORY_BUDGET = int(os.environ.get("CHAT_WITH_PDF_SESSION_MEMORY_MB", 2048)) << 20
+SPILL_DIR = os.path.join(DATA_DIR, "spill")
+SESSION_KEY = "memory_session_id"
+# 推定に使う1件あたりのおおよそのバイト数 (Python オブジェクトの管理領域を含む)
+DOCUMENT_OVERHEAD = 600
+# CompactDocstore の nbytes() に含まれない分 (ID の dict など)
+COMPACT_DOCUMENT_OVERHEAD = 128
+POSTING_BYTES = 100
+BM25_SLOT_BYTES = 200
+
+
+def _docstore_bytes(docstore, n):
+    if isinstance(docstore, CompactDocstore):
+        # テキストと配列の大きさはそのまま数えられる
+        return docstore.nbytes() + n * COMPACT_DOCUMENT_OVERHEAD
+    docs = getattr(docstore, "_dict", {}).values()
+    return sum(len(doc.page_content) for doc in docs) + n * DOCUMENT_OVERHEAD
+
+
+def estimate_bytes(vectorstore, lexical_index=None):
+    """ ベクトルストアと BM25 インデックスが使うメモリのおおよそのバイト数 """
+    index = vectorstore.index
+    n = index.ntotal
+    total = n * bytes_per_vector(index)
+    if index_kind(index) == HNSW:
+        # レベル0の隣接リスト (2M 本の int32)
+        total += n * HNSW_M * 2 * 4
+    total += _docstore_bytes(vectorstore.docstore, n)
+    if lexical_index is not None:
+        total += sum(map(len, lexical_index.postings.values())) * POSTING_BYTES
+        total += len(lexical_index.slot_ids) * BM25_SLOT_BYTES
+    return total
+
+
+def process_rss():
+    """ このプロセスの常駐メモリ (バイト)。/proc が無い環境では None """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _Entry:
+    def __init__(self, session_id):
+        self.session_id = session_id
+        # 書き出し・読み戻し・検索の間はこのロックを持つ
+        self.lock = threading.Lock()
+        self.vectorstore = None
+        self.lexical_index = None
+        self.index_name = None
+        self.size_key = None
+        self.bytes = 0
+        self.last_used = time.time()
+        # 登録中のジョブが追加のたびに取るロック (state["vectorstore_lock"])
+        self.vectorstore_lock = None
+        self.spilled = False
+
+    def alive(self):
+        return self.vectorstore is not None and self.vectorstore() is not None
+
+    def ingesting(self):
+        """
+        登録中のジョブがこのベクトルストアを書き換えているか
+        セッションが最後に開いたときの ingest_job_id ではなく、ジョブそのものを見る
+        (投入直後でまだ state に反映されていない場合や、登録中にタブが閉じられた場合のため)
+        """
+        vectorstore = self.vectorstore() if self.vectorstore else None
+        return vectorstore is not None and job_manager().running_on(vectorstore) is not None
+
+
+class SessionMemoryManager:
+    def __init__(self, budget=MEMORY_BUDGET, spill_dir=None):
+        self.budget = budget
+        # 同じデータディレクトリを複数のサーバープロセスで使ってもぶつからないよう、pid ごとに分ける
+        self.spill_dir = spill_dir or os.path.join(SPILL_DIR, str(os.getpid()))
+        self.evictions = 0
+        self.reloads = 0
+        # session_id → _Entry (最後に使われた順。先頭が最も古い)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._remove_stale_spills()
+
+    def _remove_stale_spills(self):
+        # 終了したプロセスが残した書き出しファイルを消す
+        parent = os.path.dirname(self.spill_dir)
+        if not os.path.isdir(parent):
+            return
+        for name in os.listdir(parent):
+            path = os.path.join(parent, name)
+            if name.isdigit() and (int(name) == os.getpid() or not _pid_alive(int(name))):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _path(self, entry):
+        return os.path.join(self.spill_dir, entry.session_id)
+
+    def _remove_files(self, entry):
+        for suffix in (".faiss", ".pkl"):
+            try:
+                os.unlink(self._path(entry) + suffix)
+            except FileNotFoundError:
+                pass
+
+    def _track(self, state):
+        """ セッションのエントリを LRU の末尾に移して返す。管理対象のベクトルストアが無ければ None """
+        session_id = state.get(SESSION_KEY)
+        if session_id is None:
+            session_id = state[SESSION_KEY] = uuid.uuid4().hex
+        vectorstore = state.get("vectorstore")
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if vectorstore is None or state.get("vectorstore_shared"):
+                if entry is not None:
+                    del self._entries[session_id]
+                    self._remove_files(entry)
+                return None
+            if entry is None:
+                entry = self._entries[session_id] = _Entry(session_id)
+            entry.index_name = state.get("index_name")
+            entry.vectorstore_lock = state.get("vectorstore_lock")
+            entry.last_used = time.time()
+            self._entries.move_to_end(session_id)
+        return entry
+
+    def _attach(self, entry, state):
+        """ state のオブジェクトをエントリに結び付ける (entry.lock の中で呼ぶ) """
+        vectorstore, lexical_index = state.get("vectorstore"), state.get("lexical_index")
+        if entry.vectorstore is None or entry.vectorstore() is not vectorstore:
+            # 作り直されたかコピーされた。前のオブジェクトの書き出しはもう要らない
+            if entry.spilled:
+                self._remove_files(entry)
+                entry.spilled = False
+            entry.vectorstore = weakref.ref(vectorstore)
+            entry.size_key = None
+        if not entry.spilled:
+            entry.lexical_index = weakref.ref(lexical_index) if lexical_index is not None else None
+
+    def _measure(self, entry, state):
+        vectorstore = entry.vectorstore()
+        lexical_index = entry.lexical_index() if entry.lexical_index else None
+        # 登録中のジョブが書き換えている最中に docstore を数えないようにする
+        with state.get("vectorstore_lock") or nullcontext():
+            key = (vectorstore.index.ntotal, id(lexical_index), len(lexical_index or ()))
+            if key != entry.size_key:
+                entry.bytes = estimate_bytes(vectorstore, lexical_index)
+                entry.size_key = key
+
+    def touch(self, state):
+        """
+        セッションがページを開いたときに呼ぶ。最近使ったものとして記録し、
+        メモリ予算を超えていれば他の古いセッションのインデックスを書き出す
+        """
+        entry = self._track(state)
+        if entry is not None:
+            with entry.lock:
+                self._attach(entry, state)
+                if not entry.spilled:
+                    self._measure(entry, state)
+        self.enforce_budget(keep=entry)
+        return entry
+
+    @contextmanager
+    def use(self, state):
+        """ with の間はセッションのインデックスをメモリに置き、書き出さない (書き出されていれば読み戻す) """
+        entry = self._track(state)
+        if entry is None:
+            yield
+            return
+        with entry.lock:
+            self._attach(entry, state)
+            if entry.spilled:
+                self._reload(entry)
+                self._measure(entry, state)
+            yield
+
+    def enforce_budget(self, keep=None):
+        """ 予算を超えている分だけ、古いセッションから順に書き出す """
+        with self._lock:
+            self._prune()
+            over = self.used_bytes() - self.budget
+            candidates = [
+                e for e in self._entries.values() if e is not keep and not e.spilled
+            ]
+        for entry in candidates:
+            if over <= 0:
+                break
+            over -= self._spill(entry)
+
+    def _prune(self):
+        # セッションが無くなった (ベクトルストアが回収された) エントリを消す
+        for session_id, entry in list(self._entries.items()):
+            if entry.vectorstore is not None and not entry.alive():
+                del self._entries[session_id]
+                self._remove_files(entry)
+
+    def _spill(self, entry):
+        """ エントリのインデックスをディスクに書き出し、空いたバイト数を返す """
+        # 検索中や読み戻し中のものは飛ばす
+        if not entry.lock.acquire(blocking=False):
+            return 0
+        try:
+            vectorstore = entry.vectorstore() if entry.vectorstore else None
+            if entry.spilled or vectorstore is None or entry.ingesting():
+                return 0
+            # 終わったばかりのジョブがまだ追加の途中ということがないよう、ジョブのロックも取る
+            with entry.vectorstore_lock or nullcontext():
+                return self._write_spill(entry, vectorstore)
+        finally:
+            entry.lock.release()
+
+    def _write_spill(self, entry, vectorstore):
+        """ _spill の本体 (entry.lock とジョブのロックの中で呼ぶ) """
+        lexical_index = entry.lexical_index() if entry.lexical_index else None
+        path = self._path(entry)
+        os.makedirs(self.spill_dir, exist_ok=True)
+        index = vectorstore.index
+        faiss.write_index(index, path + ".faiss")
+        with open(path + ".pkl", "wb") as f:
+            lexical_state = vars(lexical_index) if lexical_index is not None else None
+            pickle.dump(
+                (vectorstore.docstore, vectorstore.index_to_docstore_id, lexical_state),
+                f, protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        # オブジェクトは残したまま中身だけを手放す
+        vectorstore.index = faiss.IndexFlat(index.d, index.metric_type)
+        vectorstore.docstore = InMemoryDocstore()
+        vectorstore.index_to_docstore_id = {}
+        if lexical_index is not None:
+            lexical_index.__init__()
+        entry.spilled = True
+        with self._lock:
+            self.evictions += 1
+        return entry.bytes
+
+    def _reload(self, entry):
+        """ 書き出したインデックスを元のオブジェクトに読み戻す (entry.lock の中で呼ぶ) """
+        vectorstore = entry.vectorstore()
+        lexical_index = entry.lexical_index() if entry.lexical_index else None
+        path = self._path(entry)
+        index = faiss.read_index(path + ".faiss")
+        with open(path + ".pkl", "rb") as f:
+            docstore, index_to_docstore_id, lexical_state = pickle.load(f)
+        vectorstore.index = index
+        vectorstore.docstore = docstore
+        vectorstore.index_to_docstore_id = index_to_docstore_id
+        if lexical_index is not None and lexical_state is not None:
+            vars(lexical_index).update(lexical_state)
+        self._remove_files(entry)
+        entry.spilled = False
+        with self._lock:
+            self.reloads += 1
+
+    def used_bytes(self):
+        return sum(e.bytes for e in self._entries.values() if not e.spilled)
+
+    def stats(self):
+        """ 管理画面に出す集計とセッションごとの状態 """
+        with self._lock:
+            self._prune()
+            now = time.time()
+            sessions = [
+                {
+                    "session": e.session_id[:8],
+                    "index": e.index_name,
+                    "state": "spilled" if e.spilled else "ingesting" if e.ingesting() else "in memory",
+                    "size_mb": e.bytes / (1 << 20),
+                    "idle_sec": now - e.last_used,
+                }
+                for e in reversed(self._entries.values())
+            ]
+            return {
+                "budget": self.budget,
+                "used": self.used_bytes(),
+                "spilled": sum(e.bytes for e in self._entries.values() if e.spilled),
+                "sessions": sessions,
+                "evictions": self.evictions,
+                "reloads": self.reloads,
+            }
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def session_memory():
+    """ プロセス内で共有する SessionMemoryManager (スクリプトの再実行をまたいで残る) """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = SessionMemoryManager()
+        return _manager
@@ -0,0 +1,126 @@
+"""
+トークン位置で一度に分割するテキストスプリッター
+
+RecursiveCharacterTextSplitter.from_tiktoken_encoder は区切り文字ごとに再帰しながら
+候補の断片を何度も tiktoken でエンコードする。
+ここでは文書を一度だけエンコードし、各トークンの文字位置を使って
+chunk_size トークン以内に収まる範囲で、段落 > 文 > 行 の順に区切りの良い位置で切る。
+"""
+import re
+import warnings
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from itertools import accumulate
+
+import tiktoken
+
+
+# 区切りの優先度 (大きいほど優先)
+_PARAGRAPH, _SENTENCE, _LINE = 3, 2, 1
+_BOUNDARY_PATTERN = re.compile(
+    r"(?P<paragraph>\n[ \t]*\n)|(?P<line>\n)|(?P<sentence>[。．！？!?]|\.(?=\s))"
+)
+_PRIORITIES = {"paragraph": _PARAGRAPH, "sentence": _SENTENCE, "line": _LINE}
+# チャンクが短くなりすぎないよう、この割合より手前では区切らない
+MIN_FILL = 0.5
+
+
+class ApproximateEncoding:
+    """
+    tiktoken のエンコーディングを取得できない (オフラインの) 環境での近似
+    CJK は1文字、英数字は前の空白と合わせて6文字までを1トークンとする (cl100k_base に近い数になる)
+    トークンは ID ではなく文字列のまま返す
+    """
+    name = "approximate"
+    _PIECE = re.compile(
+        r"[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]"
+        r"|[^\S\n]?\w{1,6}|\n+|[^\S\n]+|[^\w\s]"
+    )
+
+    def encode(self, text, disallowed_special=()):
+        return self._PIECE.findall(text)
+
+    def encode_batch(self, texts, disallowed_special=()):
+        return [self.encode(text) for text in texts]
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+    def decode_with_offsets(self, tokens):
+        return self.decode(tokens), [0, *accumulate(len(t) for t in tokens)][:len(tokens)]
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name="cl100k_base"):
+    """ tiktoken のエンコーディング。ファイルを取得できなければ ApproximateEncoding で代用する """
+    try:
+        return tiktoken.get_encoding(name)
+    except OSError as e:
+        # 事前に TIKTOKEN_CACHE_DIR にファイルを置いておけばオフラインでも tiktoken を使える
+        warnings.warn(f"tiktoken encoding {name} is unavailable ({e}); using an approximation")
+        return ApproximateEncoding()
+
+
+class TokenSplitter:
+    def __init__(self, chunk_size=500, chunk_overlap=0, encoding=None):
+        if chunk_overlap >= chunk_size:
+            raise ValueError("chunk_overlap must be smaller than chunk_size")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.encoding = encoding or get_encoding()
+
+    @classmethod
+    def from_model_name(cls, model_name, **kwargs):
+        return cls(encoding=get_encoding(tiktoken.encoding_name_for_model(model_name)), **kwargs)
+
+    def _boundaries(self, text, offsets):
+        """ 区切り位置を (トークン番号, 優先度) のリストでトークン順に返す """
+        boundaries = {}
+        for m in _BOUNDARY_PATTERN.finditer(text):
+            token = bisect_left(offsets, m.end())
+            priority = _PRIORITIES[m.lastgroup]
+            if boundaries.get(token, 0) < priority:
+                boundaries[token] = priority
+        tokens = sorted(boundaries)
+        return tokens, [boundaries[t] for t in tokens]
+
+    def _cut(self, start, boundary_tokens, boundary_priorities, n_tokens):
+        """ start から chunk_size 以内で最も区切りの良いトークン位置を返す """
+        end = start + self.chunk_size
+        if end >= n_tokens:
+            return n_tokens
+        lo = bisect_right(boundary_tokens, start + int(self.chunk_size * MIN_FILL))
+        hi = bisect_right(boundary_tokens, end)
+        best, best_priority = end, 0
+        # 同じ優先度なら後ろの区切りを選ぶ (チャンクをなるべく大きくする)
+        for i in range(lo, hi):
+            if boundary_priorities[i] >= best_priority:
+                best, best_priority = boundary_tokens[i], boundary_priorities[i]
+        return best
+
+    def split_with_offsets(self, text):
+        """ (チャンクのテキスト, 開始文字位置, 終了文字位置) のリストを返す """
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if not tokens:
+            return []
+        _, offsets = self.encoding.decode_with_offsets(tokens)
+        boundary_tokens, boundary_priorities = self._boundaries(text, offsets)
+
+        chunks, start, n_tokens = [], 0, len(tokens)
+        while start < n_tokens:
+            stop = self._cut(start, boundary_tokens, boundary_priorities, n_tokens)
+            begin_char = offsets[start]
+            end_char = offsets[stop] if stop < n_tokens else len(text)
+            # 前後の空白を落とし、文字位置もそれに合わせる
+            raw = text[begin_char:end_char]
+            stripped = raw.strip()
+            if stripped:
+                begin_char += len(raw) - len(raw.lstrip())
+                chunks.append((stripped, begin_char, begin_char + len(stripped)))
+            if stop >= n_tokens:
+                break
+            start = max(stop - self.chunk_overlap, start + 1)
+        return chunks
+
+    def split_text(self, text):
+        return [chunk for chunk, _, _ in self.split_with_offsets(text)]
@@ -0,0 +1,94 @@
+"""
+保存済みインデックスを使って、ベクトルの保存形式と docstore ごとの
+1チャンクあたりのメモリ使用量と検索の再現率を比較するレポート
+
+    python storage_report.py <index name> [--queries 200] [--k 10]
+
+比較の基準にするため、対象のインデックスは float32 のフラットインデックスであること。
+"""
+import argparse
+import json
+import tracemalloc
+
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
+
+from compact_docstore import CompactDocstore
+from faiss_index import (
+    FLAT, FLOAT32, STORAGE_TYPES, bytes_per_vector, index_kind, new_flat_index, storage_type
+)
+from index_store import load_index
+
+
+def _docstore_bytes(docstore_cls, docs):
+    """
+    docstore にチャンクを入れたときに増えた Python ヒープのバイト数
+    アップロード時と同じく、Document とテキストはこの中で作る
+    """
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    docstore = docstore_cls()
+    for i, doc in enumerate(docs):
+        text = doc.page_content.encode("utf-8").decode("utf-8")
+        docstore.add({str(i): Document(page_content=text, metadata=dict(doc.metadata))})
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del docstore
+    return after - before
+
+
+def _recall(exact, approx):
+    k = exact.shape[1]
+    hits = sum(len(set(e) & set(a)) for e, a in zip(exact, approx))
+    return hits / (len(exact) * k)
+
+
+def storage_report(vectors, docs, n_queries=200, k=10, seed=0):
+    rng = np.random.default_rng(seed)
+    n = len(vectors)
+    # 実際の質問に近づけるため、2つのチャンクの中間点をクエリにする
+    a, b = rng.integers(0, n, n_queries), rng.integers(0, n, n_queries)
+    queries = ((vectors[a] + vectors[b]) / 2).astype(np.float32)
+
+    exact = None
+    report = {"chunks": n, "k": k, "queries": n_queries, "vectors": {}, "docstore": {}}
+    for storage in STORAGE_TYPES:
+        index = new_flat_index(vectors.shape[1], storage)
+        if not index.is_trained:
+            index.train(vectors)
+        index.add(vectors)
+        _, found = index.search(queries, k)
+        if exact is None:
+            exact = found
+        report["vectors"][storage] = {
+            "bytes_per_chunk": bytes_per_vector(index),
+            f"recall@{k}": _recall(exact, found),
+        }
+
+    sample = docs[:2_000]
+    for name, cls in (("InMemoryDocstore", InMemoryDocstore), ("CompactDocstore", CompactDocstore)):
+        report["docstore"][name] = {
+            "bytes_per_chunk": _docstore_bytes(cls, sample) / max(len(sample), 1),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("name", help="保存済みインデックスの名前")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    vectorstore = load_index(args.name, embeddings=None, mmap=False)
+    index = vectorstore.index
+    if index_kind(index) != FLAT or storage_type(index) != FLOAT32:
+        raise SystemExit("float32 のフラットインデックスを指定してください")
+    vectors = index.reconstruct_n(0, index.ntotal)
+    docs = [vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]) for i in range(index.ntotal)]
+    print(json.dumps(storage_report(vectors, docs, args.queries, args.k), indent=2))
+
+
+if __name__ == '__main__':
+    main()
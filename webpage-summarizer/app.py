@@ -1,14 +1,15 @@
 import traceback
+from collections import Counter
 import streamlit as st
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
 from langchain_openai import ChatOpenAI
 from langchain_anthropic import ChatAnthropic
 from langchain_google_genai import ChatGoogleGenerativeAI
-import requests
-from bs4 import BeautifulSoup
 from urllib.parse import urlparse
 
+from fetch_cache import FetchCache
+from fetcher import Fetcher, FetchError
+from summarizer import MapReduceSummarizer, PartialSummary
+
 ###### dotenv を利用しない場合は消してください ######
 try:
     from dotenv import load_dotenv
@@ -39,9 +40,11 @@ def init_page():
     st.header("Webpage Summarizer 🌐📝")
 
 
-def select_model(temperature=0):
-    models = ("GPT-4o","GPT-4o-mini", "Claude 3.5 Sonnet", "Gemini 1.5 Pro")
-    model_choice = st.radio("Choose a model:", models)
+MODELS = ("GPT-4o","GPT-4o-mini", "Claude 3.5 Sonnet", "Gemini 1.5 Pro")
+
+
+def create_llm(model_choice, temperature=0):
+    # バッチ要約 (batch.py) からも使う
     if model_choice == "GPT-4o":
         return ChatOpenAI(temperature=temperature, model_name="gpt-4o")
     elif model_choice == "GPT-4o-mini":
@@ -52,14 +55,33 @@ def select_model(temperature=0):
         return ChatGoogleGenerativeAI(temperature=temperature, model="gemini-1.5-pro-latest")
 
 
-def init_chain():
+def select_model(temperature=0):
+    model_choice = st.radio("Choose a model:", MODELS)
+    return create_llm(model_choice, temperature)
+
+
+def init_summarizer():
     llm = select_model()
-    prompt = ChatPromptTemplate.from_messages([
-        ("user", SUMMARIZE_PROMPT),
-    ])
-    output_parser = StrOutputParser()
-    chain = prompt | llm | output_parser
-    return chain
+    # 長いコンテンツは分割して並列に要約してからまとめる (summarizer.py)
+    return MapReduceSummarizer(llm, SUMMARIZE_PROMPT)
+
+
+def stream_summary(summarizer, content):
+    """ チャンクごとの途中結果を表示しながら、最終的な要約のトークンを yield する """
+    status = None
+    finished = Counter()
+    for event in summarizer.stream(content):
+        if not isinstance(event, PartialSummary):
+            yield event
+            continue
+        if status is None:
+            status = st.status("Summarizing ...")
+        # 途中結果は終わった順に届くので、段ごとの完了数を数える
+        finished[event.stage, event.total] += 1
+        status.update(label=f"Summarizing ... ({event.stage} {finished[event.stage, event.total]}/{event.total})")
+        status.markdown(f"**{event.stage} {event.index}/{event.total}**\n\n{event.text}")
+    if status is not None:
+        status.update(label="Summarized in chunks", state="complete", expanded=False)
 
 
 def validate_url(url):
@@ -71,25 +93,46 @@ def validate_url(url):
         return False
 
 
+@st.cache_resource
+def get_fetcher():
+    # 接続プールは再実行やセッションをまたいで共有する (fetcher.py)
+    return Fetcher()
+
+
+@st.cache_resource
+def get_fetch_cache():
+    # 抽出済みの本文をディスクに保存し、新しいうちはネットワークにアクセスしない (fetch_cache.py)
+    return FetchCache(get_fetcher())
+
+
+def show_fetch_stats(page):
+    st.caption(f"Cache: {page.cache_status} (checked {page.age / 60:.0f} min ago), "
+               f"{len(page.text):,} chars extracted by {page.method}")
+    if page.fetch is not None:
+        result = page.fetch
+        timings = " / ".join(f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in result.timings.items())
+        reused = " (reused connection)" if result.reused_connection else ""
+        st.caption(f"HTTP {result.status}, {len(result.content):,} bytes: {timings}{reused}")
+    with st.sidebar.expander("Fetch cache / latency"):
+        st.json({"cache": get_fetch_cache().stats(), "latency": get_fetcher().stats.summary()})
+
+
 def get_content(url):
     try:
         with st.spinner("Fetching Website ..."):
-            response = requests.get(url)
-            soup = BeautifulSoup(response.text, 'html.parser')
-            # なるべく本文の可能性が高い要素を取得する
-            if soup.main:
-                return soup.main.get_text()
-            elif soup.article:
-                return soup.article.get_text()
-            else:
-                return soup.body.get_text()
+            page = get_fetch_cache().get(url)
+            show_fetch_stats(page)
+            return page.text
+    except FetchError as e:
+        st.error(f"Failed to fetch {url}: {e}")
+        return None
     except:
         st.write(traceback.format_exc())  # エラーが発生した場合はエラー内容を表示
         return None
 
 def main():
     init_page()
-    chain = init_chain()
+    summarizer = init_summarizer()
 
     # ユーザーの入力を監視
     if url := st.text_input("URL: ", key="input"):
@@ -99,7 +142,7 @@ def main():
         else:
             if content := get_content(url):
                 st.markdown("## Summary")
-                st.write_stream(chain.stream({"content": content}))
+                st.write_stream(stream_summary(summarizer, content))
 
 if __name__ == '__main__':
     main()
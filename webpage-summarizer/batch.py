@@ -0,0 +1,198 @@
+"""
+URL をまとめて要約するバッチ (Streamlit を使わないコマンドライン版)
+
+    python batch.py --urls urls.txt --output results.jsonl [--model GPT-4o-mini]
+    python batch.py --sitemap https://example.com/sitemap.xml --output results.jsonl
+
+取得 (fetch_cache.py / fetcher.py) と要約 (summarizer.py) はアプリと同じものを使う。
+asyncio で取得と要約を並行に進め、それぞれの同時実行数は --fetch-concurrency と
+--llm-concurrency で別々に抑える (LLM は map / reduce の各リクエストまで含めて数える)。
+結果は1件終わるごとに JSONL に追記する。出力ファイルがチェックポイントを兼ねていて、
+途中で止まっても同じコマンドを実行し直せば、成功済みの URL を飛ばして続きから再開する。
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lxml.etree
+
+from app import MODELS, SUMMARIZE_PROMPT, create_llm
+from fetch_cache import FetchCache, normalize_url
+from fetcher import Fetcher, FetchError
+from summarizer import MapReduceSummarizer
+
+
+FETCH_CONCURRENCY = 8
+LLM_CONCURRENCY = 4
+# サイトマップインデックスをたどる深さ
+MAX_SITEMAP_DEPTH = 3
+
+
+def read_url_list(path):
+    """ 1行1URL のファイル (- なら標準入力) を読む。空行と # で始まる行は無視する """
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    with f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def read_sitemap(fetcher, source, depth=0):
+    """ サイトマップ (URL かファイル) の URL を返す。サイトマップインデックスはたどる """
+    if os.path.exists(source):
+        with open(source, "rb") as f:
+            content = f.read()
+    else:
+        content = fetcher.fetch(source).content
+    if content[:2] == b"\x1f\x8b":
+        # sitemap.xml.gz をそのまま返すサーバーがある
+        content = gzip.decompress(content)
+    root = lxml.etree.fromstring(content, parser=lxml.etree.XMLParser(resolve_entities=False))
+    locations = [loc.strip() for loc in root.xpath("//*[local-name()='loc']/text()")]
+    if lxml.etree.QName(root).localname != "sitemapindex":
+        return locations
+    if depth >= MAX_SITEMAP_DEPTH:
+        raise ValueError(f"sitemap index nested deeper than {MAX_SITEMAP_DEPTH}: {source}")
+    urls = []
+    for location in locations:
+        urls.extend(read_sitemap(fetcher, location, depth + 1))
+    return urls
+
+
+def load_checkpoint(path, retry_failed=False):
+    """
+    出力ファイルから処理済みの URL (正規化済み) を返す
+    書き込み途中で止まった最後の行は切り捨てる
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    for line in data[:end].splitlines():
+        record = json.loads(line)
+        if record["status"] == "ok" or not retry_failed:
+            done.add(normalize_url(record["url"]))
+    return done
+
+
+def dedupe(urls):
+    seen, unique = set(), []
+    for url in urls:
+        key = normalize_url(url)
+        if key not in seen:
+            seen.add(key)
+            unique.append(url)
+    return unique
+
+
+def summarize(summarizer, content):
+    # バッチでは途中結果は使わず、最終的な要約だけを返す
+    return "".join(event for event in summarizer.stream(content) if isinstance(event, str))
+
+
+async def process(url, cache, summarizer, fetch_slots, summarize_slots, executor, model):
+    loop = asyncio.get_running_loop()
+    record = {"url": url, "model": model}
+    started = time.perf_counter()
+    try:
+        async with fetch_slots:
+            page = await loop.run_in_executor(executor, cache.get, url)
+        record.update(
+            final_url=page.url, title=page.title, cache_status=page.cache_status,
+            extraction=page.method, chars=len(page.text),
+            fetch_seconds=round(time.perf_counter() - started, 3),
+        )
+        if not page.text:
+            raise ValueError("no content extracted")
+        summarize_started = time.perf_counter()
+        async with summarize_slots:
+            record["summary"] = await loop.run_in_executor(executor, summarize, summarizer, page.text)
+        record["summarize_seconds"] = round(time.perf_counter() - summarize_started, 3)
+        record["status"] = "ok"
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["finished_at"] = time.time()
+    return record
+
+
+async def run_batch(urls, output, cache, summarizer, fetch_concurrency=FETCH_CONCURRENCY,
+                    llm_concurrency=LLM_CONCURRENCY, model=None, log=sys.stderr):
+    """ urls を要約して output (JSONL) に1件ずつ追記する。成功した件数を返す """
+    fetch_slots = asyncio.Semaphore(fetch_concurrency)
+    # 要約中のコンテンツ数。LLM へのリクエスト数そのものは summarizer.limiter で抑える
+    summarize_slots = asyncio.Semaphore(llm_concurrency)
+    executor = ThreadPoolExecutor(fetch_concurrency + llm_concurrency, thread_name_prefix="batch")
+    tasks = [
+        asyncio.ensure_future(
+            process(url, cache, summarizer, fetch_slots, summarize_slots, executor, model)
+        )
+        for url in urls
+    ]
+    succeeded = 0
+    try:
+        with open(output, "a", encoding="utf-8") as f:
+            for i, task in enumerate(asyncio.as_completed(tasks), start=1):
+                record = await task
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                # 1件ごとに書き出しておけば、落ちてもそこまでは再開時に飛ばせる
+                f.flush()
+                succeeded += record["status"] == "ok"
+                detail = record.get("cache_status") if record["status"] == "ok" else record["error"]
+                print(f"[{i}/{len(tasks)}] {record['status']} ({detail}) {record['url']}", file=log)
+    finally:
+        for task in tasks:
+            task.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+    return succeeded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--urls", help="1行1URL のファイル (- で標準入力)")
+    source.add_argument("--sitemap", help="サイトマップの URL かファイル")
+    parser.add_argument("--output", required=True, help="結果を追記する JSONL (再開用のチェックポイントを兼ねる)")
+    parser.add_argument("--model", choices=MODELS, default="GPT-4o-mini")
+    parser.add_argument("--fetch-concurrency", type=int, default=FETCH_CONCURRENCY)
+    parser.add_argument("--llm-concurrency", type=int, default=LLM_CONCURRENCY)
+    parser.add_argument("--retry-failed", action="store_true", help="前回失敗した URL もやり直す")
+    parser.add_argument("--limit", type=int, help="処理する URL 数の上限")
+    args = parser.parse_args()
+
+    fetcher = Fetcher()
+    cache = FetchCache(fetcher)
+    try:
+        urls = read_url_list(args.urls) if args.urls else read_sitemap(fetcher, args.sitemap)
+    except (OSError, FetchError, ValueError, lxml.etree.XMLSyntaxError) as e:
+        parser.error(f"could not read URLs: {e}")
+    done = load_checkpoint(args.output, args.retry_failed)
+    urls = [url for url in dedupe(urls) if normalize_url(url) not in done]
+    if args.limit is not None:
+        urls = urls[:args.limit]
+    print(f"{len(urls)} URLs to summarize ({len(done)} already in {args.output})", file=sys.stderr)
+
+    summarizer = MapReduceSummarizer(
+        create_llm(args.model),
+        SUMMARIZE_PROMPT,
+        max_concurrency=args.llm_concurrency,
+        limiter=threading.BoundedSemaphore(args.llm_concurrency),
+    )
+    succeeded = asyncio.run(run_batch(
+        urls, args.output, cache, summarizer,
+        args.fetch_concurrency, args.llm_concurrency, model=args.model,
+    ))
+    print(f"{succeeded}/{len(urls)} succeeded", file=sys.stderr)
+    return 0 if succeeded == len(urls) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+"""
+本文抽出のベンチマーク (BeautifulSoup の旧実装と lxml / readability の新実装の比較)
+
+    python benchmark.py [--sizes 200 1000 3000] [--layouts news div_soup main_wrapper japanese]
+                        [--repeat 3] [--fixtures DIR] [--save-fixtures DIR] [--output result.json]
+
+フィクスチャは、本文に加えてナビゲーション・サイドバー・コメント・インラインスクリプト
+(埋め込み JSON) などを含むニュースサイト風の HTML をシードから決定的に作る。
+保存したページを使う場合は --fixtures に <name>.html を置き、本文の正解を <name>.txt に置く
+(正解が無いページは時間だけを測る)。品質は正解の本文との語単位の F1 で表す。
+"""
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import time
+from collections import Counter
+from html import escape
+
+from extraction import extract_content, extract_with_beautifulsoup, normalize_text
+
+
+LAYOUTS = ("news", "div_soup", "main_wrapper", "japanese")
+ENGINES = ("beautifulsoup", "lxml")
+_WORDS = (
+    "market policy report growth energy climate city council budget research data model "
+    "school health water transport election court science team season company product "
+    "price survey network security release update community festival museum history"
+).split()
+_JA_WORDS = (
+    "政府 市場 経済 研究 発表 地域 住民 計画 予算 調査 結果 企業 技術 開発 教育 環境 "
+    "交通 選挙 裁判 科学 文化 歴史 施設 事業 委員会 報告 対策 影響 見通し 関係者"
+).split()
+_TOKEN = re.compile(r"[a-z0-9]+|[\u3040-\u30ff\u3400-\u9fff]")
+
+
+def _sentence(rng, words, japanese=False):
+    picked = [rng.choice(words) for _ in range(rng.randint(8, 18))]
+    if japanese:
+        return "".join(f"{w}{rng.choice('はがをにでのと')}" for w in picked) + "。"
+    return " ".join(picked).capitalize() + "."
+
+
+def _links(rng, words, n, japanese=False):
+    items = "".join(
+        f'<li><a href="/{i}">{escape(_sentence(rng, words, japanese)[:40])}</a></li>' for i in range(n)
+    )
+    return f"<ul>{items}</ul>"
+
+
+def _script(rng, n_bytes):
+    # 大きなニュースサイトに多い、ページの状態を丸ごと埋め込んだ JSON
+    state = {"items": [], "ads": []}
+    size = 0
+    while size < n_bytes:
+        item = {"id": rng.randrange(10**9), "headline": " ".join(rng.choices(_WORDS, k=12))}
+        state["items"].append(item)
+        size += 120
+    return f'<script type="application/json">{json.dumps(state)}</script>'
+
+
+def make_fixture(layout, size_kb, seed=0):
+    """ (HTML のバイト列, Content-Type の charset, 本文の正解テキスト) を返す """
+    rng = random.Random(f"{layout}-{size_kb}-{seed}")
+    japanese = layout == "japanese"
+    words = _JA_WORDS if japanese else _WORDS
+    title = _sentence(rng, words, japanese)[:60]
+    paragraphs = [
+        " ".join(_sentence(rng, words, japanese) for _ in range(rng.randint(3, 6)))
+        for _ in range(rng.randint(12, 24))
+    ]
+    body = "".join(f"<p>{escape(p)}</p>" for p in paragraphs)
+    nav = f'<nav class="global-nav">{_links(rng, words, 60, japanese)}</nav>'
+    sidebar = f'<aside class="sidebar"><h3>Popular</h3>{_links(rng, words, 30, japanese)}</aside>'
+    related = f'<section class="related"><h3>Related</h3>{_links(rng, words, 20, japanese)}</section>'
+    comments = []
+
+    def page(script_bytes):
+        comment_html = "".join(
+            f'<div class="comment"><span class="author">user{i}</span><p>{escape(c)}</p></div>'
+            for i, c in enumerate(comments)
+        )
+        comment_section = f'<section class="comments" id="comments">{comment_html}</section>'
+        if layout == "news":
+            content = (
+                f"{nav}<div class=\"wrap\"><article><h1>{escape(title)}</h1>{body}</article>"
+                f"{sidebar}{related}{comment_section}</div>"
+            )
+        elif layout == "main_wrapper":
+            # main の中に本文以外も入っているので、旧実装は main 全体を本文として扱ってしまう
+            content = (
+                f"{nav}<main><h1>{escape(title)}</h1><div class=\"article-body\">{body}</div>"
+                f"{related}{sidebar}{comment_section}</main>"
+            )
+        else:
+            content = (
+                f"<div id=\"header\">{nav}</div><div id=\"content\"><div class=\"post\">"
+                f"<h1>{escape(title)}</h1><div class=\"entry-content\">{body}</div></div>"
+                f"<div id=\"sidebar\">{sidebar}</div>{related}{comment_section}</div>"
+            )
+        charset = "shift_jis" if japanese else "utf-8"
+        html = (
+            f"<!DOCTYPE html><html><head><meta charset=\"{charset}\"><title>{escape(title)}</title>"
+            f"<style>.wrap{{display:flex}}</style>{_script(rng, script_bytes)}</head>"
+            f"<body>{content}<footer>{_links(rng, words, 15, japanese)}</footer>"
+            f"<script>window.dataLayer=[];</script></body></html>"
+        )
+        return html.encode(charset, errors="replace")
+
+    # 目標のサイズになるまでコメントと埋め込み JSON を増やす (おおよそ半分ずつ)
+    target = size_kb * 1024
+    html = page(0)
+    while len(html) < target / 2:
+        comments.extend(_sentence(rng, words, japanese) for _ in range(50))
+        html = page(0)
+    html = page(max(0, target - len(html)))
+    # 日本語のフィクスチャは Content-Type に charset を付けず、meta タグだけで判定させる
+    return html, None if japanese else "utf-8", "\n".join([title, *paragraphs])
+
+
+def load_fixtures(directory):
+    """ ディレクトリ内の <name>.html と (あれば) <name>.txt の組を返す """
+    fixtures = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".html"):
+            continue
+        stem = os.path.join(directory, name[:-5])
+        with open(stem + ".html", "rb") as f:
+            html = f.read()
+        reference = None
+        if os.path.exists(stem + ".txt"):
+            with open(stem + ".txt", encoding="utf-8") as f:
+                reference = f.read()
+        fixtures.append((name[:-5], html, None, reference))
+    return fixtures
+
+
+def token_f1(extracted, reference):
+    """ 正解の本文に対する語単位 (日本語は文字単位) の precision / recall / F1 """
+    got = Counter(_TOKEN.findall(extracted.lower()))
+    want = Counter(_TOKEN.findall(reference.lower()))
+    overlap = sum((got & want).values())
+    if not overlap:
+        return 0.0, 0.0, 0.0
+    precision, recall = overlap / sum(got.values()), overlap / sum(want.values())
+    return precision, recall, 2 * precision * recall / (precision + recall)
+
+
+def run_engine(engine, html, encoding):
+    if engine == "beautifulsoup":
+        _, text = extract_with_beautifulsoup(html, encoding)
+        return normalize_text(text), engine
+    extraction = extract_content(html, encoding)
+    return extraction.text, extraction.method
+
+
+def bench_fixture(name, html, encoding, reference, repeat):
+    result = {"fixture": name, "bytes": len(html), "engines": {}}
+    for engine in ENGINES:
+        seconds = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            text, method = run_engine(engine, html, encoding)
+            seconds.append(time.perf_counter() - started)
+        row = {"ms": 1000 * statistics.median(seconds), "chars": len(text), "method": method}
+        if reference is not None:
+            row["precision"], row["recall"], row["f1"] = token_f1(text, reference)
+        result["engines"][engine] = row
+    return result
+
+
+def print_table(results):
+    print(f'{"fixture":<28} {"KB":>6} ' + " ".join(f"{e + ' ms':>18} {'F1':>5}" for e in ENGINES) + "  speedup")
+    for r in results:
+        cols = []
+        for engine in ENGINES:
+            row = r["engines"][engine]
+            f1 = f'{row["f1"]:.2f}' if "f1" in row else "-"
+            cols.append(f'{row["ms"]:>18.1f} {f1:>5}')
+        speedup = r["engines"]["beautifulsoup"]["ms"] / r["engines"]["lxml"]["ms"]
+        print(f'{r["fixture"]:<28} {r["bytes"] / 1024:>6.0f} ' + " ".join(cols) + f"  {speedup:.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[200, 1000, 3000], help="KB")
+    parser.add_argument("--layouts", nargs="+", default=list(LAYOUTS), choices=LAYOUTS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fixtures", help="保存した HTML (<name>.html と正解の <name>.txt) のディレクトリ")
+    parser.add_argument("--save-fixtures", help="生成したフィクスチャを書き出すディレクトリ")
+    parser.add_argument("--output", help="結果を JSON で書き出すパス")
+    args = parser.parse_args()
+
+    if args.fixtures:
+        fixtures = load_fixtures(args.fixtures)
+    else:
+        fixtures = []
+        for layout in args.layouts:
+            for size_kb in args.sizes:
+                html, encoding, reference = make_fixture(layout, size_kb, args.seed)
+                fixtures.append((f"{layout}-{size_kb}kb", html, encoding, reference))
+    if args.save_fixtures:
+        os.makedirs(args.save_fixtures, exist_ok=True)
+        for name, html, _, reference in fixtures:
+            with open(os.path.join(args.save_fixtures, name + ".html"), "wb") as f:
+                f.write(html)
+            if reference is not None:
+                with open(os.path.join(args.save_fixtures, name + ".txt"), "w", encoding="utf-8") as f:
+                    f.write(reference)
+
+    results = [bench_fixture(*fixture, repeat=args.repeat) for fixture in fixtures]
+    print_table(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+HTML から本文のテキストを取り出すエンジン
+
+1. lxml で一度だけパースし、script / style などを取り除く
+2. その木のコピーに readability (readability-lxml) のスコアリングをかけて本文らしい要素を選ぶ
+   (readability 自身のパースと Cleaner は、ページ全体を何度も走査して遅いので使わない)
+3. 結果が短すぎる・失敗した場合は、同じ木で main → article → body の順に探す
+   (以前の BeautifulSoup 版と同じ考え方)
+4. lxml でもパースできない壊れた HTML は BeautifulSoup (html.parser) で処理する
+
+extract_with_beautifulsoup は以前の実装そのもので、ベンチマーク (benchmark.py) の比較対象にも使う。
+"""
+import copy
+import re
+import time
+from dataclasses import dataclass
+
+import lxml.etree
+import lxml.html
+from bs4 import BeautifulSoup
+from readability import Document
+from readability.encoding import get_encoding
+from readability.readability import Unparseable
+
+
+# readability の結果がこれより短ければ本文を見つけられなかったとみなす
+MIN_TEXT_LENGTH = 200
+READABILITY, HEURISTIC, BEAUTIFULSOUP = "readability", "heuristic", "beautifulsoup"
+_NON_CONTENT_TAGS = ("script", "style", "noscript", "template", "svg")
+_BLANK_LINES = re.compile(r"\n\s*\n+")
+_UTF8_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+
+
+@dataclass
+class Extraction:
+    text: str
+    title: str
+    method: str
+    seconds: float
+
+
+def normalize_text(text):
+    """ 行ごとの前後の空白と連続する空行を取り除く """
+    lines = (line.strip() for line in text.splitlines())
+    return _BLANK_LINES.sub("\n\n", "\n".join(lines)).strip()
+
+
+def parse_html(content, encoding=None):
+    """
+    HTML を lxml で一度だけパースし、本文に関係しない要素を取り除いた木を返す
+    charset が分からなければ readability と同じく meta タグや文字種から判定する
+    """
+    if not isinstance(content, str):
+        content = content.decode(encoding or get_encoding(content) or "utf-8", errors="replace")
+    # デコード済みなので UTF-8 として渡す (meta タグの charset に惑わされないように)
+    tree = lxml.html.document_fromstring(content.encode("utf-8", "replace"), parser=_UTF8_PARSER)
+    # 巨大な埋め込み JSON などを先に捨てておくと、以降の走査が軽くなる
+    lxml.etree.strip_elements(tree, *_NON_CONTENT_TAGS, with_tail=False)
+    lxml.etree.strip_elements(tree, lxml.etree.Comment, lxml.etree.ProcessingInstruction, with_tail=False)
+    return tree
+
+
+class _ParsedDocument(Document):
+    """ パース済みの木を使う readability の Document (パースと Cleaner を省く) """
+
+    def __init__(self, tree, **kwargs):
+        super().__init__(None, **kwargs)
+        self._tree = tree
+
+    def _parse(self, input):
+        # summary は再試行のたびに木を読み直して書き換えるので、毎回コピーを渡す
+        return copy.deepcopy(self._tree)
+
+
+def extract_with_readability(tree, url=None):
+    """ readability で本文を選んでテキストを返す。見つからなければ短いか空になる """
+    summary = _ParsedDocument(tree, url=url).summary(html_partial=True)
+    return normalize_text(lxml.html.fragment_fromstring(summary).text_content())
+
+
+def extract_with_heuristic(tree):
+    """ main → article → body の順に探し、最初に見つかった要素のテキストを返す """
+    for tag in ("main", "article", "body"):
+        found = tree.find(f".//{tag}")
+        if found is not None:
+            return normalize_text(found.text_content())
+    return normalize_text(tree.text_content())
+
+
+def extract_with_beautifulsoup(content, encoding=None):
+    """ 以前の実装 (BeautifulSoup の html.parser で木全体を作ってから探す) """
+    soup = BeautifulSoup(content, 'html.parser', from_encoding=encoding)
+    title = soup.title.get_text().strip() if soup.title else ""
+    # なるべく本文の可能性が高い要素を取得する
+    if soup.main:
+        return title, soup.main.get_text()
+    elif soup.article:
+        return title, soup.article.get_text()
+    else:
+        return title, (soup.body or soup).get_text()
+
+
+def extract_content(content, encoding=None, url=None):
+    """ 本文を取り出して Extraction を返す。content はバイト列か文字列 """
+    started = time.perf_counter()
+    try:
+        tree = parse_html(content, encoding)
+    except (lxml.etree.ParserError, ValueError):
+        # lxml でも読めない壊れた HTML
+        title, text = extract_with_beautifulsoup(content, encoding)
+        return Extraction(normalize_text(text), title, BEAUTIFULSOUP, time.perf_counter() - started)
+
+    title = (tree.findtext(".//title") or "").strip()
+    method = READABILITY
+    try:
+        text = extract_with_readability(tree, url)
+    except Unparseable:
+        text = ""
+    if len(text) < MIN_TEXT_LENGTH:
+        fallback = extract_with_heuristic(tree)
+        # readability が何も選べなかったか、短すぎる部分を選んだ場合だけ置き換える
+        if len(fallback) > len(text):
+            text, method = fallback, HEURISTIC
+    return Extraction(text, title, method, time.perf_counter() - started)
@@ -0,0 +1,233 @@
+"""
+Webページ取得のディスクキャッシュ
+
+正規化した URL をキーに、抽出済みの本文と ETag / Last-Modified を SQLite に保存する。
+- 新しいうち (Cache-Control の max-age などで決まる期間) はネットワークにアクセスせずに返す (hit)
+- 古くなったら If-None-Match / If-Modified-Since 付きで取得し、304 なら保存済みの本文を使う (revalidated)
+- 変わっていれば取得し直して抽出し、保存し直す (updated)。初めての URL は miss
+- サイトが落ちている (接続できない・5xx) 場合は、MAX_AGE 以内に確認した古い本文を返す (stale)。
+  404 / 410 が返ったページは削除する
+最後に使われてから MAX_AGE を過ぎたものと、合計サイズが MAX_BYTES を超えた分は古い順に削除する。
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from extraction import extract_content
+from fetcher import FetchError, HTTPStatusError, ResponseTooLarge
+
+
+DEFAULT_PATH = os.environ.get(
+    "WEBPAGE_SUMMARIZER_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".data", "fetch_cache.sqlite3"),
+)
+# 鮮度の指定が無いページをネットワークに問い合わせずに使う期間
+DEFAULT_FRESH_TTL = 10 * 60
+# 最後に使われてからこの期間を過ぎたものは削除する
+MAX_AGE = 7 * 24 * 60 * 60
+MAX_BYTES = 256 * 1024 * 1024
+HIT, REVALIDATED, UPDATED, MISS, STALE = "hit", "revalidated", "updated", "miss", "stale"
+# このステータスが返ったページは無くなったものとしてキャッシュから消す
+GONE_STATUSES = (404, 410)
+# 同じページを指すのに付いていることが多い計測用のパラメータ
+_TRACKING_PARAMS = ("utm_", "fbclid", "gclid", "mc_cid", "mc_eid")
+
+
+def normalize_url(url):
+    """ スキームとホストの小文字化、既定のポート・フラグメント・計測用パラメータの除去、クエリの整列 """
+    parts = urlsplit(url.strip())
+    scheme, host = parts.scheme.lower(), (parts.hostname or "").lower()
+    port = parts.port
+    netloc = host if port is None or (scheme, port) in (("http", 80), ("https", 443)) else f"{host}:{port}"
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.lower().startswith(_TRACKING_PARAMS)
+    )
+    return urlunsplit((scheme, netloc, parts.path or "/", urlencode(query), ""))
+
+
+def freshness(headers, now, default=DEFAULT_FRESH_TTL):
+    """ レスポンスをネットワークに問い合わせずに使ってよい秒数。保存してはいけなければ None """
+    directives = {}
+    for part in headers.get("Cache-Control", "").lower().split(","):
+        name, _, value = part.strip().partition("=")
+        if name:
+            directives[name] = value.strip('"')
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+    if directives.get("max-age", "").isdigit():
+        return int(directives["max-age"])
+    if "Expires" in headers:
+        try:
+            return max(0, parsedate_to_datetime(headers["Expires"]).timestamp() - now)
+        except (TypeError, ValueError):
+            # 不正な Expires は「すでに期限切れ」として扱う
+            return 0
+    return default
+
+
+@dataclass
+class Page:
+    url: str
+    title: str
+    text: str
+    method: str
+    cache_status: str
+    # 最後にサーバーに確認した時刻
+    fetched: float
+    # ネットワークにアクセスした場合の取得結果 (fetcher.FetchResult)
+    fetch: object = None
+
+    @property
+    def age(self):
+        return time.time() - self.fetched
+
+
+class FetchCache:
+    def __init__(self, fetcher, path=DEFAULT_PATH, default_fresh_ttl=DEFAULT_FRESH_TTL,
+                 max_age=MAX_AGE, max_bytes=MAX_BYTES):
+        self.fetcher = fetcher
+        self.default_fresh_ttl = default_fresh_ttl
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.counts = dict.fromkeys((HIT, REVALIDATED, UPDATED, MISS, STALE), 0)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 複数スレッド・複数プロセスから使うので WAL モードで開き、接続はロックで守る
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " key TEXT PRIMARY KEY, url TEXT NOT NULL, title TEXT NOT NULL, text TEXT NOT NULL,"
+            " method TEXT NOT NULL, etag TEXT, last_modified TEXT, fetched REAL NOT NULL,"
+            " fresh_until REAL NOT NULL, last_used REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)")
+        self._conn.commit()
+
+    def _key(self, url):
+        return hashlib.sha256(normalize_url(url).encode("utf-8")).hexdigest()
+
+    def _load(self, key):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT url, title, text, method, etag, last_modified, fetched, fresh_until"
+                " FROM pages WHERE key = ?", (key,),
+            ).fetchone()
+
+    def _touch(self, key, fetched=None, fresh_until=None):
+        with self._lock:
+            if fetched is None:
+                self._conn.execute("UPDATE pages SET last_used = ? WHERE key = ?", (time.time(), key))
+            else:
+                self._conn.execute(
+                    "UPDATE pages SET last_used = ?, fetched = ?, fresh_until = ? WHERE key = ?",
+                    (time.time(), fetched, fresh_until, key),
+                )
+            self._conn.commit()
+
+    def _store(self, key, page, etag, last_modified, fresh_until):
+        size = len(page.text.encode("utf-8")) + len(page.title.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages (key, url, title, text, method, etag, last_modified,"
+                " fetched, fresh_until, last_used, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, page.url, page.title, page.text, page.method, etag, last_modified,
+                 page.fetched, fresh_until, page.fetched, size),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM pages WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def _evict(self):
+        self._conn.execute("DELETE FROM pages WHERE last_used < ?", (time.time() - self.max_age,))
+        (total,) = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for key, size in self._conn.execute("SELECT key, size FROM pages ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            victims.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM pages WHERE key = ?", victims)
+
+    def _count(self, status):
+        with self._lock:
+            self.counts[status] += 1
+
+    def get(self, url):
+        """ URL の本文を Page で返す。取得できず、キャッシュにも無ければ FetchError """
+        key = self._key(url)
+        row = self._load(key)
+        now = time.time()
+        if row is not None:
+            cached = Page(*row[:4], cache_status=HIT, fetched=row[6])
+            etag, last_modified, fresh_until = row[4], row[5], row[7]
+            if now < fresh_until:
+                self._touch(key)
+                self._count(HIT)
+                return cached
+
+        headers = {}
+        if row is not None:
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        try:
+            result = self.fetcher.fetch(url, headers=headers)
+        except FetchError as e:
+            if row is None:
+                raise
+            if isinstance(e, HTTPStatusError) and e.status in GONE_STATUSES:
+                self._delete(key)
+                raise
+            # サイトが落ちているとは言えないエラーや、古すぎる本文は返さない
+            if (isinstance(e, HTTPStatusError) and e.status < 500) or isinstance(e, ResponseTooLarge):
+                raise
+            if now - cached.fetched > self.max_age:
+                raise
+            # last_used は更新しない (落ちたままのページがいつまでも消されずに残らないように)
+            self._count(STALE)
+            cached.cache_status = STALE
+            return cached
+
+        ttl = freshness(result.headers, now, self.default_fresh_ttl)
+        fresh_until = now + min(ttl or 0, self.max_age)
+        if result.status == 304 and row is not None:
+            self._touch(key, fetched=now, fresh_until=fresh_until)
+            self._count(REVALIDATED)
+            cached.cache_status, cached.fetched, cached.fetch = REVALIDATED, now, result
+            return cached
+
+        extraction = extract_content(result.content, result.encoding, url=result.url)
+        status = MISS if row is None else UPDATED
+        page = Page(result.url, extraction.title, extraction.text, extraction.method, status, now, result)
+        if ttl is not None:
+            self._store(
+                key, page, result.headers.get("ETag"), result.headers.get("Last-Modified"), fresh_until
+            )
+        elif row is not None:
+            # no-store に変わったページは古い本文も残さない
+            self._delete(key)
+        self._count(status)
+        return page
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages"
+            ).fetchone()
+            return {"entries": entries, "bytes": size, **self.counts}
@@ -0,0 +1,357 @@
+"""
+Webページ取得用の共有 HTTP クライアント
+
+- requests.Session の接続プールを使い回す (keep-alive)。Streamlit では st.cache_resource で
+  1つの Fetcher を全セッションで共有する
+- 接続と読み込みのタイムアウトに加えて、取得全体の上限時間 (total_timeout) を設ける。
+  少しずつ送り続けるサーバーでも止まるように、上限を過ぎたら読み込み中のソケットを閉じる
+- gzip / deflate は常に、brotli はパッケージ (brotli / brotlicffi) があれば展開する
+- 本文はストリーミングで読み、展開後のバイト数が max_bytes を超えたら打ち切る
+- ホストごとの同時接続数を per_host_limit までに抑える
+- DNS / 接続 (TCP + TLS) / 応答待ち / 転送 の所要時間を記録する
+"""
+import email.message
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+
+
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 15.0
+TOTAL_TIMEOUT = 30.0
+MAX_BYTES = 5 * 1024 * 1024
+PER_HOST_LIMIT = 4
+# 接続プールを保持するホスト数
+POOL_HOSTS = 32
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 64 * 1024
+USER_AGENT = "Mozilla/5.0 (compatible; webpage-summarizer/1.0)"
+PHASES = ("dns", "connect", "wait", "transfer", "total")
+
+# 取得中のスレッドごとの計測値 (接続はそれを要求したスレッドで確立される)
+_current = threading.local()
+
+
+class FetchError(Exception):
+    pass
+
+
+class ResponseTooLarge(FetchError):
+    pass
+
+
+class HTTPStatusError(FetchError):
+    """ サーバーがエラーのステータス (4xx / 5xx) を返した """
+
+    def __init__(self, status, reason):
+        super().__init__(f"HTTP {status} {reason}")
+        self.status = status
+
+
+class _Watchdog:
+    """ 上限時間を過ぎたら使用中の接続のソケットを閉じ、ブロックしている読み込みを抜けさせる """
+
+    def __init__(self, seconds):
+        # リクエストを送ったソケット (リダイレクトでは最後のもの)
+        self.sock = None
+        self.expired = False
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._timer = threading.Timer(seconds, self._expire)
+        self._timer.daemon = True
+
+    def start(self):
+        self._timer.start()
+
+    def stop(self):
+        # 接続をプールに返す前に呼ぶ (返した後に閉じると、別の取得に使われている接続を壊しうる)
+        with self._lock:
+            self._stopped = True
+        self._timer.cancel()
+
+    def _expire(self):
+        with self._lock:
+            if self._stopped:
+                return
+            self.expired = True
+            if self.sock is not None:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+def _record(phase, seconds):
+    timings = getattr(_current, "timings", None)
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+class _TimedConnectionMixin:
+    """ 新しい接続を作るときに DNS と接続 (TCP + TLS) の時間を計る """
+
+    def _new_conn(self):
+        started = time.perf_counter()
+        host = self._dns_host
+        try:
+            infos = socket.getaddrinfo(host, self.port, allowed_gai_family(), socket.SOCK_STREAM)
+        except OSError:
+            # 名前解決のエラーの変換は urllib3 に任せる
+            return super()._new_conn()
+        self._dns_seconds = time.perf_counter() - started
+        _record("dns", self._dns_seconds)
+        # 解決済みのアドレスに順に接続する (TLS の SNI と証明書の検証には元のホスト名を使う)
+        # urllib3 と同じく、つながらないアドレスは飛ばして次を試す (IPv6 が通らない環境など)
+        error = None
+        for address in dict.fromkeys(info[4][0] for info in infos):
+            self._dns_host = address
+            try:
+                return super()._new_conn()
+            except (ConnectTimeoutError, NewConnectionError) as e:
+                error = e
+            finally:
+                self._dns_host = host
+        raise error
+
+    def connect(self):
+        started = time.perf_counter()
+        self._dns_seconds = 0.0
+        super().connect()
+        _record("connect", time.perf_counter() - started - self._dns_seconds)
+
+    def request(self, *args, **kwargs):
+        super().request(*args, **kwargs)
+        # 接続は送信時に確立されることがあるので送った後に記録する
+        # (Connection: close の応答を受け取ると self.sock は外れるが、ソケットは応答が使い続ける)
+        watchdog = getattr(_current, "watchdog", None)
+        if watchdog is not None:
+            watchdog.sock = self.sock
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+
+@dataclass
+class FetchResult:
+    url: str
+    status: int
+    headers: dict
+    content: bytes
+    encoding: str = None
+    # フェーズごとの秒数。接続を使い回した場合は dns / connect が無い
+    timings: dict = field(default_factory=dict)
+
+    @property
+    def reused_connection(self):
+        return "connect" not in self.timings
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+
+def _charset(content_type):
+    """ Content-Type の charset。指定が無ければ None (HTML の meta は呼び出し側で見る) """
+    if not content_type:
+        return None
+    message = email.message.Message()
+    message["content-type"] = content_type
+    return message.get_param("charset")
+
+
+class LatencyStats:
+    """ フェーズごとの直近の所要時間とカウンタ """
+
+    def __init__(self, window=1000):
+        self._samples = {phase: deque(maxlen=window) for phase in PHASES}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.new_connections = 0
+
+    def record(self, timings, size):
+        with self._lock:
+            self.requests += 1
+            self.bytes += size
+            self.new_connections += "connect" in timings
+            for phase, seconds in timings.items():
+                self._samples[phase].append(seconds)
+
+    def error(self):
+        with self._lock:
+            self.errors += 1
+
+    def summary(self):
+        with self._lock:
+            phases = {}
+            for phase, samples in self._samples.items():
+                if not samples:
+                    continue
+                ordered = sorted(samples)
+                phases[phase] = {
+                    "count": len(ordered),
+                    "mean_ms": 1000 * sum(ordered) / len(ordered),
+                    "p50_ms": 1000 * ordered[len(ordered) // 2],
+                    "p95_ms": 1000 * ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                    "max_ms": 1000 * ordered[-1],
+                }
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "bytes": self.bytes,
+                "new_connections": self.new_connections,
+                "phases": phases,
+            }
+
+
+class Fetcher:
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 total_timeout=TOTAL_TIMEOUT, max_bytes=MAX_BYTES, per_host_limit=PER_HOST_LIMIT,
+                 user_agent=USER_AGENT):
+        self.timeout = (connect_timeout, read_timeout)
+        self.total_timeout = total_timeout
+        self.max_bytes = max_bytes
+        self.per_host_limit = per_host_limit
+        self.stats = LatencyStats()
+        self.session = requests.Session()
+        self.session.max_redirects = MAX_REDIRECTS
+        # Accept-Encoding は requests の既定 (brotli が使えれば br を含む) のまま
+        self.session.headers["User-Agent"] = user_agent
+        adapter = _TimedAdapter(pool_connections=POOL_HOSTS, pool_maxsize=per_host_limit)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # ホストごとの [セマフォ, 待っている・取得中のリクエスト数]。使われなくなったホストは消す
+        self._host_slots = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _host_slot(self, host):
+        with self._lock:
+            entry = self._host_slots.setdefault(host, [threading.BoundedSemaphore(self.per_host_limit), 0])
+            entry[1] += 1
+        slot = entry[0]
+        try:
+            if not slot.acquire(timeout=self.total_timeout):
+                raise FetchError(f"too many concurrent requests to {host}")
+            try:
+                yield
+            finally:
+                slot.release()
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._host_slots[host]
+
+    def fetch(self, url, headers=None):
+        """ URL を取得して FetchResult を返す。失敗した場合は FetchError """
+        host = (urlsplit(url).hostname or "").lower()
+        with self._host_slot(host):
+            _current.timings = timings = {}
+            _current.watchdog = watchdog = _Watchdog(self.total_timeout)
+            started = time.perf_counter()
+            watchdog.start()
+            try:
+                result = self._fetch(url, headers, started, timings, watchdog)
+            except FetchError:
+                self.stats.error()
+                raise
+            except requests.RequestException as e:
+                self.stats.error()
+                raise FetchError(f"{type(e).__name__}: {e}") from e
+            finally:
+                watchdog.stop()
+                _current.timings = None
+                _current.watchdog = None
+        timings["total"] = time.perf_counter() - started
+        self.stats.record(timings, len(result.content))
+        return result
+
+    def _fetch(self, url, headers, started, timings, watchdog):
+        deadline = started + self.total_timeout
+        try:
+            with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                try:
+                    return self._handle(response, deadline, started, timings, watchdog)
+                finally:
+                    watchdog.stop()
+        except requests.RequestException as e:
+            # ソケットを閉じたことによるエラーは上限時間の超過として返す
+            if watchdog.expired:
+                raise self._deadline_error() from e
+            raise
+
+    def _handle(self, response, deadline, started, timings, watchdog):
+        responded = time.perf_counter()
+        # 接続の確立を除いた、リクエストを送ってからヘッダーを受け取るまでの時間
+        timings["wait"] = responded - started - timings.get("dns", 0.0) - timings.get("connect", 0.0)
+        if response.status_code >= 400:
+            raise HTTPStatusError(response.status_code, response.reason)
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > self.max_bytes:
+            raise ResponseTooLarge(f"{length} bytes exceeds the limit of {self.max_bytes}")
+        content = self._read_body(response, deadline)
+        # Content-Length の無い応答は、閉じられたソケットの EOF で途中までの本文が返りうる
+        if watchdog.expired:
+            raise self._deadline_error()
+        timings["transfer"] = time.perf_counter() - responded
+        return FetchResult(
+            url=response.url,
+            status=response.status_code,
+            # 大文字小文字を区別しない (requests の CaseInsensitiveDict)
+            headers=response.headers,
+            content=content,
+            encoding=_charset(response.headers.get("Content-Type")),
+            timings=timings,
+        )
+
+    def _deadline_error(self):
+        return FetchError(f"download did not finish within {self.total_timeout}s")
+
+    def _read_body(self, response, deadline):
+        # 展開後のサイズで数えるので、圧縮爆弾も max_bytes で止まる
+        body = bytearray()
+        for chunk in response.iter_content(CHUNK_SIZE):
+            body += chunk
+            if len(body) > self.max_bytes:
+                raise ResponseTooLarge(f"response exceeds the limit of {self.max_bytes} bytes")
+            if time.perf_counter() > deadline:
+                raise self._deadline_error()
+        return bytes(body)
+
+    def close(self):
+        self.session.close()
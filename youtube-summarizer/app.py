@@ -1,9 +1,8 @@
 # Github: https://github.com/naotaka1128/llm_app_codes/chapter05/part2/main.py
 
 import traceback
+from collections import Counter
 import streamlit as st
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
 
 # models
 from langchain_openai import ChatOpenAI
@@ -13,6 +12,8 @@ from langchain_google_genai import ChatGoogleGenerativeAI
 from urllib.parse import urlparse
 from langchain_community.document_loaders import YoutubeLoader  # Youtube用
 
+from summarizer import MapReduceSummarizer, PartialSummary
+
 ###### dotenv を利用しない場合は消してください ######
 try:
     from dotenv import load_dotenv
@@ -56,14 +57,28 @@ def select_model(temperature=0):
         return ChatGoogleGenerativeAI(temperature=temperature, model="gemini-1.5-pro-latest")
 
 
-def init_chain():
+def init_summarizer():
     llm = select_model()
-    prompt = ChatPromptTemplate.from_messages([
-        ("user", SUMMARIZE_PROMPT),
-    ])
-    output_parser = StrOutputParser()
-    chain = prompt | llm | output_parser
-    return chain
+    # 長いコンテンツは分割して並列に要約してからまとめる (summarizer.py)
+    return MapReduceSummarizer(llm, SUMMARIZE_PROMPT)
+
+
+def stream_summary(summarizer, content):
+    """ チャンクごとの途中結果を表示しながら、最終的な要約のトークンを yield する """
+    status = None
+    finished = Counter()
+    for event in summarizer.stream(content):
+        if not isinstance(event, PartialSummary):
+            yield event
+            continue
+        if status is None:
+            status = st.status("Summarizing ...")
+        # 途中結果は終わった順に届くので、段ごとの完了数を数える
+        finished[event.stage, event.total] += 1
+        status.update(label=f"Summarizing ... ({event.stage} {finished[event.stage, event.total]}/{event.total})")
+        status.markdown(f"**{event.stage} {event.index}/{event.total}**\n\n{event.text}")
+    if status is not None:
+        status.update(label="Summarized in chunks", state="complete", expanded=False)
 
 
 def validate_url(url):
@@ -110,7 +125,7 @@ def get_content(url):
 
 def main():
     init_page()
-    chain = init_chain()
+    summarizer = init_summarizer()
 
     # ユーザーの入力を監視
     if url := st.text_input("URL: ", key="input"):
@@ -120,7 +135,7 @@ def main():
         else:
             if content := get_content(url):
                 st.markdown("## Summary")
-                st.write_stream(chain.stream({"content": content}))
+                st.write_stream(stream_summary(summarizer, content))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,156 @@
+"""
+長いコンテンツの map-reduce 要約エンジン
+
+1. コンテンツをトークン数で分割する
+2. 各チャンクを並列 (最大 max_concurrency) に要約する (map)
+3. 要約を1回のプロンプトに収まる量ずつまとめ直し (reduce)、収まったら最終的な要約を作る
+
+短いコンテンツは従来どおり1回のリクエストで要約する。
+stream() は途中結果 (PartialSummary) を終わった順に返し、最後に最終的な要約をトークンごとに返す。
+LLM の呼び出しはスレッドで行い、Streamlit の描画は呼び出し側 (スクリプトのスレッド) で行う。
+
+webpage-summarizer と youtube-summarizer に同じものを置いている。
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from dataclasses import dataclass
+
+import tiktoken
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+
+# これ以下のトークン数なら分割せずに1回で要約する
+SINGLE_PASS_TOKENS = 8_000
+CHUNK_TOKENS = 4_000
+CHUNK_OVERLAP = 200
+# reduce の1回のプロンプトに入れる要約のトークン数の上限
+REDUCE_TOKENS = 6_000
+MAX_CONCURRENCY = 4
+
+MAP_PROMPT = """以下は長いコンテンツを分割したものの一部 ({index}/{total}) です。
+この部分の重要な点を200文字程度で箇条書きにまとめてください。
+
+========
+
+{content}
+
+========
+
+日本語で書いてね！
+"""
+
+REDUCE_PROMPT = """以下は長いコンテンツを分割して要約したものです。
+重複を除いて、重要な点を400文字程度の箇条書きにまとめ直してください。
+
+========
+
+{content}
+
+========
+
+日本語で書いてね！
+"""
+
+
+@dataclass
+class PartialSummary:
+    stage: str  # "map" または "reduce"
+    index: int
+    total: int
+    text: str
+
+
+def _token_counter():
+    try:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    except OSError:
+        # エンコーディングをダウンロードできない環境では文字数で数える (日本語ではほぼ同じ、英語では多めになる)
+        return len
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+class MapReduceSummarizer:
+    def __init__(self, llm, final_prompt, max_concurrency=MAX_CONCURRENCY,
+                 chunk_tokens=CHUNK_TOKENS, single_pass_tokens=SINGLE_PASS_TOKENS,
+                 reduce_tokens=REDUCE_TOKENS, limiter=None):
+        output_parser = StrOutputParser()
+        self.map_chain = ChatPromptTemplate.from_messages([("user", MAP_PROMPT)]) | llm | output_parser
+        self.reduce_chain = ChatPromptTemplate.from_messages([("user", REDUCE_PROMPT)]) | llm | output_parser
+        self.final_chain = ChatPromptTemplate.from_messages([("user", final_prompt)]) | llm | output_parser
+        self.max_concurrency = max_concurrency
+        self.single_pass_tokens = single_pass_tokens
+        self.reduce_tokens = reduce_tokens
+        # 複数のコンテンツを同時に要約する場合に、LLM へのリクエスト数を全体で抑えるためのもの
+        # (threading.BoundedSemaphore など)。各リクエストの間だけ with で取る
+        self.limiter = limiter or nullcontext()
+        self.count_tokens = _token_counter()
+        self.splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_tokens,
+            chunk_overlap=CHUNK_OVERLAP,
+            length_function=self.count_tokens,
+            separators=["\n\n", "\n", "。", ". ", " ", ""],
+        )
+
+    def _run(self, executor, stage, chain, inputs):
+        """ inputs を並列に実行し、終わった順に PartialSummary を yield する """
+        futures = {
+            executor.submit(self._invoke, chain, {**values, "index": i + 1, "total": len(inputs)}): i
+            for i, values in enumerate(inputs)
+        }
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = futures[future]
+                yield PartialSummary(stage, i + 1, len(inputs), future.result())
+
+    def _invoke(self, chain, values):
+        with self.limiter:
+            return chain.invoke(values)
+
+    def _stream_final(self, content):
+        with self.limiter:
+            yield from self.final_chain.stream({"content": content})
+
+    def _group(self, summaries):
+        """ 要約を reduce_tokens 以下ずつのグループに分ける (順序は保つ) """
+        groups, current, size = [], [], 0
+        for summary in summaries:
+            tokens = self.count_tokens(summary)
+            # 必ず2つ以上ずつまとめる (1つずつでは reduce しても数が減らない)
+            if len(current) > 1 and size + tokens > self.reduce_tokens:
+                groups.append(current)
+                current, size = [], 0
+            current.append(summary)
+            size += tokens
+        groups.append(current)
+        return groups
+
+    def stream(self, content):
+        """ 途中結果の PartialSummary と、最終的な要約のトークン (str) を順に yield する """
+        if self.count_tokens(content) <= self.single_pass_tokens:
+            yield from self._stream_final(content)
+            return
+
+        executor = ThreadPoolExecutor(self.max_concurrency, thread_name_prefix="summarize")
+        try:
+            chunks = self.splitter.split_text(content)
+            summaries = [None] * len(chunks)
+            for partial in self._run(executor, "map", self.map_chain, [{"content": c} for c in chunks]):
+                summaries[partial.index - 1] = partial.text
+                yield partial
+            # 1回のプロンプトに収まるまで、隣り合う要約をまとめ直す
+            groups = self._group(summaries)
+            while len(groups) > 1:
+                inputs = [{"content": "\n\n".join(group)} for group in groups]
+                summaries = [None] * len(inputs)
+                for partial in self._run(executor, "reduce", self.reduce_chain, inputs):
+                    summaries[partial.index - 1] = partial.text
+                    yield partial
+                groups = self._group(summaries)
+        finally:
+            # 途中で打ち切られた場合は未着手の要約を捨てる
+            executor.shutdown(wait=False, cancel_futures=True)
+        yield from self._stream_final("\n\n".join(groups[0]))